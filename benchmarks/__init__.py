@@ -0,0 +1 @@
+"""Contains performance benchmarks for this package. Not a part of the distribution."""
@@ -0,0 +1,73 @@
+"""Compares decoders of message values from src.decoders per installed JSON library
+
+Measures decoding alone and decoding together with building the COPY buffer, i.e. the whole
+client side way of a message from Kafka bytes to data sent to DB. 'legacy' is the decoder
+the consumer used before decoders were pluggable.
+
+Usage:
+    python -m benchmarks.decoders [--messages 10000] [--repeat 5]
+"""
+import argparse
+import importlib
+import json
+import time
+
+from statistics import median
+
+try:
+    from ..benchmarks.ingest import make_batch
+    from ..src.decoders import DECODERS, JSON_LIBRARIES, RowDecoder
+    from ..src.postgres_wrapper import WebMonitoringDBWrapper
+except ImportError:
+    from benchmarks.ingest import make_batch
+    from src.decoders import DECODERS, JSON_LIBRARIES, RowDecoder
+    from src.postgres_wrapper import WebMonitoringDBWrapper
+
+
+def legacy_decoder(value: bytes):
+    return json.loads(value.decode('utf-8'))
+
+
+def installed_libraries() -> list:
+    libraries = []
+    for name in JSON_LIBRARIES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+        libraries.append(name)
+    return libraries
+
+
+def run(decoder, messages: list, repeat: int, to_buffer: bool) -> float:
+    """Returns median time in seconds of decoding all messages"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        records = [decoder(message) for message in messages]
+        if to_buffer:
+            WebMonitoringDBWrapper.to_copy_buffer(records)
+        timings.append(time.perf_counter() - start)
+    return median(timings)
+
+
+if __name__ == '__main__':
+    cmd_args = argparse.ArgumentParser()
+    cmd_args.add_argument('--messages', dest='messages', help='messages to decode', default=10000, type=int)
+    cmd_args.add_argument('--repeat', dest='repeat', help='number of runs per decoder', default=5, type=int)
+    args = cmd_args.parse_args()
+
+    messages = [json.dumps(record).encode('utf-8') for record in make_batch(args.messages)]
+    keys = tuple(WebMonitoringDBWrapper.DATA_TO_DB)
+    decoders = {'legacy': legacy_decoder}
+    for library in installed_libraries():
+        for kind, decoder_class in DECODERS.items():
+            decoder_args = (keys,) if decoder_class is RowDecoder else ()
+            decoders[f'{kind}/{library}'] = decoder_class(*decoder_args, library=library)
+
+    print(f'Decoding of {args.messages} messages, median of {args.repeat} runs:')
+    print(f'  {"decoder":<14} {"decode, us/msg":>15} {"+ COPY buffer, us/msg":>22}')
+    for name, decoder in decoders.items():
+        decode = run(decoder, messages, args.repeat, to_buffer=False)
+        total = run(decoder, messages, args.repeat, to_buffer=True)
+        print(f'  {name:<14} {decode / args.messages * 1e6:15.2f} {total / args.messages * 1e6:22.2f}')
@@ -0,0 +1,116 @@
+"""Synthetic web metrics shaped like messages of the collector service
+
+Usage:
+    python -m benchmarks.generator [--messages 5] [--urls 100] [--null-rate 0.1] [--payload-size 0]
+"""
+import argparse
+import datetime
+import json
+import math
+import random
+
+from typing import Any, Dict, List, Optional
+
+
+# status codes of responses and their frequencies
+STATUS_CODES = {200: 0.9, 301: 0.02, 404: 0.03, 500: 0.03, 503: 0.02}
+
+
+class MetricGenerator:
+    def __init__(
+            self,
+            urls: int = 100,
+            null_rate: float = 0.1,
+            payload_size: int = 0,
+            seed: int = 0,
+            start: datetime.datetime = datetime.datetime(2021, 1, 1),
+            interval: float = 0.01,
+            comment: Optional[str] = None
+    ):
+        """Generates reproducible stream of web metrics
+
+        Urls are requested with Zipf-like popularity, response times are log-normal
+        with median of 200 ms, most of the responses are successful.
+
+        Args:
+            urls: number of distinct urls
+            null_rate: probability of every optional value (response time, status code,
+                ip address and content validation) to be missing
+            payload_size: min size in bytes of serialized message, reached by padding
+                the comment. 0 - no padding
+            seed: seed of random generator, equal seeds give equal streams
+            start: time stamp of the first metric
+            interval: seconds between time stamps of subsequent metrics
+            comment: comment of every metric, e.g. to find them in DB afterwards
+
+        """
+        if urls < 1:
+            raise ValueError(f'Number of urls shall be positive, got: {urls}')
+        if not 0 <= null_rate <= 1:
+            raise ValueError(f'Null rate shall be between 0 and 1, got: {null_rate}')
+        self._random = random.Random(seed)
+        self._urls = [f'https://www.site-{i}.example.com/page/{i % 7}' for i in range(urls)]
+        self._url_weights = list(_cumulative(1 / (i + 1) for i in range(urls)))
+        self._ips = [f'104.{i % 251}.{i // 251 % 251}.{(i * 7) % 251}' for i in range(urls)]
+        self._statuses = list(STATUS_CODES)
+        self._status_weights = list(_cumulative(STATUS_CODES.values()))
+        self._null_rate = null_rate
+        self._payload_size = payload_size
+        self._comment = comment
+        self._moment = start
+        self._interval = datetime.timedelta(seconds=interval)
+
+    def record(self) -> Dict[str, Any]:
+        """Returns the next metric as a dict, i.e. as decoded by DictDecoder"""
+        choice = self._random
+        url = choice.choices(range(len(self._urls)), cum_weights=self._url_weights)[0]
+        response_time = choice.lognormvariate(math.log(0.2), 0.8)
+        record = {
+            'request_timestamp': self._moment.isoformat(sep=' '),
+            'url': self._urls[url],
+            'service_name': 'Web metric collection service',
+            'resp_time': self._optional(str(datetime.timedelta(seconds=response_time))),
+            'resp_status_code': self._optional(
+                choice.choices(self._statuses, cum_weights=self._status_weights)[0]
+            ),
+            'ip_address': self._optional(self._ips[url]),
+            'pattern_found': self._optional(choice.random() < 0.95),
+            'comment': self._comment
+        }
+        self._moment += self._interval
+        if self._payload_size:
+            missing = self._payload_size - len(json.dumps(record))
+            if missing > 0:
+                record['comment'] = (self._comment or '') + 'x' * missing
+        return record
+
+    def records(self, count: int) -> List[Dict[str, Any]]:
+        return [self.record() for _ in range(count)]
+
+    def messages(self, count: int) -> List[bytes]:
+        """Returns the next metrics as Kafka message values"""
+        return [json.dumps(self.record()).encode('utf-8') for _ in range(count)]
+
+    def _optional(self, value: Any) -> Any:
+        return None if self._random.random() < self._null_rate else value
+
+
+def _cumulative(weights):
+    total = 0.0
+    for weight in weights:
+        total += weight
+        yield total
+
+
+if __name__ == '__main__':
+    cmd_args = argparse.ArgumentParser()
+    cmd_args.add_argument('--messages', dest='messages', help='messages to print', default=5, type=int)
+    cmd_args.add_argument('--urls', dest='urls', help='number of distinct urls', default=100, type=int)
+    cmd_args.add_argument('--null-rate', dest='null_rate', help='share of missing values', default=0.1, type=float)
+    cmd_args.add_argument('--payload-size', dest='payload_size', help='min message size, bytes', default=0, type=int)
+    cmd_args.add_argument('--seed', dest='seed', default=0, type=int)
+    args = cmd_args.parse_args()
+
+    generator = MetricGenerator(args.urls, args.null_rate, args.payload_size, args.seed)
+    for message in generator.messages(args.messages):
+        print(message.decode('utf-8'))
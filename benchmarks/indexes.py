@@ -0,0 +1,65 @@
+"""Compares insert rate of the metrics table per index profile of WebMonitoringDBWrapper
+
+For every profile a fresh table is created in the DB configured for the service, filled with
+--batches batches of --rows rows using 'copy' ingest mode and dropped afterwards. The rate is
+measured over all batches, so that growth of indexes with the table is accounted for.
+
+Usage:
+    python -m benchmarks.indexes [--rows 10000] [--batches 20] [--profiles legacy write-optimized]
+"""
+import argparse
+import time
+
+import psycopg2
+
+try:
+    from ..benchmarks.ingest import make_batch
+    from ..src.postgres_wrapper import WebMonitoringDBWrapper
+    from ..src.service import DATABASE, DB
+except ImportError:
+    from benchmarks.ingest import make_batch
+    from src.postgres_wrapper import WebMonitoringDBWrapper
+    from src.service import DATABASE, DB
+
+
+def run(db: WebMonitoringDBWrapper, batch: list, batches: int, schema: str, table: str) -> float:
+    """Returns time in seconds of inserting the batch the given number of times into a new table"""
+    db.create_table_if_not_exist(schema, table, psycopg2)
+    try:
+        start = time.perf_counter()
+        for _ in range(batches):
+            db.insert(batch, schema=schema, table=table, db_lib=psycopg2, raise_errors=True)
+        return time.perf_counter() - start
+    finally:
+        db.execute_sql(f'DROP TABLE IF EXISTS {schema}.{table} CASCADE;', psycopg2, fetch_results=False)
+        db.invalidate_provisioning(schema, table)
+
+
+if __name__ == '__main__':
+    cmd_args = argparse.ArgumentParser()
+    cmd_args.add_argument('--rows', dest='rows', help='rows per batch', default=10000, type=int)
+    cmd_args.add_argument('--batches', dest='batches', help='batches per profile', default=20, type=int)
+    cmd_args.add_argument('--schema', dest='schema', default='web_metrics', type=str)
+    cmd_args.add_argument('--table', dest='table', default='metrics_index_benchmark', type=str)
+    cmd_args.add_argument(
+        '--profiles',
+        dest='profiles',
+        nargs='+',
+        choices=tuple(WebMonitoringDBWrapper.INDEX_PROFILES),
+        default=tuple(WebMonitoringDBWrapper.INDEX_PROFILES)
+    )
+    args = cmd_args.parse_args()
+
+    data = make_batch(args.rows)
+    results = {}
+    for profile in args.profiles:
+        wrapper = DATABASE(DB, ingest_mode='copy', index_profile=profile, idempotent=False, partitioning=None)
+        try:
+            results[profile] = run(wrapper, data, args.batches, args.schema, args.table)
+        finally:
+            wrapper.close()
+
+    total = args.rows * args.batches
+    print(f'Insert of {args.batches} batches of {args.rows} rows per index profile:')
+    for profile, seconds in results.items():
+        print(f'  {profile:<16} {seconds:10.2f} s  {total / seconds:12.0f} rows/s')
@@ -0,0 +1,85 @@
+"""Compares ingest modes of WebMonitoringDBWrapper.insert
+
+By default only the client side cost (query / buffer building) is measured using mocked db lib.
+With --live the batches are sent to the DB configured for the service and removed afterwards.
+
+Usage:
+    python -m benchmarks.ingest [--rows 10000] [--repeat 5] [--live]
+"""
+import argparse
+import time
+
+from statistics import median
+
+try:
+    from ..src.postgres_wrapper import WebMonitoringDBWrapper
+    from ..utils.db_lib_mock import mock_db_lib
+except ImportError:
+    from src.postgres_wrapper import WebMonitoringDBWrapper
+    from utils.db_lib_mock import mock_db_lib
+
+
+BENCH_COMMENT = 'benchmark'
+
+
+def make_batch(rows: int) -> list:
+    """Creates list of messages in the format produced by Consumer"""
+    return [
+        {
+            'request_timestamp': f'2021-01-01 00:{(i // 60) % 60:02d}:{i % 60:02d}',
+            'url': f'https://www.example-{i % 100}.com/',
+            'ip_address': None if i % 10 == 0 else '104.18.91.87',
+            'resp_time': '0:00:00.123456',
+            'resp_status_code': 200 if i % 7 else 503,
+            'pattern_found': i % 3 == 0,
+            'service_name': 'Web metric collection service',
+            'comment': BENCH_COMMENT
+        } for i in range(rows)
+    ]
+
+
+def run(db: WebMonitoringDBWrapper, batch: list, repeat: int, schema: str, table: str, db_lib) -> float:
+    """Returns median time in seconds of a single insert of the batch"""
+    timings = []
+    for _ in range(repeat):
+        mock_db_lib.reset_mock()
+        start = time.perf_counter()
+        db.insert(batch, schema=schema, table=table, db_lib=db_lib)
+        timings.append(time.perf_counter() - start)
+    return median(timings)
+
+
+if __name__ == '__main__':
+    cmd_args = argparse.ArgumentParser()
+    cmd_args.add_argument('--rows', dest='rows', help='rows per batch', default=10000, type=int)
+    cmd_args.add_argument('--repeat', dest='repeat', help='number of runs per mode', default=5, type=int)
+    cmd_args.add_argument('--schema', dest='schema', default='web_metrics', type=str)
+    cmd_args.add_argument('--table', dest='table', default='metrics_benchmark', type=str)
+    cmd_args.add_argument(
+        '--live',
+        dest='live',
+        help='send data to DB configured for the service instead of mocked db lib',
+        action='store_true'
+    )
+    args = cmd_args.parse_args()
+
+    data = make_batch(args.rows)
+    results = {}
+    for mode in WebMonitoringDBWrapper.INGEST_MODES:
+        if args.live:
+            try:
+                from ..src.service import DATABASE, DB
+            except ImportError:
+                from src.service import DATABASE, DB
+            import psycopg2
+            wrapper, lib = DATABASE(DB, ingest_mode=mode), psycopg2
+        else:
+            wrapper, lib = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', mode), mock_db_lib
+        results[mode] = run(wrapper, data, args.repeat, args.schema, args.table, lib)
+        if args.live:
+            wrapper.delete_data(schema=args.schema, table=args.table, comment=BENCH_COMMENT)
+
+    target = 'live DB' if args.live else 'mocked db lib'
+    print(f'Insert of {args.rows} rows against {target}, median of {args.repeat} runs:')
+    for mode, seconds in results.items():
+        print(f'  {mode:<8} {seconds * 1000:10.2f} ms  {args.rows / seconds:12.0f} rows/s')
@@ -0,0 +1,65 @@
+"""Measures memory and allocations per record for dict, row tuple and MetricRecord batches
+
+For every decoder the batch is decoded from message bytes and kept alive, so that:
+- 'retained' is memory held by the batch per record (tracemalloc)
+- 'blocks' is number of memory blocks held by the batch per record (sys.getallocatedblocks)
+- 'peak' is peak memory per record while decoding the batch and building COPY buffer from it
+
+Usage:
+    python -m benchmarks.records [--messages 10000]
+"""
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+
+try:
+    from ..benchmarks.ingest import make_batch
+    from ..src.decoders import DictDecoder, RecordDecoder, RowDecoder
+    from ..src.postgres_wrapper import WebMonitoringDBWrapper
+except ImportError:
+    from benchmarks.ingest import make_batch
+    from src.decoders import DictDecoder, RecordDecoder, RowDecoder
+    from src.postgres_wrapper import WebMonitoringDBWrapper
+
+
+def measure(decoder, messages: list) -> dict:
+    """Returns memory and allocation statistics per decoded record"""
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    batch = [decoder(message) for message in messages]
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sys.getallocatedblocks() - blocks_before
+    del batch
+
+    gc.collect()
+    tracemalloc.start()
+    WebMonitoringDBWrapper.to_copy_buffer([decoder(message) for message in messages])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'retained': retained / len(messages),
+        'blocks': blocks / len(messages),
+        'peak': peak / len(messages)
+    }
+
+
+if __name__ == '__main__':
+    cmd_args = argparse.ArgumentParser()
+    cmd_args.add_argument('--messages', dest='messages', help='messages in a batch', default=10000, type=int)
+    args = cmd_args.parse_args()
+
+    messages = [json.dumps(record).encode('utf-8') for record in make_batch(args.messages)]
+    decoders = {
+        'dict': DictDecoder(),
+        'row': RowDecoder(tuple(WebMonitoringDBWrapper.DATA_TO_DB)),
+        'record': RecordDecoder()
+    }
+    print(f'Batch of {args.messages} records, per record:')
+    print(f'  {"decoder":<8} {"retained, B":>12} {"blocks":>8} {"peak, B":>10}')
+    for name, decoder in decoders.items():
+        stats = measure(decoder, messages)
+        print(f'  {name:<8} {stats["retained"]:12.1f} {stats["blocks"]:8.2f} {stats["peak"]:10.1f}')
@@ -0,0 +1,182 @@
+"""Measures end-to-end throughput of the service and latency of its stages per batch
+
+Synthetic messages (see benchmarks/generator.py) go the way of consume_publish_run:
+- 'decode' - message values to records by the decoder, as done by Consumer while polling
+- 'transform' - records to insert query, WebMonitoringDBWrapper.prepare_insert
+- 'insert' - query to DB, WebMonitoringDBWrapper.write_prepared
+- 'commit' - offsets of the batch to broker, Consumer.mark_processed and commit_processed
+Broker is always mocked. By default DB is mocked too, i.e. only the client side cost is measured.
+With --live the batches are sent to a temporary table in the DB configured for the service.
+
+Results are printed and with --output saved as JSON, with --baseline they are compared with
+results saved by a previous run.
+
+Usage:
+    python -m benchmarks.throughput [--messages 100000] [--batch-size 1000] [--decoder record]
+        [--ingest-mode copy] [--urls 100] [--null-rate 0.1] [--payload-size 0] [--live]
+        [--output results.json] [--baseline results.json]
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+from statistics import median
+from typing import Any, Dict, List
+from unittest.mock import MagicMock
+
+try:
+    from ..benchmarks.generator import MetricGenerator
+    from ..src.consumer import Consumer
+    from ..src.decoders import DECODERS, RowDecoder
+    from ..src.postgres_wrapper import WebMonitoringDBWrapper
+    from ..src.records import Batch
+    from ..utils.db_lib_mock import mock_db_lib
+except ImportError:
+    from benchmarks.generator import MetricGenerator
+    from src.consumer import Consumer
+    from src.decoders import DECODERS, RowDecoder
+    from src.postgres_wrapper import WebMonitoringDBWrapper
+    from src.records import Batch
+    from utils.db_lib_mock import mock_db_lib
+
+
+STAGES = ('decode', 'transform', 'insert', 'commit')
+PARTITION = ('website-metrics', 0)
+
+
+def run(
+        messages: List[bytes],
+        batch_size: int,
+        decoder,
+        db: WebMonitoringDBWrapper,
+        db_lib,
+        schema: str,
+        table: str
+) -> Dict[str, Any]:
+    """Passes messages through all stages batch by batch
+
+    Returns:
+        messages per second and per stage latencies of a batch in milliseconds
+    """
+    consumer = Consumer(decoder=decoder, security_protocol='PLAINTEXT')
+    consumer._consumer = MagicMock()
+    timings = {stage: [] for stage in STAGES}
+    started = time.perf_counter()
+    for offset in range(0, len(messages), batch_size):
+        moments = [time.perf_counter()]
+        batch = Batch()
+        for i, message in enumerate(messages[offset:offset + batch_size]):
+            batch.add(decoder(message), PARTITION, offset + i)
+        moments.append(time.perf_counter())
+        prepared = db.prepare_insert(batch, schema, table)
+        moments.append(time.perf_counter())
+        db.write_prepared(prepared, db_lib, raise_errors=True)
+        moments.append(time.perf_counter())
+        consumer.mark_processed(batch)
+        consumer.commit_processed()
+        moments.append(time.perf_counter())
+        for stage, start, end in zip(STAGES, moments, moments[1:]):
+            timings[stage].append((end - start) * 1000)
+    elapsed = time.perf_counter() - started
+    return {
+        'messages_per_second': len(messages) / elapsed,
+        'batches': len(timings['decode']),
+        'stages_ms': {
+            stage: {
+                'p50': median(values),
+                'p95': sorted(values)[int(0.95 * (len(values) - 1))],
+                'max': max(values),
+                'total': sum(values)
+            } for stage, values in timings.items()
+        }
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    """Prints change of results relative to baseline, positive is faster"""
+    def change(new: float, old: float) -> str:
+        return f'{(new / old - 1) * 100:+.1f}%' if old else 'n/a'
+
+    old = baseline['results']
+    print(f'Compared with baseline of {baseline["parameters"]}:')
+    print(f'  {"messages/s":<10} {change(results["messages_per_second"], old["messages_per_second"]):>8}')
+    for stage in STAGES:
+        # lower latency is better, so the ratio is inverted
+        new_p50, old_p50 = results['stages_ms'][stage]['p50'], old['stages_ms'][stage]['p50']
+        print(f'  {stage:<10} {change(old_p50, new_p50):>8}')
+
+
+if __name__ == '__main__':
+    cmd_args = argparse.ArgumentParser()
+    cmd_args.add_argument('--messages', dest='messages', help='messages to process', default=100000, type=int)
+    cmd_args.add_argument('--batch-size', dest='batch_size', help='messages per batch', default=1000, type=int)
+    cmd_args.add_argument('--decoder', dest='decoder', choices=tuple(DECODERS), default='record')
+    cmd_args.add_argument(
+        '--ingest-mode', dest='ingest_mode', choices=WebMonitoringDBWrapper.INGEST_MODES, default='copy'
+    )
+    cmd_args.add_argument('--urls', dest='urls', help='number of distinct urls', default=100, type=int)
+    cmd_args.add_argument('--null-rate', dest='null_rate', help='share of missing values', default=0.1, type=float)
+    cmd_args.add_argument('--payload-size', dest='payload_size', help='min message size, bytes', default=0, type=int)
+    cmd_args.add_argument('--seed', dest='seed', default=0, type=int)
+    cmd_args.add_argument('--schema', dest='schema', default='web_metrics', type=str)
+    cmd_args.add_argument('--table', dest='table', default='metrics_throughput_benchmark', type=str)
+    cmd_args.add_argument(
+        '--live',
+        dest='live',
+        help='send data to a temporary table in DB configured for the service instead of mocked db lib',
+        action='store_true'
+    )
+    cmd_args.add_argument('--output', dest='output', help='file to save results to as JSON')
+    cmd_args.add_argument('--baseline', dest='baseline', help='JSON file saved by previous run to compare with')
+    args = cmd_args.parse_args()
+
+    generator = MetricGenerator(args.urls, args.null_rate, args.payload_size, args.seed)
+    messages = generator.messages(args.messages)
+    decoder_class = DECODERS[args.decoder]
+    decoder_args = (tuple(WebMonitoringDBWrapper.DATA_TO_DB),) if decoder_class is RowDecoder else ()
+    decoder = decoder_class(*decoder_args)
+
+    if args.live:
+        try:
+            from ..src.service import DATABASE, DB
+        except ImportError:
+            from src.service import DATABASE, DB
+        import psycopg2
+        wrapper, lib = DATABASE(DB, ingest_mode=args.ingest_mode, idempotent=False, partitioning=None), psycopg2
+        wrapper.create_table_if_not_exist(args.schema, args.table, lib)
+    else:
+        wrapper = WebMonitoringDBWrapper(
+            'host', 'port', 'user', 'password', 'mock-db', args.ingest_mode, provisioning='startup'
+        )
+        lib = mock_db_lib
+    try:
+        results = run(messages, args.batch_size, decoder, wrapper, lib, args.schema, args.table)
+    finally:
+        if args.live:
+            wrapper.execute_sql(f'DROP TABLE IF EXISTS {args.schema}.{args.table} CASCADE;', lib, fetch_results=False)
+            wrapper.close()
+
+    target = 'live DB' if args.live else 'mocked db lib'
+    print(f'{args.messages} messages in batches of {args.batch_size}, {args.decoder} decoder, '
+          f'{args.ingest_mode} ingest mode against {target}:')
+    print(f'  {results["messages_per_second"]:.0f} messages/s')
+    print(f'  {"stage":<10} {"p50, ms":>10} {"p95, ms":>10} {"max, ms":>10} {"share":>7}')
+    total = sum(stage['total'] for stage in results['stages_ms'].values())
+    for stage, stats in results['stages_ms'].items():
+        print(f'  {stage:<10} {stats["p50"]:10.2f} {stats["p95"]:10.2f} {stats["max"]:10.2f} '
+              f'{stats["total"] / total:7.1%}')
+
+    report = {
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'environment': {'python': sys.version.split()[0], 'platform': platform.platform()},
+        'results': results
+    }
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            compare(results, json.load(baseline_file))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f'Results are saved to {args.output}')
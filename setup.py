@@ -40,10 +40,11 @@ setup(
     name="WebMetricsConsumePublish",
     version="0.1.0",
     author="Sergii Sichynskyi",
-    packages=find_packages(exclude=["contrib", "docs", "tests"]),
+    packages=find_packages(exclude=["contrib", "docs", "tests", "benchmarks"]),
     python_requires=">=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, !=3.4.*, <4",
     install_requires=["kafka-python==2.0.2", "psycopg2-binary==2.8.6", "pyyaml==5.4.1"],
     extras_require={
+        "rollups": ["numpy"],
         "dev": [
             "appdirs==1.4.4",
             "attrs==21.2.0; python_version >= '2.7' and python_version not in '3.0, 3.1, 3.2, 3.3, 3.4'",
@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection could be checked out from the pool in time."""
+
+
+class _PooledConnection:
+    __slots__ = ('connection', 'created', 'last_used')
+
+    def __init__(self, connection: Any):
+        self.connection = connection
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+
+class ConnectionPool:
+    def __init__(
+            self,
+            connect: Callable[[], Any],
+            max_size: int = 4,
+            max_lifetime: float = 1800.0,
+            checkout_timeout: float = 30.0,
+            ping_after: float = 30.0
+    ):
+        """Bounded thread-safe pool of DB-API connections
+
+        Args:
+            connect: callable without arguments which opens a new connection
+            max_size: max number of simultaneously open connections
+            max_lifetime: seconds after which connection is closed and replaced by new one
+            checkout_timeout: seconds to wait for a free connection when pool is exhausted
+            ping_after: seconds of idleness after which connection is checked
+                with a trivial query before it's given away
+
+        Usage:
+            pool = ConnectionPool(partial(psycopg2.connect, **connection_params))
+            with pool.connection() as connection:
+                ...
+
+        """
+        if max_size < 1:
+            raise ValueError(f'Pool size shall be positive, got: {max_size}')
+        self._connect = connect
+        self._max_size = max_size
+        self._max_lifetime = max_lifetime
+        self._checkout_timeout = checkout_timeout
+        self._ping_after = ping_after
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._stats = {
+            'created': 0,
+            'recycled': 0,
+            'discarded': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0
+        }
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        """Checks out connection for the duration of with statement.
+
+        Connection is returned to the pool on exit or discarded if it's broken.
+        If exception was raised inside the with statement, connection is rolled back.
+
+        Raises:
+            PoolTimeoutError: if no connection became available during checkout timeout
+
+        """
+        entry = self._checkout()
+        try:
+            yield entry.connection
+        except BaseException:
+            try:
+                entry.connection.rollback()
+            except Exception:
+                self._discard(entry)
+            else:
+                self._checkin(entry)
+            raise
+        self._checkin(entry)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns pool counters and current state"""
+        with self._condition:
+            stats = dict(self._stats)
+            stats['max_size'] = self._max_size
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+        return stats
+
+    def close(self) -> None:
+        """Closes idle connections. Connections in use are closed when returned."""
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                self._close(self._idle.pop())
+            self._condition.notify_all()
+
+    def _checkout(self) -> _PooledConnection:
+        deadline = time.monotonic() + self._checkout_timeout
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise PoolTimeoutError('Pool is closed')
+                while self._idle:
+                    entry = self._idle.pop()
+                    if self._is_usable(entry):
+                        self._stats['checkouts'] += 1
+                        return entry
+                    self._stats['recycled'] += 1
+                    self._close(entry)
+                if self._size < self._max_size:
+                    # reserve the slot, connection itself is opened outside of the lock
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    msg = f'No DB connection available within {self._checkout_timeout}s'
+                    raise PoolTimeoutError(f'{msg}, pool size: {self._max_size}')
+                self._stats['waits'] += 1
+                self._condition.wait(remaining)
+        try:
+            entry = _PooledConnection(self._connect())
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._stats['created'] += 1
+            self._stats['checkouts'] += 1
+        return entry
+
+    def _checkin(self, entry: _PooledConnection) -> None:
+        if self._is_closed(entry.connection):
+            self._discard(entry)
+            return
+        entry.last_used = time.monotonic()
+        with self._condition:
+            if self._closed:
+                self._close(entry)
+            else:
+                self._idle.append(entry)
+            self._condition.notify()
+
+    def _discard(self, entry: _PooledConnection) -> None:
+        with self._condition:
+            self._stats['discarded'] += 1
+            self._close(entry)
+            self._condition.notify()
+
+    def _close(self, entry: _PooledConnection) -> None:
+        """Closes connection and releases its slot. Shall be called under the lock."""
+        self._size -= 1
+        try:
+            entry.connection.close()
+        except Exception as e:
+            log.warning(f'Error closing DB connection: {e}')
+
+    def _is_usable(self, entry: _PooledConnection) -> bool:
+        now = time.monotonic()
+        if now - entry.created > self._max_lifetime:
+            return False
+        if self._is_closed(entry.connection):
+            return False
+        if now - entry.last_used > self._ping_after:
+            try:
+                with entry.connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                entry.connection.rollback()
+            except Exception as e:
+                log.warning(f'Idle DB connection is broken and will be replaced: {e}')
+                return False
+        return True
+
+    @staticmethod
+    def _is_closed(connection: Any) -> bool:
+        # psycopg2 uses int: 0 - open, 1 - closed, 2 - broken
+        return bool(getattr(connection, 'closed', 0))
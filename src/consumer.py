@@ -1,9 +1,22 @@
-import json
 import logging
+import threading
+import time
 
-from typing import Iterable
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
-from kafka import KafkaConsumer
+from kafka import KafkaConsumer, TopicPartition
+from kafka.structs import OffsetAndMetadata
+
+try:
+    from ..src.decoders import DictDecoder
+    from ..src.metrics import ServiceMetrics
+    from ..src.records import Batch
+    from ..src.scheduler import FlushScheduler
+except ImportError:
+    from src.decoders import DictDecoder
+    from src.metrics import ServiceMetrics
+    from src.records import Batch
+    from src.scheduler import FlushScheduler
 
 
 log = logging.getLogger(__name__)
@@ -14,20 +27,34 @@ log.addHandler(logging.NullHandler())
 # as well as Aiven Kafka tutorials
 
 
+def _offset_and_metadata(offset: int) -> OffsetAndMetadata:
+    # leader_epoch field was added in kafka-python 2.1
+    if 'leader_epoch' in OffsetAndMetadata._fields:
+        return OffsetAndMetadata(offset, '', -1)
+    return OffsetAndMetadata(offset, '')
+
+
 class Consumer:
 
     GROUP_ID = 'web_metrics_consumer'
     CLIENT_ID = 'website-monitoring-consumer-service'
+    POLL_TIMEOUT_MS = 1000
 
     def __init__(
             self,
             *topics,
+            decoder: Optional[Callable[[bytes], Any]] = None,
+            metrics: Optional[ServiceMetrics] = None,
             **connection_kwargs
     ):
         """Class for creating Kafka consumer.
 
         Args:
             *topics - topics to subscribe to. Could be changed during lifetime, str
+            decoder - turns message value bytes into the record, see src.decoders.
+                Default is DictDecoder using the fastest installed JSON library
+            metrics - if given, number and size of fetched messages, batch sizes and fetch durations
+                are recorded in it
             **connection_kwargs - keyword arguments as taken by KafkaConsumer
             below there are some useful kwargs and their default value:
                 'bootstrap_servers' - uri with port for the service
@@ -54,6 +81,8 @@ class Consumer:
 
         """
         self._topics = topics
+        self._decoder = decoder or DictDecoder()
+        self._metrics = metrics
         self._connection_data = connection_kwargs
         # auto-determine security protocol if not provided
         try:
@@ -73,6 +102,9 @@ class Consumer:
                 msg = f'{msg} Check auth kwargs'
                 raise ValueError(msg)
         self._client_id = f'{self.CLIENT_ID}:{id(self)}'
+        # offsets of processed batches waiting for commit, see mark_processed
+        self._processed: Dict[Tuple[str, int], int] = dict()
+        self._processed_lock = threading.Lock()
 
     def __enter__(self):
         """Method which creates the connection. Activated inside with statement."""
@@ -84,26 +116,240 @@ class Consumer:
             client_id=self._client_id,
             group_id=self.GROUP_ID,
             consumer_timeout_ms=1000,
-            value_deserializer=lambda x: json.loads(x.decode("utf-8"))
+            value_deserializer=self._decoder
         )
         log.info(f'Connected to kafka broker at: {self._consumer.config["bootstrap_servers"]}')
 
-    def fetch_latest(self):
+    def fetch_latest(self, commit: bool = True) -> Batch:
         """Fetches only not read messages by members of this group.
 
+        Args:
+            commit: if True, offsets are committed before returning messages, i.e. they
+                are lost if the caller fails to process them. Otherwise, the caller shall
+                report processed messages with mark_processed
+
         Returns:
             list of decoded message values
         """
-        self._consumer.poll()
-        messages = list()
-        for message in self._consumer:
-            messages.append(message.value)
+        started = time.monotonic()
+        try:
+            messages = Batch()
+            # records already fetched by the client are returned by poll, not by the iterator
+            messages_bytes = self._add_records(messages, self._consumer.poll())
+            partitions = dict()
+            for message in self._consumer:
+                partition = (message.topic, message.partition)
+                # the same object for all messages of partition
+                partition = partitions.setdefault(partition, partition)
+                messages.add(message.value, partition, message.offset)
+                messages_bytes += max(message.serialized_value_size, 0)
+        except Exception:
+            if self._metrics is not None:
+                self._metrics.errors.inc(label_value='fetch')
+            raise
+        if self._metrics is not None:
+            self._record_fetch(len(messages), messages_bytes, time.monotonic() - started)
         log.info(
             f'Fetched {len(messages)} messages from {self._consumer.config["bootstrap_servers"]}'
         )
-        self._consumer.commit()
+        if commit:
+            self._consumer.commit()
         return messages
 
+    def iter_batches(
+            self,
+            max_records: int = 1000,
+            max_bytes: int = 1048576,
+            max_linger: float = 5.0,
+            scheduler: Optional[FlushScheduler] = None,
+            commit: bool = True,
+            stop: Optional[threading.Event] = None
+    ) -> Iterator[Batch]:
+        """Fetches not read messages by members of this group in bounded batches.
+
+        Unlike fetch_latest, batch is given away as soon as it's complete, so that
+        memory consumption doesn't depend on the amount of messages waiting in broker.
+
+        Args:
+            max_records: max number of messages in a batch
+            max_bytes: batch is complete when size of serialized message values reaches this
+                number of bytes. Checked after each poll, so it could be exceeded by one poll
+            max_linger: max number of seconds to wait for batch completion after its first message
+            scheduler: flush policy to use instead of the limits above. Its flush decisions
+                are recorded in it
+            commit: if True, offsets of the batch are committed when the next one is requested,
+                i.e. after the batch is processed by the caller. Otherwise, the caller shall
+                report processed batches with mark_processed, possibly from another thread.
+                Their offsets are committed before every poll
+            stop: when set, e.g. on shutdown, broker is not polled anymore and messages
+                already fetched are given away as the last batch
+
+        Yields:
+            lists of decoded message values. Iteration stops when broker has no new messages
+            or after scheduler.max_cycle seconds, whichever comes first.
+
+        """
+        if scheduler is None:
+            scheduler = FlushScheduler(max_records, max_bytes, max_linger)
+        batch = Batch()
+        batch_bytes = 0
+        started = None
+        fetch_started = time.monotonic()
+        cycle_deadline = fetch_started + scheduler.max_cycle
+        while True:
+            self.commit_processed()
+            stopping = stop is not None and stop.is_set()
+            cycle_over = time.monotonic() >= cycle_deadline
+            if (stopping or cycle_over) and not batch:
+                return
+            timeout_ms = self._poll_timeout(scheduler, started)
+            polling = not (stopping or cycle_over)
+            records = self._poll(timeout_ms, scheduler.max_records - len(batch)) if polling else dict()
+            batch_bytes += self._add_records(batch, records)
+            if batch and started is None:
+                started = time.monotonic()
+            # nothing came during full poll timeout, i.e. all messages are read, or consumer is stopping
+            drained = stopping or (polling and not records and timeout_ms == self.POLL_TIMEOUT_MS)
+            age = time.monotonic() - started if batch else 0.0
+            reason = scheduler.flush_reason(len(batch), batch_bytes, age)
+            reason = reason or self._last_batch_reason(batch, drained, cycle_over)
+            if reason:
+                scheduler.record_flush(reason, len(batch), batch_bytes, age)
+                log.info(f'Fetched batch of {len(batch)} messages, {batch_bytes} bytes')
+                if self._metrics is not None:
+                    self._record_fetch(len(batch), batch_bytes, time.monotonic() - fetch_started)
+                yield batch
+                if commit:
+                    self._consumer.commit()
+                batch = Batch()
+                batch_bytes = 0
+                started = None
+                fetch_started = time.monotonic()
+            if drained or cycle_over:
+                return
+
+    @staticmethod
+    def _last_batch_reason(batch: Batch, drained: bool, cycle_over: bool) -> Optional[str]:
+        """Returns reason to flush incomplete batch when iteration ends, None if it continues"""
+        if not batch:
+            return None
+        if drained:
+            return 'drained'
+        return 'cycle' if cycle_over else None
+
+    def _poll_timeout(self, scheduler: FlushScheduler, started: Optional[float]) -> int:
+        """Returns milliseconds to wait for messages, so that batch started at 'started' isn't kept for too long"""
+        if started is None:
+            return self.POLL_TIMEOUT_MS
+        remaining = started + scheduler.max_staleness - time.monotonic()
+        return max(0, min(self.POLL_TIMEOUT_MS, int(remaining * 1000)))
+
+    def _poll(self, timeout_ms: int, max_records: int) -> Dict[TopicPartition, List[Any]]:
+        try:
+            return self._consumer.poll(timeout_ms=timeout_ms, max_records=max_records)
+        except Exception:
+            if self._metrics is not None:
+                self._metrics.errors.inc(label_value='fetch')
+            raise
+
+    @staticmethod
+    def _add_records(batch: Batch, records: Dict[TopicPartition, List[Any]]) -> int:
+        """Adds polled records to the batch, returns size of their serialized values"""
+        records_bytes = 0
+        for partition, partition_records in records.items():
+            for record in partition_records:
+                batch.add(record.value, partition, record.offset)
+                # size is -1 for messages with no value
+                records_bytes += max(record.serialized_value_size, 0)
+        return records_bytes
+
+    def _record_fetch(self, messages: int, messages_bytes: int, duration: float) -> None:
+        metrics = self._metrics
+        metrics.messages.inc(messages)
+        metrics.message_bytes.inc(messages_bytes)
+        metrics.batches.inc()
+        metrics.batch_size.observe(messages)
+        metrics.fetch_duration.observe(duration)
+
+    def mark_processed(self, batch: Iterable) -> None:
+        """Reports that batch is stored, so that its offsets could be committed
+
+        Thread-safe. Offsets are committed by commit_processed, which is called
+        by iter_batches before every poll.
+
+        Args:
+            batch: as returned by fetch_latest or iter_batches. Batches of the same
+                partition shall be reported in the order they were fetched
+        """
+        if not isinstance(batch, Batch):
+            return
+        offsets = batch.next_offsets()
+        with self._processed_lock:
+            for partition, offset in offsets.items():
+                if offset > self._processed.get(partition, 0):
+                    self._processed[partition] = offset
+
+    def commit_processed(self) -> None:
+        """Commits offsets of batches reported with mark_processed.
+
+        Shall be called from the thread which polls the consumer
+        """
+        with self._processed_lock:
+            processed, self._processed = self._processed, dict()
+        if not processed:
+            return
+        self._consumer.commit({
+            TopicPartition(topic, partition): _offset_and_metadata(offset)
+            for (topic, partition), offset in processed.items()
+        })
+        log.debug(f'Committed offsets: {processed}')
+
+    def rewind(self) -> None:
+        """Returns consumer to the last committed offsets, so that messages not reported
+        as processed are fetched again, e.g. after failed write to DB
+        """
+        self.commit_processed()
+        for partition in self._consumer.assignment():
+            committed = self._consumer.committed(partition)
+            if committed is None:
+                self._consumer.seek_to_beginning(partition)
+            else:
+                self._consumer.seek(partition, committed)
+        log.warning('Consumer is rewound to the last committed offsets')
+
+    def lag(self, topics: Optional[Iterable[str]] = None) -> Dict[Tuple[str, int], int]:
+        """Measures how far committed offsets of the group are behind the end of partitions
+
+        Args:
+            topics: if given, lag of all partitions of these topics is measured. Doesn't
+                require subscription, so consumer created without topics could watch the
+                group without taking partitions from its members. Otherwise, only partitions
+                assigned to this consumer are measured
+
+        Returns:
+            number of not processed messages per (topic, partition). Partitions without
+            committed offset are measured from their beginning
+        """
+        if topics is None:
+            partitions = list(self._consumer.assignment())
+        else:
+            partitions = [
+                TopicPartition(topic, partition)
+                for topic in topics
+                for partition in sorted(self._consumer.partitions_for_topic(topic) or ())
+            ]
+        if not partitions:
+            return dict()
+        end_offsets = self._consumer.end_offsets(partitions)
+        committed = {partition: self._consumer.committed(partition) for partition in partitions}
+        not_committed = [partition for partition, offset in committed.items() if offset is None]
+        if not_committed:
+            committed.update(self._consumer.beginning_offsets(not_committed))
+        return {
+            (partition.topic, partition.partition): max(end_offsets[partition] - committed[partition], 0)
+            for partition in partitions
+        }
+
     def change_topics(self, topics: Iterable) -> None:
         """Changes Kafka consumer topic statically or dynamically
 
@@ -123,6 +369,9 @@ class Consumer:
 
     def __exit__(self, exc_type, exc_value, traceback):
         """Actions to perform when exiting with statement."""
+        # offsets are committed explicitly, leaving the group right away lets other members
+        # take over partitions without waiting for session timeout
+        self._consumer.close(autocommit=False)
         log.info(
             f'Closed connection tp kafka broker at: {self._consumer.config["bootstrap_servers"]}'
         )
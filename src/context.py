@@ -0,0 +1,317 @@
+import os
+import threading
+
+from functools import cached_property, partial
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+
+
+TOPIC = 'website-metrics'
+
+
+class ServiceContext:
+    def __init__(
+            self,
+            config: Optional[Dict[str, Any]] = None,
+            storage_provider: Optional[str] = None,
+            broker_provider: Optional[str] = None,
+            environ: Optional[Mapping[str, str]] = None
+    ):
+        """Settings and client factories of the service, built on first use
+
+        Nothing is read, imported or connected when the context is created: config files are
+        parsed, client libraries are imported and clients are created when the attribute which
+        needs them is accessed for the first time. Results are cached, so every attribute is
+        built at most once per context.
+
+        Args:
+            config: parsed service config, default is read from service.yaml and
+                service_local.yaml, see utils.env_config.load_config
+            storage_provider: section of 'Metrics storage endpoint' to use,
+                default is STORAGE_SERVICE_PROVIDER environment variable
+            broker_provider: section of 'Metrics collection endpoint' to use,
+                default is BROKER_SERVICE_PROVIDER environment variable
+            environ: source of environment variables with providers and credentials,
+                default is os.environ
+
+        Usage:
+            context = ServiceContext()
+            db_wrapper = context.database(DB)
+            consumer = context.consumer_factory()
+
+        """
+        self._config = config
+        self._environ = os.environ if environ is None else environ
+        self._storage_provider = storage_provider
+        self._broker_provider = broker_provider
+
+    @cached_property
+    def config(self) -> Dict[str, Any]:
+        if self._config is not None:
+            return self._config
+        try:
+            from ..utils.env_config import load_config
+        except ImportError:
+            from utils.env_config import load_config
+        return load_config()
+
+    @cached_property
+    def storage_settings(self) -> Dict[str, Any]:
+        return self._section('Metrics storage endpoint', self._storage_provider, 'STORAGE_SERVICE_PROVIDER')
+
+    @cached_property
+    def broker_settings(self) -> Dict[str, Any]:
+        return self._section('Metrics collection endpoint', self._broker_provider, 'BROKER_SERVICE_PROVIDER')['broker']
+
+    @cached_property
+    def db_settings(self) -> Dict[str, Any]:
+        return self.storage_settings['db']
+
+    def _section(self, name: str, provider: Optional[str], variable: str) -> Dict[str, Any]:
+        provider = provider or self._environ.get(variable)
+        providers = tuple(self.config[name])
+        if provider not in providers:
+            raise ValueError(f'Unknown provider of {name}: {provider}, set {variable} to one of {providers}')
+        return self.config[name][provider]
+
+    @property
+    def sleep_between_requests(self) -> int:
+        return self.storage_settings['upload every']
+
+    @property
+    def scheduler_settings(self) -> Dict[str, Any]:
+        return {
+            'max_records': self.storage_settings.get('batch max records', 0),
+            'max_bytes': self.storage_settings.get('batch max bytes', 1048576),
+            'max_staleness': self.storage_settings.get('batch max linger', 5),
+            'min_idle_sleep': self.storage_settings.get('idle sleep min', 1),
+            'max_idle_sleep': self.sleep_between_requests,
+            'max_cycle': self.storage_settings.get('cycle max seconds', 60)
+        }
+
+    @property
+    def shutdown_timeout(self) -> float:
+        """Seconds workers are given to store fetched batches on shutdown before they are killed"""
+        return self.storage_settings.get('shutdown timeout', 30)
+
+    @property
+    def pipeline_depth(self) -> int:
+        return self.storage_settings.get('pipeline depth', 0)
+
+    @property
+    def spool_factory(self) -> Optional[Callable]:
+        settings = self.storage_settings.get('spool') or {}
+        if not settings:
+            return
+        try:
+            from ..src.spool import DiskSpool
+        except ImportError:
+            from src.spool import DiskSpool
+        return partial(DiskSpool.claim, settings['path'], max_bytes=settings.get('max size', 104857600))
+
+    @property
+    def spool_settings(self) -> Dict[str, Any]:
+        settings = self.storage_settings.get('spool') or {}
+        return {
+            'latency_budget': settings.get('latency budget'),
+            'replay_rate': settings.get('replay rate', 0)
+        }
+
+    @property
+    def rollups(self) -> bool:
+        # per url and minute aggregates are kept in rollup tables next to the metrics one
+        return self.db_settings.get('rollups', False)
+
+    @property
+    def metrics_endpoint(self) -> Optional[Tuple[str, int]]:
+        """Address of HTTP endpoint exposing service metrics in Prometheus text format, None - disabled"""
+        settings = self.storage_settings.get('metrics endpoint') or {}
+        return (settings.get('host', '127.0.0.1'), settings.get('port', 9108)) if settings else None
+
+    @property
+    def autoscaling_settings(self) -> Optional[Dict[str, Any]]:
+        settings = self.storage_settings.get('autoscaling') or {}
+        return {
+            'min_workers': settings.get('min workers', 1),
+            'max_workers': settings.get('max workers', 4),
+            'scale_up_lag': settings.get('scale up lag', 10000),
+            'scale_down_lag': settings.get('scale down lag', 1000),
+            'sustain': settings.get('sustain', 60),
+            'cooldown': settings.get('cooldown', 120),
+            'check_interval': settings.get('check interval', 10)
+        } if settings else None
+
+    @property
+    def profiler_factory(self) -> Callable:
+        try:
+            from ..src.profiling import CycleProfiler
+        except ImportError:
+            from src.profiling import CycleProfiler
+        settings = self.storage_settings.get('profiling') or {}
+        return partial(
+            CycleProfiler,
+            settings.get('path', 'profiles'),
+            cycles=settings.get('cycles', 10),
+            cpu=settings.get('cpu', 'cprofile'),
+            memory=settings.get('memory', True),
+            top=settings.get('top', 10)
+        )
+
+    @property
+    def reloader_factory(self) -> Callable:
+        """Callable without args creating ConfigReloader of the sections used by this context"""
+        try:
+            from ..src.reload import ConfigReloader
+        except ImportError:
+            from src.reload import ConfigReloader
+        return partial(
+            ConfigReloader,
+            self._storage_provider or self._environ.get('STORAGE_SERVICE_PROVIDER'),
+            self._broker_provider or self._environ.get('BROKER_SERVICE_PROVIDER')
+        )
+
+    @property
+    def partition_maintenance_interval(self) -> float:
+        """Seconds between creation of new partitions and removal of expired ones"""
+        return (self.db_settings.get('partitioning') or {}).get('maintenance interval', 3600)
+
+    @property
+    def broker_uri(self) -> str:
+        return ':'.join((self.broker_settings['host'], str(self.broker_settings['port'])))
+
+    @property
+    def broker_auth(self) -> Dict[str, Any]:
+        """Keyword arguments of Kafka clients for configured auth method"""
+        auth = self.broker_settings['auth']
+        if auth == 'sasl_plain':
+            return {
+                'security_protocol': 'SASL_PLAINTEXT',
+                'sasl_mechanism': 'PLAIN',
+                'sasl_plain_username': self._environ.get('BROKER_USERNAME'),
+                'sasl_plain_password': self._environ.get('BROKER_PASSWORD')
+            }
+        if auth == 'ssl':
+            return {
+                'security_protocol': 'SSL',
+                'ssl_cafile': self._environ.get('BROKER_CA_CERT'),
+                'ssl_certfile': self._environ.get('BROKER_SERVICE_CERT'),
+                'ssl_keyfile': self._environ.get('BROKER_SERVICE_KEY')
+            }
+        if auth == 'no_auth':
+            return {'security_protocol': 'PLAINTEXT'}
+        raise ValueError(f'Unknown broker auth: {auth}, expected one of sasl_plain, ssl, no_auth')
+
+    def _broker_class(self) -> type:
+        try:
+            from ..src.consumer import Consumer
+        except ImportError:
+            from src.consumer import Consumer
+        brokers = {'kafka': Consumer}
+        return brokers[self.broker_settings['type']]
+
+    @cached_property
+    def consumer_factory(self) -> Callable:
+        """Callable without args creating consumer of the service topic"""
+        try:
+            from ..src.decoders import DECODERS, RowDecoder
+            from ..src.postgres_wrapper import WebMonitoringDBWrapper
+        except ImportError:
+            from src.decoders import DECODERS, RowDecoder
+            from src.postgres_wrapper import WebMonitoringDBWrapper
+        decoder_class = DECODERS[self.broker_settings.get('decoder', 'dict')]
+        decoder_args = (tuple(WebMonitoringDBWrapper.DATA_TO_DB),) if decoder_class is RowDecoder else ()
+        return partial(
+            self._broker_class(),
+            TOPIC,
+            decoder=decoder_class(*decoder_args, library=self.broker_settings.get('json library', 'auto')),
+            bootstrap_servers=self.broker_uri,
+            **self.broker_auth
+        )
+
+    @cached_property
+    def consumer(self):
+        """Consumer of the service topic, shared by all users of the context"""
+        return self.consumer_factory()
+
+    @property
+    def lag_probe_factory(self) -> Callable:
+        # consumer without topics doesn't join the group, so it measures lag without taking partitions from workers
+        return partial(self._broker_class(), bootstrap_servers=self.broker_uri, **self.broker_auth)
+
+    @cached_property
+    def dead_letters(self):
+        """Sink of rejected records, None if disabled. Created once, so that all DB wrappers share it"""
+        settings = self.storage_settings.get('dead letters') or {}
+        if not settings:
+            return
+        try:
+            from ..src.dead_letter import JsonlDeadLetterSink, KafkaDeadLetterSink
+        except ImportError:
+            from src.dead_letter import JsonlDeadLetterSink, KafkaDeadLetterSink
+        sinks = {
+            'file': lambda: JsonlDeadLetterSink(settings['path']),
+            'kafka': lambda: KafkaDeadLetterSink(settings['topic'], bootstrap_servers=self.broker_uri, **self.broker_auth)
+        }
+        return sinks[settings['type']]()
+
+    @property
+    def db_options(self) -> Dict[str, Any]:
+        """Keyword arguments of DB wrapper except for connection ones"""
+        try:
+            from ..src.partitions import PartitioningPolicy
+        except ImportError:
+            from src.partitions import PartitioningPolicy
+        db_settings = self.db_settings
+        partitioning = db_settings.get('partitioning') or {}
+        return {
+            'ingest_mode': db_settings.get('ingest mode', 'values'),
+            'page_size': db_settings.get('page size', 1000),
+            'provisioning': db_settings.get('provisioning', 'insert'),
+            'pool_size': db_settings.get('pool size', 4),
+            'pool_max_lifetime': db_settings.get('pool max lifetime', 1800),
+            'pool_timeout': db_settings.get('pool timeout', 30),
+            'idempotent': db_settings.get('idempotent writes', False),
+            'index_profile': db_settings.get('index profile', 'legacy'),
+            'partitioning': PartitioningPolicy(
+                interval=partitioning['interval'],
+                ahead=partitioning.get('ahead', 3),
+                retention_days=partitioning.get('retention days'),
+                expire=partitioning.get('expire', 'drop')
+            ) if partitioning else None,
+            'dead_letters': self.dead_letters
+        }
+
+    @cached_property
+    def database(self) -> Callable:
+        """DB wrapper class with connection and config settings bound, takes database name"""
+        try:
+            from ..src.postgres_wrapper import WebMonitoringDBWrapper
+        except ImportError:
+            from src.postgres_wrapper import WebMonitoringDBWrapper
+        databases = {'postgres': WebMonitoringDBWrapper}
+        auth = self.db_settings['auth']
+        credentials = {
+            'scram': (self._environ.get('DB_LOGIN'), self._environ.get('DB_PASS')),
+            'no_auth': ()
+        }
+        if auth not in credentials:
+            raise ValueError(f'Unknown database auth: {auth}, expected one of {tuple(credentials)}')
+        return partial(
+            databases[self.db_settings['type']],
+            self.db_settings['host'],
+            self.db_settings['port'],
+            *credentials[auth],
+            **self.db_options
+        )
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def service_context() -> ServiceContext:
+    """Returns context of the service configured by environment variables, created on first call"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = ServiceContext()
+        return _default
@@ -0,0 +1,130 @@
+import datetime
+import fcntl
+import json
+import logging
+import threading
+
+from pathlib import Path
+from typing import Any, Dict, Union
+
+from kafka import KafkaProducer
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class DeadLetterSink:
+    """Destination of records which can't be stored in DB. Base class, stores nothing."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def send(self, record: Any, reason: str) -> None:
+        """Stores rejected record together with the reason of rejection
+
+        Args:
+            record: message value as received from broker
+            reason: human readable explanation of rejection
+
+        """
+        log.warning(f'Record rejected: {reason}. Record: {record}')
+        entry = {
+            'time': datetime.datetime.utcnow().isoformat(),
+            'reason': reason,
+            'record': record
+        }
+        with self._lock:
+            self._write(entry)
+            self.count += 1
+
+    def close(self) -> None:
+        pass
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        pass
+
+    def __getstate__(self):
+        # sinks are created in service process and passed to workers, open resources stay behind
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class JsonlDeadLetterSink(DeadLetterSink):
+    def __init__(self, path: Union[str, Path]):
+        """Appends rejected records to local file, one JSON object per line
+
+        The file could be shared by worker processes: every line is written under exclusive file lock.
+
+        Args:
+            path: file to append to. Created together with parent folders on first record
+
+        """
+        super().__init__()
+        self._path = Path(path)
+        self._file = None
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        if self._file is None:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self._path, 'a', encoding='utf-8')
+        line = json.dumps(entry, default=str) + '\n'
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            self._file.write(line)
+            self._file.flush()
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_file'] = None
+        return state
+
+
+class KafkaDeadLetterSink(DeadLetterSink):
+    def __init__(self, topic: str, **connection_kwargs):
+        """Sends rejected records to Kafka topic
+
+        Args:
+            topic: topic to send records to
+            **connection_kwargs: keyword arguments as taken by KafkaProducer,
+                see Consumer for the useful ones
+
+        """
+        super().__init__()
+        self._topic = topic
+        self._connection_data = connection_kwargs
+        self._producer = None
+
+    def close(self) -> None:
+        with self._lock:
+            if self._producer is not None:
+                self._producer.flush()
+                self._producer.close()
+                self._producer = None
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        if self._producer is None:
+            self._producer = KafkaProducer(
+                **self._connection_data,
+                value_serializer=lambda x: json.dumps(x, default=str).encode('utf-8')
+            )
+        self._producer.send(self._topic, entry)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_producer'] = None
+        return state
@@ -0,0 +1,160 @@
+import importlib
+import json
+import logging
+import operator
+import sys
+
+from typing import Any, Callable, Dict, NamedTuple, Optional, Sequence, Tuple, Union
+
+try:
+    from ..src.records import MetricRecord
+except ImportError:
+    from src.records import MetricRecord
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# JSON libraries in the order of preference, the first installed one is used by default
+JSON_LIBRARIES = ('orjson', 'ujson', 'json')
+
+
+class InvalidMessage(NamedTuple):
+    """Message value which couldn't be decoded.
+
+    Decoders run inside KafkaConsumer.poll, so they return this instead of raising:
+    one malformed message shall not break the whole poll.
+    """
+    raw: str
+    reason: str
+
+
+def json_loads(library: str = 'auto') -> Callable[[bytes], Any]:
+    """Returns loads function of JSON library accepting utf-8 encoded bytes
+
+    Args:
+        library: one of JSON_LIBRARIES or 'auto' for the fastest installed one
+
+    Raises:
+        ImportError: if requested library is not installed
+
+    """
+    candidates = JSON_LIBRARIES if library == 'auto' else (library,)
+    for name in candidates:
+        if name not in JSON_LIBRARIES:
+            raise ValueError(f'Unknown JSON library: {name}, expected one of {JSON_LIBRARIES}')
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            if library != 'auto':
+                raise
+            continue
+        log.debug(f'Using {name} to decode messages')
+        return module.loads
+    # stdlib json is always there
+    return json.loads
+
+
+class DictDecoder:
+    def __init__(self, library: str = 'auto'):
+        """Decodes message value to a dict (or whatever JSON value it contains)
+
+        Args:
+            library: JSON library to use, see json_loads
+
+        """
+        self.library = library
+        self._loads = json_loads(library)
+
+    def __call__(self, value: bytes) -> Union[Dict[str, Any], InvalidMessage]:
+        try:
+            return self._loads(value)
+        except ValueError as e:
+            return InvalidMessage(_safe_text(value), f'Not a valid JSON: {e}')
+
+    def __reduce__(self):
+        # loads function of C libraries can't be pickled, so decoder is re-created instead
+        return self.__class__, (self.library,)
+
+
+class RowDecoder:
+    def __init__(self, keys: Sequence[str], library: str = 'auto'):
+        """Decodes JSON object straight to a tuple of its values in fixed order
+
+        Args:
+            keys: keys of JSON object in the order of the resulting tuple,
+                e.g. the order of table columns. Missing keys give None
+            library: JSON library to use, see json_loads
+
+        """
+        if not keys:
+            raise ValueError('Row decoder requires at least one key')
+        self.keys = tuple(keys)
+        self.library = library
+        self._key_set = frozenset(self.keys)
+        self._loads = json_loads(library)
+        # itemgetter of a single key doesn't return a tuple
+        self._get_all = operator.itemgetter(*self.keys) if len(self.keys) > 1 else lambda d: (d[self.keys[0]],)
+
+    def __call__(self, value: bytes) -> Union[Tuple[Any, ...], InvalidMessage]:
+        try:
+            decoded = self._loads(value)
+        except ValueError as e:
+            return InvalidMessage(_safe_text(value), f'Not a valid JSON: {e}')
+        if not isinstance(decoded, dict):
+            return InvalidMessage(_safe_text(value), f'Not a JSON object: {type(decoded).__name__}')
+        if len(decoded) == len(self.keys):
+            # the usual case of complete record, missing key then means there's an unknown one
+            try:
+                return self._get_all(decoded)
+            except KeyError:
+                pass
+        if not decoded.keys() <= self._key_set:
+            return InvalidMessage(_safe_text(value), f'Unknown keys: {sorted(decoded.keys() - self._key_set)}')
+        get = decoded.get
+        return tuple([get(key) for key in self.keys])
+
+    def __reduce__(self):
+        return self.__class__, (self.keys, self.library)
+
+
+class RecordDecoder(RowDecoder):
+    # values repeated across messages, batch keeps a single copy of each
+    INTERNED_FIELDS = ('url', 'service_name')
+
+    def __init__(self, library: str = 'auto'):
+        """Decodes JSON object straight to MetricRecord
+
+        Args:
+            library: JSON library to use, see json_loads
+
+        """
+        super().__init__(MetricRecord._fields, library)
+        self._interned = tuple(MetricRecord._fields.index(field) for field in self.INTERNED_FIELDS)
+
+    def __call__(self, value: bytes) -> Union[MetricRecord, InvalidMessage]:
+        row = super().__call__(value)
+        if isinstance(row, InvalidMessage):
+            return row
+        row = list(row)
+        for i in self._interned:
+            if type(row[i]) is str:
+                row[i] = sys.intern(row[i])
+        # bypasses argument parsing of MetricRecord constructor
+        return tuple.__new__(MetricRecord, row)
+
+    def __reduce__(self):
+        return self.__class__, (self.library,)
+
+
+DECODERS = {
+    'dict': DictDecoder,
+    'row': RowDecoder,
+    'record': RecordDecoder
+}
+
+
+def _safe_text(value: Optional[bytes]) -> str:
+    if value is None:
+        return ''
+    return value.decode('utf-8', errors='replace') if isinstance(value, (bytes, bytearray)) else str(value)
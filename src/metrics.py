@@ -0,0 +1,217 @@
+import logging
+import multiprocessing
+import threading
+
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# upper bounds of duration histograms in seconds
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# upper bounds of batch size histogram in records
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+ERROR_STAGES = ('fetch', 'transform', 'insert', 'sql', 'cycle')
+
+
+class Counter:
+    TYPE = 'counter'
+
+    def __init__(self, name: str, documentation: str, label: Optional[str] = None, label_values: Sequence[str] = ()):
+        """Monotonic counter shared between processes, optionally split by values of a single label
+
+        Shall be created before worker processes are started and passed to them.
+
+        Args:
+            name: metric name
+            documentation: HELP text
+            label: label name, e.g. 'stage'
+            label_values: all values of the label, the counter is not split when empty
+
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.label_values = tuple(label_values)
+        self._values = multiprocessing.Array('d', max(len(self.label_values), 1))
+
+    def inc(self, amount: float = 1.0, label_value: Optional[str] = None) -> None:
+        index = self.label_values.index(label_value) if label_value is not None else 0
+        with self._values.get_lock():
+            self._values[index] += amount
+
+    def value(self, label_value: Optional[str] = None) -> float:
+        return self._values[self.label_values.index(label_value) if label_value is not None else 0]
+
+    def exposition(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.TYPE}']
+        with self._values.get_lock():
+            values = list(self._values)
+        if not self.label_values:
+            lines.append(f'{self.name} {_format(values[0])}')
+        for label_value, value in zip(self.label_values, values):
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {_format(value)}')
+        return lines
+
+
+class Gauge(Counter):
+    """Value shared between processes which could go up and down, see Counter"""
+    TYPE = 'gauge'
+
+    def set(self, value: float, label_value: Optional[str] = None) -> None:
+        index = self.label_values.index(label_value) if label_value is not None else 0
+        with self._values.get_lock():
+            self._values[index] = value
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = DURATION_BUCKETS):
+        """Histogram of observed values shared between processes
+
+        Args:
+            name: metric name
+            documentation: HELP text
+            buckets: upper bounds of buckets in ascending order, +Inf is added
+
+        """
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # count of every bucket, +Inf bucket, sum of values
+        self._values = multiprocessing.Array('d', len(self.buckets) + 2)
+
+    def observe(self, value: float) -> None:
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._values.get_lock():
+            self._values[index] += 1
+            self._values[-1] += value
+
+    def count(self) -> int:
+        return int(sum(self._values[:-1]))
+
+    def exposition(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._values.get_lock():
+            values = list(self._values)
+        cumulative = 0.0
+        for bound, count in zip(self.buckets + (float('inf'),), values):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{_format(bound)}"}} {_format(cumulative)}')
+        lines.append(f'{self.name}_sum {_format(values[-1])}')
+        lines.append(f'{self.name}_count {_format(cumulative)}')
+        return lines
+
+
+class ServiceMetrics:
+    PREFIX = 'web_metrics'
+
+    def __init__(self):
+        """Counters and latency histograms of all stages of the service
+
+        Shared between worker processes, i.e. shall be created before they are started,
+        and exposed by MetricsServer in Prometheus text format.
+        """
+        prefix = self.PREFIX
+        self.messages = Counter(f'{prefix}_messages_total', 'Messages fetched from broker')
+        self.message_bytes = Counter(f'{prefix}_message_bytes_total', 'Size of fetched message values')
+        self.batches = Counter(f'{prefix}_batches_total', 'Batches fetched from broker')
+        self.inserted_rows = Counter(f'{prefix}_inserted_rows_total', 'Rows written to DB')
+        self.errors = Counter(f'{prefix}_errors_total', 'Failures per stage', 'stage', ERROR_STAGES)
+        self.cycles = Counter(f'{prefix}_cycles_total', 'Completed service cycles')
+        self.consumer_lag = Gauge(f'{prefix}_consumer_lag_messages', 'Messages in topic not processed by the group')
+        self.workers = Gauge(f'{prefix}_workers', 'Running consumer-publisher workers')
+        self.batch_size = Histogram(f'{prefix}_batch_size_records', 'Records per fetched batch', BATCH_SIZE_BUCKETS)
+        self.fetch_duration = Histogram(f'{prefix}_fetch_duration_seconds', 'Fetching of a batch from broker')
+        self.transform_duration = Histogram(
+            f'{prefix}_transform_duration_seconds', 'Building of insert query from a batch'
+        )
+        self.insert_duration = Histogram(f'{prefix}_insert_duration_seconds', 'Writing of a batch to DB')
+        self.sql_duration = Histogram(f'{prefix}_sql_duration_seconds', 'Execution of SQL query')
+        self.cycle_duration = Histogram(f'{prefix}_cycle_duration_seconds', 'Service cycle excluding sleep')
+
+    def all(self) -> Iterable:
+        return (value for value in vars(self).values() if isinstance(value, (Counter, Histogram)))
+
+    def exposition(self) -> str:
+        """Returns all metrics in Prometheus text format"""
+        lines = [line for metric in self.all() for line in metric.exposition()]
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    def __init__(self, metrics: ServiceMetrics, host: str = '127.0.0.1', port: int = 9108):
+        """Serves metrics over HTTP at /metrics from a background thread
+
+        Args:
+            metrics: metrics to expose
+            host: interface to listen to
+            port: port to listen to, 0 - any free one, see address
+
+        Usage:
+            server = MetricsServer(metrics, port=9108)
+            server.start()
+            ...
+            server.stop()
+
+        """
+        # imported here, so that workers which only update metrics don't load HTTP stack
+        from http.server import ThreadingHTTPServer
+
+        self.metrics = metrics
+        self._server = ThreadingHTTPServer((host, port), _handler(metrics))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._server.server_address[:2]
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._server.serve_forever, name='MetricsServer', daemon=True)
+        self._thread.start()
+        log.info(f'Serving metrics at http://{self.address[0]}:{self.address[1]}/metrics')
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def _handler(metrics: ServiceMetrics) -> type:
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    return MetricsHandler
+
+
+def _format(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def parse_exposition(lines: Iterable[str]) -> Dict[str, float]:
+    """Parses exposition lines to {sample: value}, e.g. for tests and ad-hoc inspection"""
+    samples = dict()
+    for line in lines:
+        if line and not line.startswith('#'):
+            sample, value = line.rsplit(' ', 1)
+            samples[sample] = float(value)
+    return samples
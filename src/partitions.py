@@ -0,0 +1,98 @@
+import datetime
+import re
+
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+
+INTERVALS = ('day', 'week', 'month')
+EXPIRE_ACTIONS = ('drop', 'detach')
+
+
+class PartitioningPolicy(NamedTuple):
+    """How metrics table is split into time_stamp ranges and for how long they are kept"""
+    # length of a partition, one of INTERVALS
+    interval: str = 'day'
+    # number of partitions created in advance after the current one
+    ahead: int = 3
+    # partitions which ended more than this number of days ago are expired, None - keep forever
+    retention_days: Optional[float] = None
+    # what to do with expired partition, one of EXPIRE_ACTIONS. Detached ones stay as separate tables
+    expire: str = 'drop'
+
+    def validate(self) -> 'PartitioningPolicy':
+        if self.interval not in INTERVALS:
+            raise ValueError(f'Unknown partition interval: {self.interval}, expected one of {INTERVALS}')
+        if self.expire not in EXPIRE_ACTIONS:
+            raise ValueError(f'Unknown expire action: {self.expire}, expected one of {EXPIRE_ACTIONS}')
+        if self.ahead < 0:
+            raise ValueError(f'Number of partitions ahead shall not be negative, got: {self.ahead}')
+        return self
+
+
+def range_start(interval: str, moment: datetime.datetime) -> datetime.datetime:
+    """Returns the beginning of partition range the moment belongs to"""
+    day = datetime.datetime(moment.year, moment.month, moment.day)
+    if interval == 'day':
+        return day
+    if interval == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def next_start(interval: str, start: datetime.datetime) -> datetime.datetime:
+    """Returns the beginning of the range following the one starting at start"""
+    if interval == 'day':
+        return start + datetime.timedelta(days=1)
+    if interval == 'week':
+        return start + datetime.timedelta(weeks=1)
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+def partition_name(table: str, start: datetime.datetime) -> str:
+    return f'{table}_p{start:%Y%m%d}'
+
+
+def partition_start(table: str, name: str) -> Optional[datetime.datetime]:
+    """Returns the beginning of the range of partition named by partition_name, None for other tables"""
+    match = re.fullmatch(rf'{re.escape(table)}_p(\d{{8}})', name)
+    if match is None:
+        return None
+    return datetime.datetime.strptime(match.group(1), '%Y%m%d')
+
+
+def planned_ranges(
+        policy: PartitioningPolicy,
+        now: datetime.datetime
+) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+    """Returns (start, end) of the current partition and policy.ahead partitions after it"""
+    start = range_start(policy.interval, now)
+    ranges = list()
+    for _ in range(policy.ahead + 1):
+        end = next_start(policy.interval, start)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def expired_starts(
+        policy: PartitioningPolicy,
+        starts: Iterable[datetime.datetime],
+        now: datetime.datetime
+) -> List[datetime.datetime]:
+    """Returns beginnings of partitions which ended before the retention period"""
+    if policy.retention_days is None:
+        return list()
+    threshold = now - datetime.timedelta(days=policy.retention_days)
+    return sorted(start for start in starts if next_start(policy.interval, start) <= threshold)
+
+
+def expired_before(policy: PartitioningPolicy, now: datetime.datetime) -> Optional[datetime.datetime]:
+    """Returns the beginning of the oldest range which is not expired, None if ranges are kept forever
+
+    Rows before it are expired, the same as partitions returned by expired_starts
+    """
+    if policy.retention_days is None:
+        return None
+    return range_start(policy.interval, now - datetime.timedelta(days=policy.retention_days))
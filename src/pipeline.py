@@ -0,0 +1,161 @@
+import logging
+import queue
+import threading
+import time
+
+from typing import Any, Callable, Dict, Iterable, List
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# marks the end of the stream in stage queues
+_END = object()
+
+
+class PipelineStopped(Exception):
+    """Raised inside stage thread when pipeline is stopped because of error in other stage."""
+
+
+class Pipeline:
+    def __init__(
+            self,
+            source: Iterable,
+            *stages: Callable[[Any], Any],
+            queue_size: int = 2,
+            name: str = 'Pipeline'
+    ):
+        """Runs source iteration and every stage in its own thread connected by bounded queues
+
+        Item yielded by source is passed to the first stage, its result to the second
+        one and so on. Stage returning None drops the item. When a queue is full, upstream
+        stage waits, so that the slowest stage defines the pace of the source
+        (e.g. consumer doesn't poll broker while DB is busy with previous batches).
+
+        Args:
+            source: iterable of items, e.g. consumer.iter_batches(). Is iterated in a
+                separate thread, so it shall not be used by other threads meanwhile
+            *stages: functions taking the result of the previous one
+            queue_size: max number of items waiting for every stage
+            name: prefix of thread names
+
+        Usage:
+            Pipeline(consumer.iter_batches(), prepare, write).run()
+
+        """
+        if not stages:
+            raise ValueError('Pipeline requires at least one stage')
+        self._source = source
+        self._stages = stages
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._name = name
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = list()
+        self._lock = threading.Lock()
+        self._busy = [0.0] * (len(stages) + 1)
+        self._items = [0] * (len(stages) + 1)
+
+    def run(self) -> Dict[str, Any]:
+        """Runs the pipeline until source is exhausted and all items passed all stages
+
+        Returns:
+            statistics: number of items and busy seconds of source and every stage,
+            together with total wall time
+
+        Raises:
+            the first exception raised by source or any of the stages. The remaining
+            stages are stopped in this case
+
+        """
+        started = time.perf_counter()
+        threads = [threading.Thread(target=self._feed, name=f'{self._name}-source', daemon=True)]
+        for i in range(len(self._stages)):
+            threads.append(
+                threading.Thread(target=self._work, args=(i,), name=f'{self._name}-stage-{i}', daemon=True)
+            )
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+        return {
+            'items': list(self._items),
+            'busy': list(self._busy),
+            'wall': time.perf_counter() - started
+        }
+
+    def _feed(self) -> None:
+        output = self._queues[0]
+        try:
+            iterator = iter(self._source)
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                self._account(0, time.perf_counter() - start)
+                self._put(output, item)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put_end(output)
+
+    def _work(self, index: int) -> None:
+        stage = self._stages[index]
+        source = self._queues[index]
+        output = self._queues[index + 1] if index + 1 < len(self._queues) else None
+        ended = False
+        try:
+            while True:
+                item = source.get()
+                if item is _END:
+                    ended = True
+                    break
+                if self._stop.is_set():
+                    # drain the queue so that upstream is not blocked
+                    continue
+                start = time.perf_counter()
+                result = stage(item)
+                self._account(index + 1, time.perf_counter() - start)
+                if output is not None and result is not None:
+                    self._put(output, result)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            # let upstream finish
+            while not ended:
+                ended = source.get() is _END
+            if output is not None:
+                self._put_end(output)
+
+    def _put(self, output: queue.Queue, item: Any) -> None:
+        while True:
+            if self._stop.is_set():
+                raise PipelineStopped()
+            try:
+                output.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    @staticmethod
+    def _put_end(output: queue.Queue) -> None:
+        # downstream always consumes until the end mark, so blocking put is safe here
+        output.put(_END)
+
+    def _account(self, index: int, busy: float) -> None:
+        with self._lock:
+            self._items[index] += 1
+            self._busy[index] += busy
+
+    def _fail(self, error: BaseException) -> None:
+        log.error(f'{self._name} stopped because of error: {error}')
+        with self._lock:
+            self._errors.append(error)
+        self._stop.set()
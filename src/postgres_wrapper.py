@@ -1,16 +1,107 @@
 import datetime
+import io
+import itertools
 import logging
+import threading
+import time
+import uuid
+import weakref
 import psycopg2
 
-from typing import Union, Dict, List, Tuple, Optional, Any
+from contextlib import contextmanager
+from functools import partial
+from psycopg2 import errorcodes
+from typing import (
+    Union, Dict, List, Tuple, Optional, Any, Callable, NamedTuple, Set, Iterable, Iterator, Sequence
+)
+
+try:
+    from ..src.connection_pool import ConnectionPool
+    from ..src.dead_letter import DeadLetterSink
+    from ..src.decoders import InvalidMessage
+    from ..src.metrics import ServiceMetrics
+    from ..src.partitions import (
+        PartitioningPolicy, expired_before, expired_starts, partition_name, partition_start, planned_ranges
+    )
+    from ..src.records import Batch, MetricRow
+    from ..src.rollups import RESPONSE_TIME_BOUNDS, Rollup
+except ImportError:
+    from src.connection_pool import ConnectionPool
+    from src.dead_letter import DeadLetterSink
+    from src.decoders import InvalidMessage
+    from src.metrics import ServiceMetrics
+    from src.partitions import (
+        PartitioningPolicy, expired_before, expired_starts, partition_name, partition_start, planned_ranges
+    )
+    from src.records import Batch, MetricRow
+    from src.rollups import RESPONSE_TIME_BOUNDS, Rollup
 
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+# escape sequences of PostgreSQL COPY text format (backslash shall go first), see:
+# https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.2
+_COPY_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'))
+_COPY_NULL = '\\N'
+
+# (db uri, database, schema, table) already created by this process
+_provisioned_tables: Set[Tuple[str, str, str, str]] = set()
+# errors which mean that provisioned table has gone
+_MISSING_TABLE_ERRORS = (errorcodes.UNDEFINED_TABLE, errorcodes.INVALID_SCHEMA_NAME)
+# classes of errors caused by the data itself: data exception and integrity constraint violation
+_DATA_ERROR_CLASSES = ('22', '23')
+# names of insert statements prepared in every open connection, see 'prepared' ingest mode
+_prepared_statements: 'weakref.WeakKeyDictionary[Any, Set[str]]' = weakref.WeakKeyDictionary()
+_prepared_statements_lock = threading.Lock()
+
+
+class PreparedInsert(NamedTuple):
+    """Insert query built by WebMonitoringDBWrapper.prepare_insert"""
+    schema: str
+    table: str
+    query: str
+    rows: int
+    # data for COPY ... FROM STDIN query, None for other queries
+    buffer: Optional[io.StringIO] = None
+    # records the query was built from
+    data: Optional[List[Union[Dict[str, Any], Tuple[Any, ...]]]] = None
+    # what the query returns, see WebMonitoringDBWrapper.insert
+    returning: Union[str, Tuple[str, ...]] = 'count'
+    # parameters of every execution of EXECUTE query, None for other queries
+    pages: Optional[List[Tuple[List[Any], ...]]] = None
+
+
+def _is_data_error(error: BaseException) -> bool:
+    """True if DB rejected query because of the data, i.e. retry with the same data won't help"""
+    return str(getattr(error, 'pgcode', None) or '')[:2] in _DATA_ERROR_CLASSES
+
+
+def _to_copy_value(value: Any) -> str:
+    """Formats a single value as a field of COPY text format"""
+    if value is None:
+        return _COPY_NULL
+    value = str(value)
+    # the check is much cheaper than unconditional replacement for typical data
+    if '\\' in value or '\t' in value or '\n' in value or '\r' in value:
+        for char, escaped in _COPY_ESCAPES:
+            value = value.replace(char, escaped)
+    return value
+
 
 class SQLDatabaseWrapper:
-    def __init__(self, host: str, port: Union[int, str], user: str, password: str, database: str):
+    def __init__(
+            self,
+            host: str,
+            port: Union[int, str],
+            user: str,
+            password: str,
+            database: str,
+            pool_size: int = 4,
+            pool_max_lifetime: float = 1800.0,
+            pool_timeout: float = 30.0,
+            metrics: Optional[ServiceMetrics] = None
+    ):
         """Wrapper / Facade class for psycopg2 lib
 
         Args:
@@ -19,6 +110,14 @@ class SQLDatabaseWrapper:
             user: username for authentication
             password: password for authentication
             database: DB schema to use
+            pool_size: max number of DB connections kept open by this wrapper
+            pool_max_lifetime: seconds after which connection is closed and reopened
+            pool_timeout: seconds to wait for a free connection when all are in use
+            metrics: if given, durations and failures of queries are recorded in it
+
+        Note:
+            connections are opened lazily and kept in the pool between queries.
+            Pools are not shared between processes, call close() to release connections.
 
         """
         self._connection_params = {
@@ -30,14 +129,69 @@ class SQLDatabaseWrapper:
         }
         self._db = database
         self._uri = f'{host}:{port}'
+        self._pool_params = {
+            'max_size': pool_size,
+            'max_lifetime': pool_max_lifetime,
+            'checkout_timeout': pool_timeout
+        }
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self._metrics = metrics
+
+    def __getstate__(self):
+        # open connections and locks can't be transferred to other process
+        state = self.__dict__.copy()
+        state['_pools'] = {}
+        del state['_pools_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pools_lock = threading.Lock()
+
+    def _pool(self, db_lib: psycopg2 = psycopg2) -> ConnectionPool:
+        """Returns connection pool for given db lib, creates it on first use"""
+        with self._pools_lock:
+            try:
+                return self._pools[db_lib]
+            except KeyError:
+                log.info(f'Creating connection pool to DB: {self._uri}')
+                pool = ConnectionPool(partial(db_lib.connect, **self._connection_params), **self._pool_params)
+                self._pools[db_lib] = pool
+                return pool
+
+    def pool_stats(self) -> Dict[str, int]:
+        """Returns statistics of connection pool(s), summed up if several db libs were used"""
+        with self._pools_lock:
+            pools = list(self._pools.values())
+        total = dict()
+        for pool in pools:
+            for k, v in pool.stats().items():
+                total[k] = total.get(k, 0) + v
+        return total
+
+    @property
+    def dead_letters(self) -> Optional[DeadLetterSink]:
+        """Sink of rejected records, None if records aren't validated. Not closed by close, it could be shared"""
+        return self._dead_letters
+
+    def close(self) -> None:
+        """Closes all connections kept by this wrapper"""
+        with self._pools_lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.close()
 
     def execute_sql(
             self,
             sql: str,
             db_lib: psycopg2 = psycopg2,
             args: Union[Dict, List, Tuple] = None,
-            fetch_results: bool = True
-    ) -> Optional[List[Tuple[Any]]]:
+            fetch_results: bool = True,
+            raise_errors: bool = False,
+            return_rowcount: bool = False
+    ) -> Optional[Union[int, List[Tuple[Any]]]]:
         """Executes given sql with arguments
 
         Args:
@@ -51,6 +205,10 @@ class SQLDatabaseWrapper:
                 For certain queries like table creation shall be set to False
                 because attempt to fetch result throws an exception. Although handled
                 in this implementation it produces unnecessary WARNING in log
+            raise_errors: if True, error of query execution is logged and re-raised.
+                Transaction is rolled back in this case
+            return_rowcount: if True, number of rows affected by the query is returned
+                instead of its result, nothing is fetched
 
         Returns:
             List of Dicts where:
@@ -62,27 +220,171 @@ class SQLDatabaseWrapper:
         # using unencrypted channel. Brief check showed that connection to some random
         # http resource is rejected beforehand. Assume it's safe. If I have more time,
         # I would investigate this better
-        connection = db_lib.connect(**self._connection_params)
         result = None
-        # It was a tradeoff to keep a connection open during service lifetime or make it like this
-        # One here more scalable (if used with bulk transactions updating many rows at once)
+        # Connections are kept open in the pool, so the handshake is paid only once per connection
         # The side effect is that for testability reasons it require passing lib as param
-        with connection:
-            log.info(f'Establishing connection to DB: {self._uri}')
+        # Entering the connection itself opens transaction which is committed or rolled back on exit
+        with self._pool(db_lib).connection() as connection, connection:
+            log.info(f'Using connection to DB: {self._uri}')
             with connection.cursor() as cursor:
                 log.info(f'Sending SQL query: {sql}')
+                started = time.monotonic()
                 try:
                     cursor.execute(sql, args)
                 except BaseException as e:
                     # Exception is too broad but this is how it's raised by lib :-(
                     log.error(f'Error executing SQL query: {e}')
-                if fetch_results:
+                    self._record_sql(started, failed=True)
+                    if raise_errors:
+                        raise
+                    return
+                self._record_sql(started)
+                if return_rowcount:
+                    result = cursor.rowcount
+                elif fetch_results:
                     try:
                         result = cursor.fetchall()
                     except db_lib.ProgrammingError as e:
                         log.warning(f'Not possible to fetch query result: {e}')
         return result
 
+    def stream_sql(
+            self,
+            sql: str,
+            db_lib: psycopg2 = psycopg2,
+            args: Union[Dict, List, Tuple] = None,
+            raise_errors: bool = False,
+            chunk_rows: int = 1000,
+            cursor_name: Optional[str] = None,
+            chunks: bool = False
+    ) -> Optional[Iterator[Union[Tuple[Any], List[Tuple[Any]]]]]:
+        """Executes given sql and returns iterator over rows of its result
+
+        Rows are fetched chunk by chunk while the caller iterates, so that they are
+        never all converted at once. The query is executed before the method returns,
+        but the connection is held and the transaction stays open until the iterator
+        is exhausted or closed, the transaction is committed in both cases.
+
+        Args:
+            sql: an SQL query returning rows
+            db_lib: library object to use, see execute_sql. Cursor shall have fetchmany method
+            args: tuple, list or dict to be inserted in sql
+            raise_errors: see execute_sql
+            chunk_rows: number of rows fetched at once
+            cursor_name: when given, the query runs in server-side cursor of this name
+                and every chunk is transferred only when requested, i.e. memory used by the
+                client doesn't depend on the size of the result. Works only for SELECT
+                queries. Otherwise, the entire result is received by the client at once
+            chunks: if True, lists of up to chunk_rows rows are yielded instead of rows
+
+        Returns:
+            iterator over result rows or chunks, None if query failed
+        """
+        fetched = self._stream(sql, db_lib, args, chunk_rows, cursor_name)
+        try:
+            # runs until the query is executed
+            next(fetched)
+        except BaseException:
+            if raise_errors:
+                raise
+            return
+        return fetched if chunks else itertools.chain.from_iterable(fetched)
+
+    def _stream(
+            self,
+            sql: str,
+            db_lib,
+            args,
+            chunk_rows: int,
+            cursor_name: Optional[str] = None
+    ) -> Iterator[Optional[List[Tuple[Any]]]]:
+        with self._pool(db_lib).connection() as connection, connection:
+            log.info(f'Using connection to DB: {self._uri}')
+            cursor_args = (cursor_name,) if cursor_name is not None else ()
+            with connection.cursor(*cursor_args) as cursor:
+                log.info(f'Sending SQL query: {sql}')
+                try:
+                    cursor.execute(sql, args)
+                except BaseException as e:
+                    log.error(f'Error executing SQL query: {e}')
+                    raise
+                try:
+                    yield
+                    while True:
+                        rows = cursor.fetchmany(chunk_rows)
+                        if not rows:
+                            return
+                        yield rows
+                except GeneratorExit:
+                    # caller stopped reading, changes made by the query are kept
+                    return
+
+    @contextmanager
+    def transaction(self, db_lib: psycopg2 = psycopg2):
+        """Runs several queries in a single transaction
+
+        Transaction is committed on exit from with statement or rolled back on exception.
+
+        Args:
+            db_lib: library object to use, see execute_sql
+
+        Usage:
+            with db.transaction() as cursor:
+                cursor.execute(...)
+                cursor.execute(...)
+        """
+        with self._pool(db_lib).connection() as connection, connection:
+            log.info(f'Using connection to DB: {self._uri}')
+            with connection.cursor() as cursor:
+                yield cursor
+
+    def copy_from_buffer(
+            self,
+            sql: str,
+            buffer: io.TextIOBase,
+            db_lib: psycopg2 = psycopg2,
+            raise_errors: bool = False
+    ) -> Optional[int]:
+        """Streams the content of file-like object to DB using COPY ... FROM STDIN
+
+        Args:
+            sql: COPY query reading from STDIN
+            buffer: file-like object with data in format expected by sql
+            db_lib: library object to use. Shall have at least compatible
+                by signature methods: connect, cursor, cursor.copy_expert
+                and cursor.rowcount attribute.
+                Default is postgres psycopg2.
+            raise_errors: if True, error of query execution is logged and re-raised
+
+        Returns:
+            number of copied rows or None if query failed
+        """
+        result = None
+        with self._pool(db_lib).connection() as connection, connection:
+            log.info(f'Using connection to DB: {self._uri}')
+            with connection.cursor() as cursor:
+                log.info(f'Sending COPY query: {sql}')
+                started = time.monotonic()
+                try:
+                    cursor.copy_expert(sql, buffer)
+                    result = cursor.rowcount
+                except BaseException as e:
+                    log.error(f'Error executing COPY query: {e}')
+                    self._record_sql(started, failed=True)
+                    if raise_errors:
+                        raise
+                    return result
+                self._record_sql(started)
+        return result
+
+    def _record_sql(self, started: float, failed: bool = False) -> None:
+        """Records duration of query started at given time.monotonic() moment in metrics, if any"""
+        if self._metrics is None:
+            return
+        self._metrics.sql_duration.observe(time.monotonic() - started)
+        if failed:
+            self._metrics.errors.inc(label_value='sql')
+
 
 class WebMonitoringDBWrapper(SQLDatabaseWrapper):
     DATA_TO_DB = {
@@ -95,8 +397,53 @@ class WebMonitoringDBWrapper(SQLDatabaseWrapper):
         'pattern_found': 'content_validation',
         'comment': 'comment'
     }
+    # keys which values go to NOT NULL columns
+    REQUIRED_KEYS = ('request_timestamp', 'url', 'service_name')
+    INGEST_MODES = ('values', 'copy', 'prepared')
+    # SQL types of table columns in the order of DATA_TO_DB
+    COLUMN_TYPES = ('timestamp', 'varchar', 'varchar', 'interval', 'int', 'varchar', 'boolean', 'varchar')
+    # what insert and delete_data return, tuple of columns may be given instead
+    RETURNING_MODES = ('none', 'count', 'rows')
+    PROVISIONING_MODES = ('insert', 'startup')
+    # index name suffix and definition for every index of the profile
+    INDEX_PROFILES = {
+        # single column index for every searchable column
+        'legacy': (
+            ('url', '(url)'),
+            ('status_code', '(status_code)'),
+            ('agent', '(agent)'),
+            ('response_time', '(response_time)'),
+            ('ip', '(ip)'),
+            ('comment', '(comment)')
+        ),
+        # the cheapest one to maintain, only helps queries by time range
+        'write-optimized': (
+            ('time_stamp_brin', 'USING brin (time_stamp)'),
+        ),
+        # history of a url and failed requests
+        'query-optimized': (
+            ('url_time_stamp', '(url, time_stamp)'),
+            ('failures', '(status_code, time_stamp) WHERE status_code IS DISTINCT FROM 200'),
+            ('time_stamp_brin', 'USING brin (time_stamp)')
+        )
+    }
 
-    def __init__(self, host: str, port: Union[int, str], user: str, password: str, database: str):
+    def __init__(
+            self,
+            host: str,
+            port: Union[int, str],
+            user: str,
+            password: str,
+            database: str,
+            ingest_mode: str = 'values',
+            provisioning: str = 'insert',
+            dead_letters: Optional[DeadLetterSink] = None,
+            idempotent: bool = False,
+            partitioning: Optional[PartitioningPolicy] = None,
+            index_profile: str = 'legacy',
+            page_size: int = 1000,
+            **pool_kwargs
+    ):
         """Wrapper / Facade class for psycopg2 lib
 
         Extends:
@@ -108,18 +455,85 @@ class WebMonitoringDBWrapper(SQLDatabaseWrapper):
             user: username for authentication
             password: password for authentication
             database: DB schema to use
+            ingest_mode: how insert sends data to DB, one of INGEST_MODES:
+                'values' - single INSERT ... VALUES query, returns inserted rows
+                'copy' - COPY ... FROM STDIN streamed from in-memory buffer,
+                    returns number of inserted rows. Much cheaper for big batches
+                'prepared' - insert statement prepared once per connection and executed
+                    with values of page_size records as array parameters, so that DB
+                    parses and plans it only once. Pages of a batch go in one transaction
+            provisioning: when schema and table are created, one of PROVISIONING_MODES:
+                'insert' - on first insert into the table done by this process
+                'startup' - only by explicit create_table_if_not_exist call, e.g. on
+                    service start. Insert then never sends DDL to DB
+                In both modes table is re-created if insert reports that it's missing
+            dead_letters: when provided, every record is validated before insert and
+                rejected ones are sent to this sink. If DB still rejects the batch because
+                of its data, the batch is split in halves until bad records are isolated.
+                Otherwise, the entire batch is rejected on the first malformed record
+            idempotent: if True, Kafka offsets of inserted batches (see src.records.Batch)
+                are stored in table_offsets table in the same transaction as the data,
+                and records which are already stored are skipped. Makes repeated insert
+                of the same messages, e.g. after a crash before Kafka commit, harmless
+            partitioning: when provided, table is created as partitioned by ranges of
+                time_stamp, see manage_partitions. Existing table is not converted
+            index_profile: set of indexes of the table, one of INDEX_PROFILES. Every index
+                slows down inserts, so keep only those used by queries. Indexes of other
+                profiles are dropped when the table is provisioned
+            page_size: max number of records inserted by one execution in 'prepared' ingest mode
+            **pool_kwargs: connection pool settings and metrics as taken by SQLDatabaseWrapper.
+                With metrics, durations of prepare_insert and write_prepared, failures
+                and numbers of inserted rows are recorded as well
         """
-        super().__init__(host, port, user, password, database)
+        super().__init__(host, port, user, password, database, **pool_kwargs)
         self._user = user
+        if ingest_mode not in self.INGEST_MODES:
+            raise ValueError(f'Unknown ingest mode: {ingest_mode}, expected one of {self.INGEST_MODES}')
+        self._ingest_mode = ingest_mode
+        if provisioning not in self.PROVISIONING_MODES:
+            msg = f'Unknown provisioning mode: {provisioning}'
+            raise ValueError(f'{msg}, expected one of {self.PROVISIONING_MODES}')
+        self._provisioning = provisioning
+        self._dead_letters = dead_letters
+        self._idempotent = idempotent
+        self.partitioning = partitioning.validate() if partitioning is not None else None
+        if index_profile not in self.INDEX_PROFILES:
+            raise ValueError(f'Unknown index profile: {index_profile}, expected one of {tuple(self.INDEX_PROFILES)}')
+        self._index_profile = index_profile
+        if page_size < 1:
+            raise ValueError(f'Page size shall be positive, got: {page_size}')
+        self._page_size = page_size
+
+    def tune(self, ingest_mode: Optional[str] = None, page_size: Optional[int] = None) -> None:
+        """Changes settings which could be changed while the wrapper is in use, e.g. when config is reloaded
+
+        Args:
+            ingest_mode: see constructor, unchanged if None
+            page_size: see constructor, unchanged if None
+
+        Raises:
+            ValueError: if a setting is invalid, then nothing is changed
+
+        """
+        if ingest_mode is not None and ingest_mode not in self.INGEST_MODES:
+            raise ValueError(f'Unknown ingest mode: {ingest_mode}, expected one of {self.INGEST_MODES}')
+        if page_size is not None and page_size < 1:
+            raise ValueError(f'Page size shall be positive, got: {page_size}')
+        if ingest_mode is not None:
+            self._ingest_mode = ingest_mode
+        if page_size is not None:
+            self._page_size = page_size
 
     def create_table_if_not_exist(
             self,
             schema: str,
             table: str,
             db_lib=psycopg2
-    ):
+    ) -> None:
         """Creates table and schema if not exist
 
+        DDL is sent only once per process for every table, subsequent calls are no-op.
+
         Args:
             schema: database schema to create (if not exists)
             table: table in schema to create (if not exists)
@@ -129,9 +543,12 @@ class WebMonitoringDBWrapper(SQLDatabaseWrapper):
                 Default is postgres psycopg2.
 
         Returns:
-            inserted rows as list of tuples (exact data types specified in signature)
+            None
 
         """
+        key = (self._uri, self._db, schema, table)
+        if key in _provisioned_tables:
+            return
         create_table_query = f'''
             CREATE SCHEMA IF NOT EXISTS {schema}
                 AUTHORIZATION {self._user};
@@ -144,84 +561,1007 @@ class WebMonitoringDBWrapper(SQLDatabaseWrapper):
                 ip VARCHAR,
                 content_validation BOOLEAN,
                 comment VARCHAR
+            ){' PARTITION BY RANGE (time_stamp)' if self.partitioning else ''};
+        '''
+        create_table_query += self.index_ddl(schema, table, self._index_profile)
+        if self.partitioning:
+            # rows out of the ranges of created partitions
+            create_table_query += f'''
+            CREATE TABLE IF NOT EXISTS {schema}.{table}_default
+                PARTITION OF {schema}.{table} DEFAULT;
+            '''
+        if self._idempotent:
+            create_table_query += f'''
+            CREATE TABLE IF NOT EXISTS {schema}.{table}_offsets(
+                topic VARCHAR NOT NULL,
+                partition INT NOT NULL,
+                next_offset BIGINT NOT NULL,
+                PRIMARY KEY (topic, partition)
+            );
+            '''
+        try:
+            self.execute_sql(create_table_query, db_lib=db_lib, fetch_results=False, raise_errors=True)
+        except Exception:
+            # already logged, next call will try again
+            return
+        _provisioned_tables.add(key)
+        if self.partitioning:
+            self.manage_partitions(schema, table, db_lib)
+
+    def manage_partitions(
+            self,
+            schema: str,
+            table: str,
+            db_lib=psycopg2,
+            now: Optional[datetime.datetime] = None
+    ) -> Dict[str, List[str]]:
+        """Creates partitions ahead of time and removes expired ones according to partitioning policy
+
+        Partition of schema.table starting at YYYY-MM-DD is named table_pYYYYMMDD.
+        Expired partitions are dropped or detached as a whole, which is much cheaper
+        than deleting their rows. Shall be called periodically, e.g. hourly.
+
+        Rows out of the ranges of existing partitions are kept in table_default. When a partition
+        is created for the range of some of them, e.g. after maintenance lapsed, they are moved
+        to the new partition. Expired rows of table_default are deleted regardless of policy.expire.
+
+        Args:
+            schema: database schema
+            table: partitioned table
+            db_lib: library object to use, see insert
+            now: moment to plan partitions for, current time by default
+
+        Returns:
+            names of created and expired partitions
+
+        """
+        result = {'created': list(), 'expired': list()}
+        if self.partitioning is None:
+            return result
+        now = now or datetime.datetime.now()
+        partitions = self._partitions(schema, table, db_lib)
+        if partitions is None:
+            return result
+        existing, has_default = partitions
+
+        for start, end in planned_ranges(self.partitioning, now):
+            if start not in existing and self._create_partition(schema, table, start, end, has_default, db_lib):
+                result['created'].append(partition_name(table, start))
+
+        for start in expired_starts(self.partitioning, existing, now):
+            name = existing[start]
+            if self.partitioning.expire == 'detach':
+                query = f'ALTER TABLE {schema}.{table} DETACH PARTITION {schema}.{name}'
+            else:
+                query = f'DROP TABLE IF EXISTS {schema}.{name}'
+            if self._execute_ddl(query, db_lib):
+                result['expired'].append(name)
+        threshold = expired_before(self.partitioning, now)
+        if has_default and threshold is not None:
+            self._execute_ddl(f'DELETE FROM {schema}.{table}_default WHERE time_stamp < %s', db_lib, (threshold,))
+        if result['created'] or result['expired']:
+            log.info(f'Partitions of {schema}.{table} created: {result["created"]}, expired: {result["expired"]}')
+        return result
+
+    def _partitions(
+            self,
+            schema: str,
+            table: str,
+            db_lib=psycopg2
+    ) -> Optional[Tuple[Dict[datetime.datetime, str], bool]]:
+        """Returns names of range partitions by their start and whether default partition exists,
+        None if table isn't partitioned or query failed
+        """
+        try:
+            rows = self.execute_sql(
+                '''
+                SELECT parent.relkind, child.relname
+                FROM pg_class parent
+                    LEFT JOIN pg_inherits ON pg_inherits.inhparent = parent.oid
+                    LEFT JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                WHERE parent.oid = %s::regclass
+                ''',
+                db_lib=db_lib,
+                args=(f'{schema}.{table}',),
+                raise_errors=True
+            )
+        except Exception:
+            # already logged
+            return
+        if not rows or rows[0][0] != 'p':
+            log.error(f'Table {schema}.{table} is not partitioned. Partitions are not managed')
+            return
+        existing = {partition_start(table, name): name for _, name in rows if name}
+        existing.pop(None, None)
+        return existing, any(name == f'{table}_default' for _, name in rows)
+
+    def _create_partition(
+            self,
+            schema: str,
+            table: str,
+            start: datetime.datetime,
+            end: datetime.datetime,
+            has_default: bool,
+            db_lib=psycopg2
+    ) -> bool:
+        """Creates partition for [start, end), returns False if it failed. Error is logged
+
+        Postgres refuses to create a partition for rows already in default partition, so that they are
+        moved in the same transaction: default partition is detached, the new one is created, rows are
+        moved to it and default partition is attached back
+        """
+        full_name = f'{schema}.{partition_name(table, start)}'
+        create_query = f'''
+            CREATE TABLE IF NOT EXISTS {full_name}
+                PARTITION OF {schema}.{table} FOR VALUES FROM (%(start)s) TO (%(end)s);
+        '''
+        args = {'start': start, 'end': end}
+        if not has_default or not self._default_has_rows(schema, table, start, end, db_lib):
+            return self._execute_ddl(create_query, db_lib, args)
+        log.warning(f'Rows of {full_name} range found in {schema}.{table}_default, they are moved to the new partition')
+        default = f'{schema}.{table}_default'
+        query = f'''
+            ALTER TABLE {schema}.{table} DETACH PARTITION {default};
+            {create_query}
+            WITH moved AS (
+                DELETE FROM {default} WHERE time_stamp >= %(start)s AND time_stamp < %(end)s RETURNING *
+            )
+            INSERT INTO {full_name} SELECT * FROM moved;
+            ALTER TABLE {schema}.{table} ATTACH PARTITION {default} DEFAULT;
+        '''
+        return self._execute_ddl(query, db_lib, args)
+
+    def _default_has_rows(
+            self,
+            schema: str,
+            table: str,
+            start: datetime.datetime,
+            end: datetime.datetime,
+            db_lib=psycopg2
+    ) -> bool:
+        try:
+            rows = self.execute_sql(
+                f'SELECT EXISTS (SELECT 1 FROM {schema}.{table}_default WHERE time_stamp >= %s AND time_stamp < %s)',
+                db_lib=db_lib,
+                args=(start, end),
+                raise_errors=True
+            )
+        except Exception:
+            # already logged, creation of partition will fail and will be tried again by the next maintenance
+            return False
+        return bool(rows and rows[0][0])
+
+    def _execute_ddl(self, query: str, db_lib=psycopg2, args: Optional[Union[Dict, Tuple]] = None) -> bool:
+        """Executes DDL query, returns False if it failed. Error is logged"""
+        try:
+            self.execute_sql(query, db_lib=db_lib, args=args, fetch_results=False, raise_errors=True)
+        except Exception:
+            return False
+        return True
+
+    def create_rollup_tables(self, schema: str, table: str, db_lib=psycopg2) -> bool:
+        """Creates tables of per url and minute aggregates next to schema.table, see merge_rollup
+
+        Creates:
+            table_rollup_minute - requests, response time histogram and content validations
+            table_rollup_status - requests per status code
+            table_rollup_stats - view with mean and p50, p95, p99 of response time and
+                validation failure rate, computed from the histogram of the minute
+            table_rollup_quantile(histogram, q) - function computing percentiles from histogram
+
+        Args:
+            schema: database schema
+            table: table name of raw metrics
+            db_lib: library object to use, see insert
+
+        Returns:
+            True if tables are created or exist already
+        """
+        bounds = ','.join(str(bound) for bound in RESPONSE_TIME_BOUNDS)
+        query = f'''
+            CREATE SCHEMA IF NOT EXISTS {schema}
+                AUTHORIZATION {self._user};
+            CREATE TABLE IF NOT EXISTS {schema}.{table}_rollup_minute(
+                url VARCHAR NOT NULL,
+                time_stamp timestamp NOT NULL,
+                requests BIGINT NOT NULL,
+                timed_requests BIGINT NOT NULL,
+                response_time_sum DOUBLE PRECISION NOT NULL,
+                response_time_histogram BIGINT[] NOT NULL,
+                validations BIGINT NOT NULL,
+                validation_failures BIGINT NOT NULL,
+                PRIMARY KEY (url, time_stamp)
             );
-            CREATE INDEX IF NOT EXISTS
-                {table}_url ON {schema}.{table}(url);
-            CREATE INDEX IF NOT EXISTS
-                {table}_status_code ON {schema}.{table}(status_code);
-            CREATE INDEX IF NOT EXISTS
-                {table}_agent ON {schema}.{table}(agent);
-            CREATE INDEX IF NOT EXISTS
-                {table}_response_time ON {schema}.{table}(response_time);
-            CREATE INDEX IF NOT EXISTS
-                {table}_ip ON {schema}.{table}(ip);
-            CREATE INDEX IF NOT EXISTS
-                {table}_comment ON {schema}.{table}(comment);
+            CREATE TABLE IF NOT EXISTS {schema}.{table}_rollup_status(
+                url VARCHAR NOT NULL,
+                time_stamp timestamp NOT NULL,
+                status_code INT NOT NULL,
+                requests BIGINT NOT NULL,
+                PRIMARY KEY (url, time_stamp, status_code)
+            );
+            CREATE OR REPLACE FUNCTION {schema}.{table}_rollup_quantile(
+                histogram BIGINT[], q DOUBLE PRECISION
+            ) RETURNS DOUBLE PRECISION LANGUAGE sql IMMUTABLE AS $$
+                SELECT upper_bound FROM (
+                    SELECT
+                        h.upper_bound,
+                        sum(h.requests) OVER (ORDER BY h.i) AS cumulative,
+                        sum(h.requests) OVER () AS total
+                    FROM unnest(histogram, '{{{bounds},Infinity}}'::DOUBLE PRECISION[])
+                        WITH ORDINALITY AS h(requests, upper_bound, i)
+                ) AS c
+                WHERE total > 0 AND cumulative >= q * total
+                ORDER BY cumulative
+                LIMIT 1
+            $$;
+            CREATE OR REPLACE VIEW {schema}.{table}_rollup_stats AS
+                SELECT
+                    url,
+                    time_stamp,
+                    requests,
+                    response_time_sum / NULLIF(timed_requests, 0) AS response_time_mean,
+                    {schema}.{table}_rollup_quantile(response_time_histogram, 0.5) AS response_time_p50,
+                    {schema}.{table}_rollup_quantile(response_time_histogram, 0.95) AS response_time_p95,
+                    {schema}.{table}_rollup_quantile(response_time_histogram, 0.99) AS response_time_p99,
+                    validation_failures::DOUBLE PRECISION / NULLIF(validations, 0) AS validation_failure_rate
+                FROM {schema}.{table}_rollup_minute;
         '''
-        self.execute_sql(create_table_query, db_lib=db_lib, fetch_results=False)
+        return self._execute_ddl(query, db_lib)
+
+    def merge_rollup(
+            self,
+            rollup: Rollup,
+            schema: str,
+            table: str,
+            db_lib=psycopg2,
+            raise_errors: bool = False
+    ) -> bool:
+        """Adds aggregates of a batch to rollup tables created by create_rollup_tables
+
+        Both tables are updated in one transaction. Aggregates of the same url and minute
+        are summed, histograms element-wise.
+
+        Args:
+            rollup: aggregates computed by src.rollups.aggregate
+            schema: database schema
+            table: table name of raw metrics
+            db_lib: library object to use, see insert
+            raise_errors: if True, errors are re-raised
+
+        Returns:
+            True if aggregates are merged
+        """
+        try:
+            with self.transaction(db_lib) as cursor:
+                cursor.executemany(
+                    f'''
+                    INSERT INTO {schema}.{table}_rollup_minute AS r
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (url, time_stamp) DO UPDATE SET
+                        requests = r.requests + EXCLUDED.requests,
+                        timed_requests = r.timed_requests + EXCLUDED.timed_requests,
+                        response_time_sum = r.response_time_sum + EXCLUDED.response_time_sum,
+                        response_time_histogram = ARRAY(
+                            SELECT a + b
+                            FROM unnest(r.response_time_histogram, EXCLUDED.response_time_histogram)
+                                WITH ORDINALITY AS h(a, b, i)
+                            ORDER BY i
+                        ),
+                        validations = r.validations + EXCLUDED.validations,
+                        validation_failures = r.validation_failures + EXCLUDED.validation_failures
+                    ''',
+                    rollup.minutes
+                )
+                cursor.executemany(
+                    f'''
+                    INSERT INTO {schema}.{table}_rollup_status AS r
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (url, time_stamp, status_code) DO UPDATE SET
+                        requests = r.requests + EXCLUDED.requests
+                    ''',
+                    rollup.statuses
+                )
+        except BaseException as e:
+            log.error(f'Error merging rollups into {schema}.{table}_rollup_*: {e}')
+            if raise_errors:
+                raise
+            return False
+        log.info(f'Merged {len(rollup.minutes)} url minutes into {schema}.{table}_rollup_minute')
+        return True
+
+    @classmethod
+    def index_ddl(cls, schema: str, table: str, profile: str) -> str:
+        """Returns queries creating indexes of the profile and dropping indexes of other profiles"""
+        indexes = dict(cls.INDEX_PROFILES[profile])
+        other = {suffix for definitions in cls.INDEX_PROFILES.values() for suffix, _ in definitions} - indexes.keys()
+        queries = [
+            f'CREATE INDEX IF NOT EXISTS {table}_{suffix} ON {schema}.{table} {definition};'
+            for suffix, definition in indexes.items()
+        ]
+        queries.extend(f'DROP INDEX IF EXISTS {schema}.{table}_{suffix};' for suffix in sorted(other))
+        return '\n'.join(queries)
+
+    def invalidate_provisioning(self, schema: str, table: str) -> None:
+        """Forgets that table was provisioned, so that next insert re-creates it"""
+        _provisioned_tables.discard((self._uri, self._db, schema, table))
+
+    def _provisioned_call(
+            self,
+            schema: str,
+            table: str,
+            db_lib,
+            query: Callable[..., Any],
+            raise_errors: bool = False
+    ) -> Any:
+        """Calls query which writes to schema.table taking care of table existence
+
+        Args:
+            schema: database schema
+            table: table name in DB
+            db_lib: library object to use, see insert
+            query: execute_sql or alike with bound arguments, shall accept raise_errors kwarg
+            raise_errors: if True, query error is re-raised instead of returning None
+
+        Returns:
+            result of query or None if it failed
+        """
+        if self._provisioning == 'insert':
+            self.create_table_if_not_exist(schema, table, db_lib)
+        try:
+            return query(raise_errors=True)
+        except Exception as e:
+            if getattr(e, 'pgcode', None) not in _MISSING_TABLE_ERRORS:
+                if raise_errors:
+                    raise
+                return
+        log.warning(f'Table {schema}.{table} is missing. Provisioning it again')
+        self.invalidate_provisioning(schema, table)
+        self.create_table_if_not_exist(schema, table, db_lib)
+        return query(raise_errors=raise_errors)
 
     def insert(
             self,
             data: List[Dict[str, str]],
             schema: str,
             table: str,
-            db_lib=psycopg2
-    ) -> Optional[List[Tuple[
-        datetime.datetime, str, str, datetime.timedelta, int, str, Optional[bool], str
-    ]]]:
+            db_lib=psycopg2,
+            raise_errors: bool = False,
+            returning: Union[str, Sequence[str]] = 'count'
+    ) -> Optional[Union[int, Iterable[Tuple[Any, ...]]]]:
         """Inserts data to table defined as schema.table
 
         Args:
-            data: list of json-serializable dicts
+            data: list of json-serializable dicts or row tuples, see to_rows
             schema: database schema
             table: table name in DB to insert data to
             db_lib: library object to use. Shall have at least compatible
                 by signature methods: connect, cursor, cursor.execute,
                 cursor.fetchall and ProgrammingError exception.
                 Default is postgres psycopg2.
+            raise_errors: if True, errors not caused by the data (e.g. lost connection)
+                are re-raised, so that the caller could retry. Batch rejected because
+                of its data is logged and dropped in any case
+            returning: what to get back from DB, one of RETURNING_MODES or columns:
+                'none' - nothing, None is returned
+                'count' - number of inserted rows
+                'rows' - iterator over inserted rows as tuples of
+                    (datetime, str, str, timedelta, int, str, Optional[bool], str),
+                    see SQLDatabaseWrapper.stream_sql. Rows of a batch written together
+                    with offsets or split by dead letters isolation come as a list
+                tuple of table columns, e.g. ('time_stamp', 'url') - list of tuples
+                    of the given columns of inserted rows
+                Only 'none' and 'count' are supported by 'copy' and 'prepared' ingest modes
 
         Returns:
-            inserted rows as list of tuples (exact data types specified in signature)
+            result as requested by returning, None if insert failed
+
+        Raises:
+            ValueError: if returning is not supported
 
         """
         if not data:
             log.warning('Insertion query called but no data supplied! Operation aborted.')
             return
+        prepared = self.prepare_insert(data, schema, table, returning)
+        if prepared is None:
+            return
+        return self.write_prepared(prepared, db_lib, raise_errors)
+
+    def prepare_insert(
+            self,
+            data: List[Dict[str, str]],
+            schema: str,
+            table: str,
+            returning: Union[str, Sequence[str]] = 'count'
+    ) -> Optional[PreparedInsert]:
+        """Builds insert query for the data without sending it to DB.
+
+        Together with write_prepared makes the same as insert, but allows to split
+        CPU-bound query building and I/O-bound DB write, e.g. between threads
+
+        Args:
+            data: list of json-serializable dicts or row tuples, see to_rows
+            schema: database schema
+            table: table name in DB to insert data to
+            returning: see insert
 
+        Returns:
+            query to pass to write_prepared or None if data has incorrect format
+            or no valid records left after validation
+
+        """
+        returning = self._check_returning(returning)
+        if self._ingest_mode != 'values' and returning not in ('none', 'count'):
+            msg = f"Only 'none' and 'count' results are supported by '{self._ingest_mode}' ingest mode"
+            raise ValueError(f'{msg}, got: {returning}')
+        if self._dead_letters is not None:
+            data = self._reject_invalid(data)
+            if not data:
+                return
+        if self._metrics is None:
+            return self._prepare(data, schema, table, returning)
+        started = time.monotonic()
+        prepared = self._prepare(data, schema, table, returning)
+        self._metrics.transform_duration.observe(time.monotonic() - started)
+        if prepared is None:
+            self._metrics.errors.inc(label_value='transform')
+        return prepared
+
+    @classmethod
+    def _check_returning(cls, returning: Union[str, Sequence[str]]) -> Union[str, Tuple[str, ...]]:
+        """Returns returning as one of RETURNING_MODES or tuple of known columns"""
+        if isinstance(returning, str):
+            if returning not in cls.RETURNING_MODES:
+                raise ValueError(f'Unknown returning mode: {returning}, expected one of {cls.RETURNING_MODES} or columns')
+            return returning
+        columns = tuple(returning)
+        unknown = set(columns) - set(cls.DATA_TO_DB.values())
+        if not columns or unknown:
+            raise ValueError(f'Returned columns shall be some of {tuple(cls.DATA_TO_DB.values())}, got: {columns}')
+        return columns
+
+    @staticmethod
+    def _returning_clause(returning: Union[str, Tuple[str, ...]]) -> str:
+        if returning == 'rows':
+            return 'RETURNING *'
+        if isinstance(returning, tuple):
+            return f'RETURNING {", ".join(returning)}'
+        return ''
+
+    def _prepare(
+            self,
+            data: List[Dict[str, Any]],
+            schema: str,
+            table: str,
+            returning: Union[str, Tuple[str, ...]] = 'count'
+    ) -> Optional[PreparedInsert]:
         full_table_name = f'{schema}.{table}'
+        if self._ingest_mode == 'copy':
+            try:
+                buffer = self.to_copy_buffer(data)
+            except (KeyError, ValueError) as e:
+                log.error(f'Incorrect data format. Error details: {e.args}')
+                return
+            columns_str = ', '.join(self.DATA_TO_DB.values())
+            copy_query = f'COPY {full_table_name}({columns_str}) FROM STDIN'
+            return PreparedInsert(schema, table, copy_query, len(data), buffer, data, returning)
+        if self._ingest_mode == 'prepared':
+            try:
+                columns = [list(column) for column in zip(*self.to_rows(data))]
+            except (KeyError, ValueError) as e:
+                log.error(f'Incorrect data format. Error details: {e.args}')
+                return
+            pages = [
+                tuple(column[start:start + self._page_size] for column in columns)
+                for start in range(0, len(data), self._page_size)
+            ]
+            # arrays are cast explicitly, otherwise arrays of strings are sent as text[]
+            placeholders = ', '.join(f'%s::{column_type}[]' for column_type in self.COLUMN_TYPES)
+            execute_query = f'EXECUTE {self._statement_name(schema, table)}({placeholders})'
+            return PreparedInsert(
+                schema, table, execute_query, len(data), data=data, returning=returning, pages=pages
+            )
 
         try:
-            data = [{self.DATA_TO_DB[k]: 'NULL' if v is None else v for k, v in entry.items()} for entry in data]
-        except KeyError as e:
+            if isinstance(data[0], dict):
+                db_data = [
+                    {self.DATA_TO_DB[k]: 'NULL' if v is None else v for k, v in entry.items()} for entry in data
+                ]
+                columns_str = ', '.join(db_data[0].keys())
+                values = [[f"'{str(v)}'" if v != 'NULL' else f"{str(v)}" for v in item.values()] for item in db_data]
+            else:
+                # rows decoded straight to table column order
+                columns_str = ', '.join(self.DATA_TO_DB.values())
+                values = [['NULL' if v is None else f"'{v}'" for v in row] for row in self.to_rows(data)]
+        except (KeyError, ValueError, AttributeError) as e:
             log.error(f'Incorrect data format. Error details: {e.args}')
             return
-        columns_str = ', '.join(data[0].keys())
-        values = [[f"'{str(v)}'" if v != 'NULL' else f"{str(v)}" for v in item.values()] for item in data]
         values = [f'({", ".join(value_set)})' for value_set in values]
         values_str = ', '.join(values)
         insert_query = f'''
             INSERT INTO {full_table_name}({columns_str})
             VALUES
             {values_str}
-            RETURNING *;
+            {self._returning_clause(returning)};
         '''
-        self.create_table_if_not_exist(schema, table, db_lib)
-        result = self.execute_sql(insert_query, db_lib=db_lib)
-        if result:
-            log.info(f'Successfully inserted rows in db {result}')
+        return PreparedInsert(schema, table, insert_query, len(data), data=data, returning=returning)
+
+    def write_prepared(
+            self,
+            prepared: PreparedInsert,
+            db_lib=psycopg2,
+            raise_errors: bool = False,
+            written: Optional[List[Any]] = None
+    ) -> Optional[Union[int, Iterable[Tuple[Any, ...]]]]:
+        """Sends query built by prepare_insert to DB
+
+        Args:
+            prepared: result of prepare_insert
+            db_lib: library object to use, see insert
+            raise_errors: see insert
+            written: if given, records stored in DB are appended to it. Records rejected by DB
+                or skipped as already stored are not, so it's what e.g. rollups shall be built from
+
+        Returns:
+            the same as insert
+
+        """
+        if self._metrics is None:
+            return self._write_prepared(prepared, db_lib, raise_errors, written)
+        started = time.monotonic()
+        try:
+            result = self._write_prepared(prepared, db_lib, raise_errors, written)
+        except Exception:
+            self._metrics.errors.inc(label_value='insert')
+            raise
+        finally:
+            self._metrics.insert_duration.observe(time.monotonic() - started)
+        if result is None and prepared.returning != 'none':
+            self._metrics.errors.inc(label_value='insert')
+        else:
+            # rows are streamed lazily, so they are counted as sent
+            self._metrics.inserted_rows.inc(result if isinstance(result, int) else prepared.rows)
+        return result
+
+    def _write_prepared(
+            self,
+            prepared: PreparedInsert,
+            db_lib=psycopg2,
+            raise_errors: bool = False,
+            written: Optional[List[Any]] = None
+    ) -> Optional[Union[int, Iterable[Tuple[Any, ...]]]]:
+        if self._dead_letters is not None:
+            return self._write_isolating(prepared, db_lib, raise_errors, written)
+        try:
+            return self._write(prepared, db_lib, raise_errors, written)
+        except Exception as e:
+            if not _is_data_error(e):
+                raise
+            # already logged, retry with the same data won't help
+            return
+
+    def _write(
+            self,
+            prepared: PreparedInsert,
+            db_lib=psycopg2,
+            raise_errors: bool = False,
+            written: Optional[List[Any]] = None
+    ) -> Optional[Union[int, Iterable[Tuple[Any, ...]]]]:
+        idempotent = self._idempotent and isinstance(prepared.data, Batch) and prepared.data.has_positions()
+        if idempotent:
+            # only this query knows which records are already stored
+            query = partial(self._write_idempotent, prepared, db_lib, written=written)
+        else:
+            query = self._write_query(prepared, db_lib)
+        try:
+            result = self._provisioned_call(prepared.schema, prepared.table, db_lib, query, raise_errors=True)
+        except Exception:
+            # error is logged by the query
+            if raise_errors:
+                raise
+            return
+        if written is not None and not idempotent:
+            written.extend(prepared.data)
+        if prepared.returning == 'none':
+            return
+        if isinstance(result, int):
+            log.info(f'Successfully inserted {result} rows in db')
+        elif isinstance(result, list):
+            log.info(f'Successfully inserted {len(result)} rows in db')
+        return result
+
+    def _write_query(self, prepared: PreparedInsert, db_lib=psycopg2) -> Callable[..., Any]:
+        """Returns query sending prepared insert, see _provisioned_call"""
+        if prepared.pages is not None:
+            query = partial(self._write_paged, prepared, db_lib)
+        elif prepared.buffer is None and prepared.returning == 'rows' and self._dead_letters is None:
+            query = partial(self.stream_sql, prepared.query, db_lib=db_lib)
+        elif prepared.buffer is None:
+            query = partial(
+                self.execute_sql,
+                prepared.query,
+                db_lib=db_lib,
+                fetch_results=isinstance(prepared.returning, tuple) or prepared.returning == 'rows',
+                return_rowcount=prepared.returning == 'count'
+            )
+        else:
+            def query(**kwargs):
+                # buffer is read again if the first attempt failed
+                prepared.buffer.seek(0)
+                return self.copy_from_buffer(prepared.query, prepared.buffer, db_lib=db_lib, **kwargs)
+        return query
+
+    def _write_idempotent(
+            self,
+            prepared: PreparedInsert,
+            db_lib=psycopg2,
+            raise_errors: bool = False,
+            written: Optional[List[Any]] = None
+    ) -> Optional[Union[int, List[Tuple[Any, ...]]]]:
+        """Writes batch and its Kafka offsets in one transaction skipping already stored records
+
+        Offsets of the batch partitions are locked first, so that concurrent writes
+        of the same messages, e.g. by workers during partition rebalance, are serialized
+        """
+        batch = prepared.data
+        batch_returning = prepared.returning
+        offsets_table = f'{prepared.schema}.{prepared.table}_offsets'
+        next_offsets = sorted(batch.next_offsets().items())
+        partitions = tuple((topic, partition) for (topic, partition), _ in next_offsets)
+        try:
+            with self.transaction(db_lib) as cursor:
+                log.info(f'Sending SQL query: {prepared.query}')
+                cursor.executemany(
+                    f'INSERT INTO {offsets_table}(topic, partition, next_offset) VALUES (%s, %s, 0) '
+                    f'ON CONFLICT DO NOTHING',
+                    partitions
+                )
+                cursor.execute(
+                    f'SELECT topic, partition, next_offset FROM {offsets_table} '
+                    f'WHERE (topic, partition) IN %s FOR UPDATE',
+                    (partitions,)
+                )
+                stored = {(topic, partition): offset for topic, partition, offset in cursor.fetchall()}
+                fresh = batch.after(stored)
+                if len(fresh) < len(batch):
+                    log.warning(f'Skipping {len(batch) - len(fresh)} records which are already stored')
+                    prepared = self._prepare(fresh, prepared.schema, prepared.table, prepared.returning) if fresh else None
+                if prepared is not None:
+                    result = self._execute_prepared(cursor, prepared, db_lib)
+                else:
+                    result = 0 if batch_returning == 'count' else None if batch_returning == 'none' else []
+                cursor.executemany(
+                    f'UPDATE {offsets_table} SET next_offset = GREATEST(next_offset, %s) '
+                    f'WHERE topic = %s AND partition = %s',
+                    [(offset, topic, partition) for (topic, partition), offset in next_offsets]
+                )
+        except BaseException as e:
+            log.error(f'Error executing SQL query: {e}')
+            if raise_errors:
+                raise
+            return
+        if written is not None:
+            written.extend(fresh)
         return result
 
+    def _write_paged(
+            self,
+            prepared: PreparedInsert,
+            db_lib=psycopg2,
+            raise_errors: bool = False
+    ) -> Optional[int]:
+        """Executes prepared statement for every page of the batch in one transaction"""
+        try:
+            with self.transaction(db_lib) as cursor:
+                return self._execute_prepared(cursor, prepared, db_lib)
+        except BaseException as e:
+            log.error(f'Error executing SQL query: {e}')
+            if raise_errors:
+                raise
+
+    @staticmethod
+    def _statement_name(schema: str, table: str) -> str:
+        return f'insert_{schema}_{table}'
+
+    def _prepare_statement(self, cursor, schema: str, table: str) -> None:
+        """Prepares insert statement in connection of the cursor unless it's prepared already
+
+        Statement inserts rows from arrays of column values, so that the same statement
+        serves batches of any size.
+        """
+        name = self._statement_name(schema, table)
+        connection = cursor.connection
+        with _prepared_statements_lock:
+            if name in _prepared_statements.get(connection, ()):
+                return
+        types = ', '.join(f'{column_type}[]' for column_type in self.COLUMN_TYPES)
+        columns = ', '.join(self.DATA_TO_DB.values())
+        arrays = ', '.join(f'${i}' for i in range(1, len(self.COLUMN_TYPES) + 1))
+        prepare_query = f'PREPARE {name}({types}) AS INSERT INTO {schema}.{table}({columns}) SELECT * FROM unnest({arrays})'
+        log.info(f'Sending SQL query: {prepare_query}')
+        cursor.execute(prepare_query)
+        # prepared statements are not transactional, it stays even if the transaction fails
+        with _prepared_statements_lock:
+            _prepared_statements.setdefault(connection, set()).add(name)
+
+    def _execute_prepared(
+            self,
+            cursor,
+            prepared: PreparedInsert,
+            db_lib=psycopg2
+    ) -> Optional[Union[int, List[Tuple[Any, ...]]]]:
+        """Sends prepared query using cursor of already opened transaction"""
+        if prepared.pages is not None:
+            self._prepare_statement(cursor, prepared.schema, prepared.table)
+            log.info(f'Sending {len(prepared.pages)} pages to SQL query: {prepared.query}')
+            rows = 0
+            for page in prepared.pages:
+                cursor.execute(prepared.query, page)
+                rows += cursor.rowcount
+            return rows if prepared.returning == 'count' else None
+        if prepared.buffer is not None:
+            prepared.buffer.seek(0)
+            cursor.copy_expert(prepared.query, prepared.buffer)
+        else:
+            cursor.execute(prepared.query)
+        if prepared.returning == 'none':
+            return
+        if prepared.returning == 'count':
+            return cursor.rowcount
+        try:
+            return cursor.fetchall()
+        except db_lib.ProgrammingError as e:
+            log.warning(f'Not possible to fetch query result: {e}')
+
+    def _write_isolating(
+            self,
+            prepared: PreparedInsert,
+            db_lib=psycopg2,
+            raise_errors: bool = False,
+            written: Optional[List[Any]] = None
+    ) -> Optional[Union[int, List[Tuple[Any, ...]]]]:
+        """Writes prepared query, bisects the batch if DB rejects its data
+
+        Every failed half is split again, so that a single bad record among N costs
+        about 2 * log2(N) statements. Records rejected alone go to dead letters.
+        Errors not caused by data (e.g. connection loss) are not bisected.
+        """
+        try:
+            return self._write(prepared, db_lib, raise_errors=True, written=written)
+        except Exception as e:
+            if not _is_data_error(e):
+                if raise_errors:
+                    raise
+                return
+            error = e
+        data = prepared.data
+        if len(data) == 1:
+            self._dead_letters.send(self._dead_letter_value(data[0]), f'Rejected by DB: {str(error).strip()}')
+            return
+        log.warning(f'DB rejected batch of {len(data)} records. Splitting it to isolate bad ones')
+        middle = len(data) // 2
+        results = list()
+        for part in (data[:middle], data[middle:]):
+            part_prepared = self._prepare(part, prepared.schema, prepared.table, prepared.returning)
+            results.append(self._write_isolating(part_prepared, db_lib, raise_errors, written))
+        results = [result for result in results if result is not None]
+        if not results:
+            return
+        if all(isinstance(result, int) for result in results):
+            return sum(results)
+        return [row for result in results for row in result]
+
+    def _reject_invalid(self, data: List[Any]) -> List[Any]:
+        """Sends invalid records to dead letters, returns valid ones
+
+        Batch stays Batch with positions of the valid records, so that they are still written idempotently
+        """
+        valid = list()
+        for i, record in enumerate(data):
+            reason = self.validate_record(record)
+            if reason is None:
+                valid.append(i)
+            else:
+                self._dead_letters.send(self._dead_letter_value(record), reason)
+        if len(valid) == len(data):
+            return data
+        if isinstance(data, Batch):
+            return data.select(valid)
+        return [data[i] for i in valid]
+
+    @classmethod
+    def _dead_letter_value(cls, record: Any) -> Any:
+        """Returns record in the form it's stored in dead letters: as received or as JSON object"""
+        if isinstance(record, InvalidMessage):
+            return record.raw
+        if isinstance(record, tuple) and len(record) == len(cls.DATA_TO_DB):
+            return dict(zip(cls.DATA_TO_DB, record))
+        return record
+
+    @classmethod
+    def validate_record(cls, record: Any) -> Optional[str]:
+        """Checks that the record could be inserted in the table
+
+        Args:
+            record: message value as produced by consumer decoder: dict or row tuple
+
+        Returns:
+            reason of rejection or None if record is valid
+
+        """
+        if isinstance(record, InvalidMessage):
+            return record.reason
+        if isinstance(record, tuple):
+            if len(record) != len(cls.DATA_TO_DB):
+                return f'Row shall have {len(cls.DATA_TO_DB)} values, got {len(record)}'
+            record = dict(zip(cls.DATA_TO_DB, record))
+        if not isinstance(record, dict):
+            return f'Record shall be a JSON object, got {type(record).__name__}'
+        unknown_keys = record.keys() - cls.DATA_TO_DB.keys()
+        if unknown_keys:
+            return f'Unknown keys: {sorted(unknown_keys)}'
+        for key in cls.REQUIRED_KEYS:
+            if record.get(key) in (None, ''):
+                return f'Missing value of {key}'
+        return cls._validate_values(record)
+
+    @staticmethod
+    def _validate_values(record: Dict[str, Any]) -> Optional[str]:
+        """Checks values of record with known keys and required values, see validate_record"""
+        try:
+            datetime.datetime.fromisoformat(str(record['request_timestamp']))
+        except ValueError:
+            return f'Incorrect request_timestamp: {record["request_timestamp"]}'
+        status_code = record.get('resp_status_code')
+        if status_code is not None and (isinstance(status_code, bool) or not str(status_code).isdigit()):
+            return f'Incorrect resp_status_code: {status_code}'
+        pattern_found = record.get('pattern_found')
+        if pattern_found is not None and str(pattern_found).lower() not in ('true', 'false'):
+            return f'Incorrect pattern_found: {pattern_found}'
+        return None
+
+    @classmethod
+    def to_rows(cls, data: List[Any]) -> Iterator[Tuple[Any, ...]]:
+        """Yields records as tuples of values in the order of DATA_TO_DB, i.e. of table columns
+
+        Args:
+            data: list of json-serializable dicts or of tuples already in column order,
+                e.g. src.records.MetricRecord or decoded by src.decoders.RowDecoder
+
+        Raises:
+            KeyError: if dict contains a key not present in DATA_TO_DB
+            ValueError: if record is InvalidMessage or a tuple of wrong length
+
+        """
+        keys = tuple(cls.DATA_TO_DB)
+        known_keys = cls.DATA_TO_DB.keys()
+        for entry in data:
+            if isinstance(entry, dict):
+                if not entry.keys() <= known_keys:
+                    raise KeyError(*(entry.keys() - known_keys))
+                yield tuple([entry.get(k) for k in keys])
+            elif isinstance(entry, InvalidMessage):
+                raise ValueError(entry.reason)
+            elif len(entry) == len(keys):
+                yield entry
+            else:
+                raise ValueError(f'Row shall have {len(keys)} values, got {len(entry)}')
+
+    @classmethod
+    def to_copy_buffer(cls, data: List[Any]) -> io.StringIO:
+        """Serializes data to in-memory buffer in COPY text format
+
+        Args:
+            data: list of json-serializable dicts or row tuples, see to_rows
+
+        Returns:
+            buffer, rewound to the beginning, with one line per entry.
+            Columns follow the order of DATA_TO_DB values, missing keys are NULL
+
+        Raises:
+            KeyError: if entry contains a key not present in DATA_TO_DB
+            ValueError: if entry is not a valid row
+
+        """
+        lines = ['\t'.join([_to_copy_value(value) for value in row]) for row in cls.to_rows(data)]
+        lines.append('')
+        return io.StringIO('\n'.join(lines))
+
+    def query(
+            self,
+            schema: str,
+            table: str,
+            url: Optional[str] = None,
+            agent: Optional[str] = None,
+            status_code: Optional[Union[int, Sequence[int]]] = None,
+            since: Optional[datetime.datetime] = None,
+            until: Optional[datetime.datetime] = None,
+            columns: Optional[Sequence[str]] = None,
+            fetch_size: int = 1000,
+            columnar: bool = False,
+            db_lib=psycopg2
+    ) -> Iterator[Union[MetricRow, Tuple[Any, ...], Dict[str, List[Any]]]]:
+        """Reads rows of the table ordered by time_stamp, filters not given are not applied
+
+        Rows are read through server-side cursor fetch_size rows at a time, so that reading
+        any number of rows takes constant memory. Filter values are sent as query parameters.
+        Connection is held until the iterator is exhausted or closed.
+
+        Args:
+            schema: database schema
+            table: table name in DB
+            url: exact url
+            agent: exact agent, i.e. service_name of the record
+            status_code: exact status code or any of given ones
+            since: min time_stamp, inclusive
+            until: max time_stamp, exclusive
+            columns: table columns to read, all of them by default
+            fetch_size: number of rows transferred from DB at once
+            columnar: if True, chunks of up to fetch_size rows are yielded as dicts of
+                column name to list of its values
+            db_lib: library object to use, see insert
+
+        Returns:
+            iterator over MetricRow, over tuples of given columns or over columnar chunks
+
+        Raises:
+            ValueError: if columns are not the table ones
+
+        """
+        selected = tuple(columns) if columns is not None else MetricRow._fields
+        unknown = set(selected) - set(MetricRow._fields)
+        if not selected or unknown:
+            raise ValueError(f'Columns shall be some of {MetricRow._fields}, got: {selected}')
+        conditions = list()
+        args = dict()
+        for column, value in (('url', url), ('agent', agent), ('status_code', status_code)):
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple, set)):
+                conditions.append(f'{column} = ANY(%({column})s)')
+                value = list(value)
+            else:
+                conditions.append(f'{column} = %({column})s')
+            args[column] = value
+        if since is not None:
+            conditions.append('time_stamp >= %(since)s')
+            args['since'] = since
+        if until is not None:
+            conditions.append('time_stamp < %(until)s')
+            args['until'] = until
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        select_query = f'SELECT {", ".join(selected)} FROM {schema}.{table} {where} ORDER BY time_stamp'
+        chunks = self.stream_sql(
+            select_query,
+            db_lib,
+            args,
+            raise_errors=True,
+            chunk_rows=fetch_size,
+            cursor_name=f'{table}_query_{uuid.uuid4().hex}',
+            chunks=True
+        )
+        if columnar:
+            return (
+                {column: list(values) for column, values in zip(selected, zip(*chunk))}
+                for chunk in chunks
+            )
+        rows = itertools.chain.from_iterable(chunks)
+        return map(MetricRow._make, rows) if columns is None else rows
+
     def delete_data(
             self,
             schema: str,
             table: str,
             db_lib=psycopg2,
+            returning: Union[str, Sequence[str]] = 'count',
             **kwargs
-    ) -> Optional[List[Tuple[
-        datetime.datetime, str, str, datetime.timedelta, int, str, bool, str
-    ]]]:
+    ) -> Optional[Union[int, Iterable[Tuple[Any, ...]]]]:
         """Removes rows from the table.
 
+        Note:
+            to remove old data from partitioned table, expire its partitions
+            instead, see manage_partitions
+
         Args:
             schema: database schema
             table: table name in DB to insert data to
@@ -229,12 +1569,19 @@ class WebMonitoringDBWrapper(SQLDatabaseWrapper):
                 by signature methods: connect, cursor, cursor.execute,
                 cursor.fetchall and ProgrammingError exception.
                 Default is postgres psycopg2.
+            returning: what to get back from DB, see insert. 'rows' are returned as iterator, see stream_sql.
+                DELETE can't run in server-side cursor, so that the whole result is received by the client
+                at once and only converted to rows in pages while iterating
             **kwargs: keys and values used in WHERE filter
 
         Returns:
-            removed rows as list of tuples
+            result as requested by returning, None if delete failed
+
+        Raises:
+            ValueError: if returning is not supported
 
         """
+        returning = self._check_returning(returning)
         if not kwargs:
             log.warning('Calling delete with no params rejected! Are you trying to wipe all data?')
             return
@@ -244,9 +1591,18 @@ class WebMonitoringDBWrapper(SQLDatabaseWrapper):
         DELETE
         FROM {full_table_name}
         WHERE {search_param_str}
-        RETURNING *;
+        {self._returning_clause(returning)};
         '''
-        result = self.execute_sql(delete_query, db_lib)
-        if result:
-            log.info(f'Successfully removed rows from db: {result}')
+        if returning == 'rows':
+            return self.stream_sql(delete_query, db_lib)
+        result = self.execute_sql(
+            delete_query,
+            db_lib,
+            fetch_results=isinstance(returning, tuple),
+            return_rowcount=returning == 'count'
+        )
+        if returning == 'none':
+            return
+        if result is not None:
+            log.info(f'Successfully removed {result if isinstance(result, int) else len(result)} rows from db')
         return result
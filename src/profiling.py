@@ -0,0 +1,227 @@
+import cProfile
+import logging
+import os
+import sys
+import threading
+import tracemalloc
+
+from collections import Counter
+from typing import Any, List, NamedTuple, Optional, Tuple
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+CPU_PROFILERS = ('cprofile', 'sampling', 'none')
+
+
+class CycleProfile(NamedTuple):
+    """Result of profiling of one consume-publish cycle"""
+    cycle: int
+    # (function, seconds or samples) spent in the function itself, the hottest first
+    hot_functions: List[Tuple[str, float]]
+    # (source line, bytes) allocated during the cycle and still alive at its end, the largest first
+    top_allocators: List[Tuple[str, int]]
+    # files the full profile and memory snapshot are written to
+    dumps: List[str]
+
+
+class StackSampler:
+    def __init__(self, interval: float = 0.005):
+        """Sampling profiler of all threads of the process
+
+        Unlike cProfile, it costs nothing to the profiled code and sees stage threads
+        of the pipeline too, but measures time statistically.
+
+        Args:
+            interval: seconds between samples
+
+        """
+        self._interval = interval
+        self._stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='StackSampler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        """Stops sampling and returns number of samples per stack, outermost frame first"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        stacks, self._stacks = self._stacks, Counter()
+        return stacks
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self._interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(_function_name(code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                self._stacks[tuple(reversed(stack))] += 1
+
+
+class CycleProfiler:
+    def __init__(
+            self,
+            directory: str = 'profiles',
+            cycles: int = 10,
+            cpu: str = 'cprofile',
+            memory: bool = True,
+            top: int = 10,
+            sample_interval: float = 0.005,
+            memory_frames: int = 1,
+            requested: bool = False
+    ):
+        """Profiles consume-publish cycles on request, see consume_publish_run
+
+        Nothing is measured until request is called, e.g. from a signal handler, then
+        the next 'cycles' cycles are profiled. For every profiled cycle, the hottest
+        functions and the largest allocations are logged and full dumps are written:
+        <directory>/<pid>-<cycle>.prof - cProfile stats, see pstats or snakeviz
+        <directory>/<pid>-<cycle>.stacks - sampled stacks in collapsed format, see flamegraph.pl
+        <directory>/<pid>-<cycle>.tracemalloc - memory snapshot, see tracemalloc.Snapshot.load
+
+        Args:
+            directory: folder to write dumps to, created if missing
+            cycles: number of cycles profiled per request
+            cpu: CPU profiler, one of CPU_PROFILERS. cProfile is exact but slows down profiled
+                code and sees only the thread running cycles, i.e. not pipeline stage threads.
+                'sampling' sees all threads at almost no cost
+            memory: if True, allocations are traced with tracemalloc. Slows down allocations
+            top: number of functions and allocators reported per cycle
+            sample_interval: seconds between samples of 'sampling' profiler
+            memory_frames: number of frames stored per allocation
+            requested: if True, profiling starts with the first cycle
+
+        """
+        if cpu not in CPU_PROFILERS:
+            raise ValueError(f'Unknown CPU profiler: {cpu}, expected one of {CPU_PROFILERS}')
+        if cycles < 1:
+            raise ValueError(f'Number of profiled cycles shall be positive, got: {cycles}')
+        self._directory = directory
+        self._cycles = cycles
+        self._cpu = cpu
+        self._memory = memory
+        self._top = top
+        self._sample_interval = sample_interval
+        self._memory_frames = memory_frames
+        # set by request, possibly from signal handler, consumed by start_cycle
+        self._requested: Optional[int] = cycles if requested else None
+        self._remaining = 0
+        self._cpu_profiler: Any = None
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+
+    @property
+    def active(self) -> bool:
+        return self._remaining > 0
+
+    def request(self, cycles: Optional[int] = None) -> None:
+        """Profiles the next cycles. Safe to call from signal handler
+
+        Args:
+            cycles: number of cycles to profile, default is set in constructor
+        """
+        self._requested = cycles or self._cycles
+
+    def start_cycle(self) -> None:
+        """Starts profiling if it's requested or in progress. Costs nothing otherwise"""
+        if not self._remaining:
+            if self._requested is None:
+                return
+            self._remaining, self._requested = self._requested, None
+            os.makedirs(self._directory, exist_ok=True)
+            if self._memory and not tracemalloc.is_tracing():
+                tracemalloc.start(self._memory_frames)
+            log.warning(f'Profiling of {self._remaining} cycle(s) started, dumps are written to {self._directory}')
+        if self._memory and tracemalloc.is_tracing():
+            self._snapshot = tracemalloc.take_snapshot()
+        if self._cpu == 'cprofile':
+            self._cpu_profiler = cProfile.Profile()
+            self._cpu_profiler.enable()
+        elif self._cpu == 'sampling':
+            self._cpu_profiler = StackSampler(self._sample_interval)
+            self._cpu_profiler.start()
+
+    def end_cycle(self, cycle: int) -> Optional[CycleProfile]:
+        """Stops profiling of the cycle, writes dumps and logs the report
+
+        Args:
+            cycle: number of the cycle, used in names of dumps
+
+        Returns:
+            report of the cycle or None if it wasn't profiled
+        """
+        if not self._remaining:
+            return
+        base = os.path.join(self._directory, f'{os.getpid()}-{cycle:06d}')
+        dumps = []
+        hot_functions = []
+        if isinstance(self._cpu_profiler, cProfile.Profile):
+            import pstats
+            self._cpu_profiler.disable()
+            self._cpu_profiler.dump_stats(f'{base}.prof')
+            dumps.append(f'{base}.prof')
+            hot_functions = self._hot_functions(pstats.Stats(self._cpu_profiler))
+        elif isinstance(self._cpu_profiler, StackSampler):
+            stacks = self._cpu_profiler.stop()
+            with open(f'{base}.stacks', 'w') as dump:
+                for stack, samples in stacks.most_common():
+                    dump.write(f'{";".join(stack)} {samples}\n')
+            dumps.append(f'{base}.stacks')
+            hot_functions = self._hot_sampled(stacks)
+        self._cpu_profiler = None
+
+        top_allocators = []
+        if self._snapshot is not None:
+            # memory of snapshots themselves is not reported
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            snapshot.dump(f'{base}.tracemalloc')
+            dumps.append(f'{base}.tracemalloc')
+            top_allocators = [
+                (str(stat.traceback), stat.size_diff)
+                for stat in snapshot.compare_to(self._snapshot, 'lineno')[:self._top]
+                if stat.size_diff > 0
+            ]
+            self._snapshot = None
+
+        report = CycleProfile(cycle, hot_functions, top_allocators, dumps)
+        log.warning(self.format(report))
+        self._remaining -= 1
+        if not self._remaining:
+            if self._memory and tracemalloc.is_tracing():
+                tracemalloc.stop()
+            log.warning('Profiling finished')
+        return report
+
+    def _hot_functions(self, stats) -> List[Tuple[str, float]]:
+        # (file, line, function): (primitive calls, calls, own time, cumulative time, callers)
+        entries = sorted(stats.stats.items(), key=lambda entry: entry[1][2], reverse=True)
+        return [(_function_name(*function), own_time) for function, (_, _, own_time, _, _) in entries[:self._top]]
+
+    def _hot_sampled(self, stacks: Counter) -> List[Tuple[str, float]]:
+        own_samples = Counter()
+        for stack, samples in stacks.items():
+            own_samples[stack[-1]] += samples
+        return own_samples.most_common(self._top)
+
+    @staticmethod
+    def format(report: CycleProfile) -> str:
+        lines = [f'Profile of cycle {report.cycle}, dumps: {", ".join(report.dumps)}', 'Hot functions:']
+        lines.extend(f'  {value:12.4f}  {function}' for function, value in report.hot_functions)
+        if report.top_allocators:
+            lines.append('Top allocators, bytes:')
+            lines.extend(f'  {size:12d}  {line}' for line, size in report.top_allocators)
+        return '\n'.join(lines)
+
+
+def _function_name(filename: str, line: int, name: str) -> str:
+    return f'{name} ({os.path.basename(filename)}:{line})' if line else name
@@ -0,0 +1,116 @@
+import datetime
+
+from array import array
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+
+class MetricRecord(NamedTuple):
+    """Single web metric as posted by the collector service.
+
+    Fields follow the order of WebMonitoringDBWrapper.DATA_TO_DB, i.e. of table columns,
+    so that record is passed to DB as is. Being a tuple, it takes less than a third of
+    the memory of the equivalent dict and is created with a single allocation.
+    """
+    request_timestamp: Union[str, datetime.datetime]
+    url: str
+    service_name: str
+    resp_time: Optional[Union[str, float]] = None
+    resp_status_code: Optional[int] = None
+    ip_address: Optional[str] = None
+    pattern_found: Optional[bool] = None
+    comment: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'MetricRecord':
+        """Creates record from message value decoded to dict
+
+        Raises:
+            TypeError: if data contains unknown keys
+        """
+        return cls(**data)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self._asdict()
+
+
+class MetricRow(NamedTuple):
+    """Row of metrics table as read from DB, see WebMonitoringDBWrapper.query"""
+    time_stamp: datetime.datetime
+    url: str
+    agent: str
+    response_time: Optional[datetime.timedelta]
+    status_code: Optional[int]
+    ip: Optional[str]
+    content_validation: Optional[bool]
+    comment: Optional[str]
+
+
+def records_from_dicts(data: Iterable[Dict[str, Any]]) -> List[MetricRecord]:
+    """Adapter of dict-based batches, e.g. produced by DictDecoder, to records"""
+    return [MetricRecord(**entry) for entry in data]
+
+
+class Batch(list):
+    def __init__(
+            self,
+            records: Iterable[Any] = (),
+            partitions: Optional[Iterable[Tuple[str, int]]] = None,
+            offsets: Optional[Iterable[int]] = None
+    ):
+        """List of records together with their positions in Kafka
+
+        Args:
+            records: decoded message values
+            partitions: (topic, partition) of every record. Equal values shall be
+                the same object, so that a position costs about 16 bytes per record
+            offsets: offset of every record in its partition
+
+        """
+        super().__init__(records)
+        self.partitions: List[Tuple[str, int]] = list(partitions) if partitions is not None else list()
+        self.offsets = array('q', offsets if offsets is not None else ())
+
+    def add(self, record: Any, partition: Tuple[str, int], offset: int) -> None:
+        self.append(record)
+        self.partitions.append(partition)
+        self.offsets.append(offset)
+
+    def has_positions(self) -> bool:
+        """True if position of every record is known"""
+        return len(self.offsets) == len(self)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return Batch(super().__getitem__(key), self.partitions[key], self.offsets[key])
+        return super().__getitem__(key)
+
+    def next_offsets(self) -> Dict[Tuple[str, int], int]:
+        """Returns offset following the last record of every partition, i.e. offset to commit"""
+        result = dict()
+        for partition, offset in zip(self.partitions, self.offsets):
+            if offset >= result.get(partition, 0):
+                result[partition] = offset + 1
+        return result
+
+    def after(self, stored: Dict[Tuple[str, int], int]) -> 'Batch':
+        """Returns records not stored yet
+
+        Args:
+            stored: next offset to store for (topic, partition), records before it are dropped.
+                Partitions not mentioned are kept entirely
+
+        """
+        kept = [
+            i for i, (partition, offset) in enumerate(zip(self.partitions, self.offsets))
+            if offset >= stored.get(partition, 0)
+        ]
+        if len(kept) == len(self):
+            return self
+        return self.select(kept)
+
+    def select(self, indexes: Iterable[int]) -> 'Batch':
+        """Returns records with given indexes together with their positions, if known"""
+        indexes = list(indexes)
+        if not self.has_positions():
+            return Batch([self[i] for i in indexes])
+        return Batch([self[i] for i in indexes], [self.partitions[i] for i in indexes], [self.offsets[i] for i in indexes])
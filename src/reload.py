@@ -0,0 +1,146 @@
+import logging
+import os
+import time
+
+from numbers import Number
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+try:
+    from ..utils.env_config import config_paths, read_config
+except ImportError:
+    from utils.env_config import config_paths, read_config
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+STORAGE_SECTION = 'Metrics storage endpoint'
+BROKER_SECTION = 'Metrics collection endpoint'
+
+_MISSING = object()
+
+
+def _positive(value: Any) -> bool:
+    return isinstance(value, Number) and not isinstance(value, bool) and value > 0
+
+
+def _not_negative(value: Any) -> bool:
+    return isinstance(value, Number) and not isinstance(value, bool) and value >= 0
+
+
+def _ingest_mode(value: Any) -> bool:
+    try:
+        from ..src.postgres_wrapper import WebMonitoringDBWrapper
+    except ImportError:
+        from src.postgres_wrapper import WebMonitoringDBWrapper
+    return value in WebMonitoringDBWrapper.INGEST_MODES
+
+
+class ConfigReloader:
+    # settings of the storage section applied between cycles: path -> (tunable name, validator).
+    # Other settings of the service sections are used to create clients, their changes require restart
+    RELOADABLE: Dict[Tuple[str, ...], Tuple[str, Callable[[Any], bool]]] = {
+        (STORAGE_SECTION, 'upload every'): ('sleep_time', _positive),
+        (STORAGE_SECTION, 'batch max records'): ('max_records', _positive),
+        (STORAGE_SECTION, 'batch max bytes'): ('max_bytes', _positive),
+        (STORAGE_SECTION, 'batch max linger'): ('max_staleness', _not_negative),
+        (STORAGE_SECTION, 'idle sleep min'): ('min_idle_sleep', _not_negative),
+        (STORAGE_SECTION, 'cycle max seconds'): ('max_cycle', _positive),
+        (STORAGE_SECTION, 'pipeline depth'): ('pipeline_depth', _not_negative),
+        (STORAGE_SECTION, 'db', 'ingest mode'): ('ingest_mode', _ingest_mode),
+        (STORAGE_SECTION, 'db', 'page size'): ('page_size', _positive)
+    }
+
+    def __init__(
+            self,
+            storage_provider: Optional[str] = None,
+            broker_provider: Optional[str] = None,
+            check_interval: float = 5.0,
+            reader: Callable[[], Dict[str, Any]] = read_config,
+            paths: Optional[Iterable[str]] = None
+    ):
+        """Watches config files and reports changes of tunables, see consume_publish_run
+
+        Files are checked by modification time, so that unchanged config costs one stat
+        per file and check_interval. Changes of settings which are not RELOADABLE or with
+        invalid values are logged and ignored, i.e. they stay ignored until restart.
+
+        Args:
+            storage_provider: section of 'Metrics storage endpoint' to watch,
+                default is STORAGE_SERVICE_PROVIDER environment variable
+            broker_provider: section of 'Metrics collection endpoint' to watch,
+                default is BROKER_SERVICE_PROVIDER environment variable
+            check_interval: min seconds between checks of files
+            reader: callable returning merged config, read when files change
+            paths: files to watch, default are service.yaml and service_local.yaml
+
+        """
+        self._providers = {
+            STORAGE_SECTION: storage_provider or os.environ.get('STORAGE_SERVICE_PROVIDER'),
+            BROKER_SECTION: broker_provider or os.environ.get('BROKER_SERVICE_PROVIDER')
+        }
+        self._check_interval = check_interval
+        self._reader = reader
+        self._paths = tuple(paths) if paths is not None else config_paths()
+        self._stamps = self._modification_times()
+        self._settings = self._flatten(reader())
+        self._next_check = time.monotonic() + check_interval
+
+    def check(self) -> Dict[str, Any]:
+        """Returns tunables changed since the previous check, e.g. {'max_records': 500}
+
+        Empty if files weren't changed, couldn't be read or check_interval hasn't passed yet
+        """
+        now = time.monotonic()
+        if now < self._next_check:
+            return dict()
+        self._next_check = now + self._check_interval
+        stamps = self._modification_times()
+        if stamps == self._stamps:
+            return dict()
+        self._stamps = stamps
+        try:
+            settings = self._flatten(self._reader())
+        except Exception as e:
+            log.error(f'Config is not reloaded, failed to read it: {e}')
+            return dict()
+
+        changes = dict()
+        for path in sorted(set(settings) | set(self._settings)):
+            old, new = self._settings.get(path, _MISSING), settings.get(path, _MISSING)
+            if old == new:
+                continue
+            name = ' / '.join(path)
+            if path not in self.RELOADABLE:
+                log.error(f'Change of "{name}" requires restart, ignored')
+                continue
+            tunable, valid = self.RELOADABLE[path]
+            if new is _MISSING or not valid(new):
+                log.error(f'Invalid value of "{name}": {None if new is _MISSING else new!r}, ignored')
+                continue
+            changes[tunable] = new
+            self._settings[path] = new
+        if changes:
+            log.warning(f'Config reloaded, changed: {changes}')
+        return changes
+
+    def _flatten(self, config: Dict[str, Any]) -> Dict[Tuple[str, ...], Any]:
+        """Returns leaf settings of watched sections by their paths"""
+        settings = dict()
+        stack = [((section,), config[section][provider]) for section, provider in self._providers.items()]
+        while stack:
+            path, value = stack.pop()
+            if isinstance(value, dict):
+                stack.extend((path + (str(key),), item) for key, item in value.items())
+            else:
+                settings[path] = value
+        return settings
+
+    def _modification_times(self) -> Tuple[Optional[int], ...]:
+        stamps = []
+        for path in self._paths:
+            try:
+                stamps.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                stamps.append(None)
+        return tuple(stamps)
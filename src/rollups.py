@@ -0,0 +1,179 @@
+import datetime
+import logging
+import warnings
+
+from typing import Any, Iterable, List, NamedTuple, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from ..src.decoders import InvalidMessage
+    from ..src.records import MetricRecord
+except ImportError:
+    from src.decoders import InvalidMessage
+    from src.records import MetricRecord
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# upper bounds in seconds of response time histogram bins, the last bin has no upper bound.
+# Percentiles are reported as the upper bound of the bin they fall into.
+# Changing the bounds invalidates histograms already stored in rollup tables
+RESPONSE_TIME_BOUNDS = (
+    0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.75,
+    1.0, 1.5, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0
+)
+
+_TIMESTAMP = MetricRecord._fields.index('request_timestamp')
+_URL = MetricRecord._fields.index('url')
+_RESPONSE_TIME = MetricRecord._fields.index('resp_time')
+_STATUS_CODE = MetricRecord._fields.index('resp_status_code')
+_VALIDATION = MetricRecord._fields.index('pattern_found')
+
+
+class Rollup(NamedTuple):
+    """Aggregates of a batch per url and minute, in the format of rollup tables rows.
+
+    Rows are sorted by their keys, so that concurrent merges lock rows in the same order.
+    """
+    # (url, minute, requests, timed requests, response time sum, histogram, validated, validation failures)
+    minutes: List[Tuple[str, datetime.datetime, int, int, float, List[int], int, int]]
+    # (url, minute, status code, requests)
+    statuses: List[Tuple[str, datetime.datetime, int, int]]
+
+
+def require_numpy() -> None:
+    """Raises ImportError if rollups can't be computed"""
+    if np is None:
+        raise ImportError('Rollups require numpy, install it with: pip install numpy')
+
+
+def response_seconds(value: Any) -> float:
+    """Converts response time as posted by collector ('H:MM:SS.ffffff') or seconds to float, NaN if missing"""
+    if value is None:
+        return float('nan')
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, str) and ':' in value:
+        hours, minutes, seconds = value.split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    return float(value)
+
+
+def aggregate(records: Iterable[Any]) -> Optional[Rollup]:
+    """Computes per url and minute aggregates of the records
+
+    Per every url and minute: number of requests, histogram and sum of response times
+    (see RESPONSE_TIME_BOUNDS), number of requests per status code, number of content
+    validations and failed ones. Aggregates of different batches are merged by summing.
+
+    Args:
+        records: dicts, MetricRecord or other tuples in its field order. Records without
+            timestamp or url, and those which can't be decoded, are skipped
+
+    Returns:
+        aggregates or None if there are no records to aggregate
+
+    Raises:
+        ImportError: if numpy is not installed
+
+    """
+    require_numpy()
+    timestamps, urls, response_times, status_codes, validations = [], [], [], [], []
+    for record in records:
+        if isinstance(record, InvalidMessage):
+            continue
+        if isinstance(record, dict):
+            record = tuple(record.get(field) for field in MetricRecord._fields)
+        try:
+            response_time = response_seconds(record[_RESPONSE_TIME])
+        except (ValueError, TypeError):
+            response_time = float('nan')
+        if record[_TIMESTAMP] is None or record[_URL] is None:
+            continue
+        timestamps.append(record[_TIMESTAMP])
+        urls.append(record[_URL])
+        response_times.append(response_time)
+        status_codes.append(_status_code(record[_STATUS_CODE]))
+        validations.append(-1 if record[_VALIDATION] is None else int(bool(record[_VALIDATION])))
+
+    minutes = _to_minutes(timestamps)
+    valid = ~np.isnat(minutes)
+    if not valid.any():
+        return None
+    minutes = minutes[valid].astype(np.int64)
+    urls = np.asarray(urls, dtype=object)[valid]
+    response_times = np.asarray(response_times, dtype=np.float64)[valid]
+    status_codes = np.asarray(status_codes, dtype=np.int64)[valid]
+    validations = np.asarray(validations, dtype=np.int8)[valid]
+
+    # every (url, minute) pair becomes a group number
+    url_names, url_index = np.unique(urls.astype(str), return_inverse=True)
+    keys, group = np.unique(np.stack((url_index, minutes), axis=1), axis=0, return_inverse=True)
+    group = group.reshape(-1)
+    groups = len(keys)
+
+    requests = np.bincount(group, minlength=groups)
+    timed = ~np.isnan(response_times)
+    timed_requests = np.bincount(group[timed], minlength=groups)
+    response_time_sum = np.bincount(group[timed], weights=response_times[timed], minlength=groups)
+    bins = len(RESPONSE_TIME_BOUNDS) + 1
+    bin_index = np.searchsorted(np.asarray(RESPONSE_TIME_BOUNDS), response_times[timed], side='left')
+    histogram = np.bincount(group[timed] * bins + bin_index, minlength=groups * bins).reshape(groups, bins)
+    validated = np.bincount(group, weights=validations >= 0, minlength=groups).astype(np.int64)
+    failures = np.bincount(group, weights=validations == 0, minlength=groups).astype(np.int64)
+
+    starts = keys[:, 1].astype('datetime64[m]').astype('datetime64[s]').tolist()
+    names = url_names[keys[:, 0]].tolist()
+    minute_rows = list(zip(
+        names,
+        starts,
+        requests.tolist(),
+        timed_requests.tolist(),
+        response_time_sum.tolist(),
+        histogram.tolist(),
+        validated.tolist(),
+        failures.tolist()
+    ))
+
+    known = status_codes >= 0
+    status_keys, status_counts = np.unique(
+        np.stack((group[known], status_codes[known]), axis=1), axis=0, return_counts=True
+    )
+    status_rows = [
+        (names[key_group], starts[key_group], code, count)
+        for (key_group, code), count in zip(status_keys.tolist(), status_counts.tolist())
+    ]
+    return Rollup(minute_rows, status_rows)
+
+
+def _status_code(value: Any) -> int:
+    """Returns status code as int, -1 if it's missing or not a number, i.e. the record isn't counted per status"""
+    if value is None or isinstance(value, bool):
+        return -1
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return -1
+
+
+def _to_minutes(timestamps: List[Any]) -> 'np.ndarray':
+    """Converts timestamps to datetime64 truncated to minute, NaT for those which can't be parsed"""
+    with warnings.catch_warnings():
+        # offset of timezone aware timestamps is dropped, same as by DB column without time zone
+        warnings.simplefilter('ignore', UserWarning)
+        try:
+            return np.array(timestamps, dtype='datetime64[m]')
+        except ValueError:
+            pass
+        result = np.full(len(timestamps), np.datetime64('NaT'), dtype='datetime64[m]')
+        for i, timestamp in enumerate(timestamps):
+            try:
+                result[i] = np.datetime64(timestamp, 'm')
+            except ValueError:
+                log.warning(f'Timestamp {timestamp!r} is not recognized, record is not aggregated')
+        return result
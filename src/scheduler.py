@@ -0,0 +1,168 @@
+import logging
+import time
+
+from collections import Counter, deque
+from typing import Deque, Dict, NamedTuple, Optional
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class FlushDecision(NamedTuple):
+    """Why and when a batch was posted to DB"""
+    timestamp: float
+    reason: str
+    records: int
+    bytes: int
+    age: float
+
+
+class CycleSummary(NamedTuple):
+    """What scheduler did during one consume-publish cycle"""
+    flushes: Dict[str, int]
+    records: int
+    bytes: int
+    sleep: float
+    # batches of the cycle weren't stored and will be fetched again
+    failed: bool = False
+
+
+class FlushScheduler:
+    # batch is full by number of messages, by their size, waits for too long, broker is empty or cycle is over
+    FLUSH_REASONS = ('records', 'bytes', 'staleness', 'drained', 'cycle')
+    # limits which could be changed by update
+    SETTINGS = ('max_records', 'max_bytes', 'max_staleness', 'min_idle_sleep', 'max_idle_sleep', 'max_cycle')
+
+    def __init__(
+            self,
+            max_records: int = 1000,
+            max_bytes: int = 1048576,
+            max_staleness: float = 5.0,
+            min_idle_sleep: float = 1.0,
+            max_idle_sleep: float = 60.0,
+            backoff_factor: float = 2.0,
+            history_size: int = 1000,
+            max_cycle: float = 60.0
+    ):
+        """Decides when batch of messages shall be posted to DB and how long to wait when idle
+
+        Batch is flushed by whichever comes first: number of messages, size of messages
+        or staleness of the oldest message in the batch. When a cycle brought no messages,
+        the next poll is delayed, growing from min_idle_sleep to max_idle_sleep.
+
+        Args:
+            max_records: max number of messages in a batch
+            max_bytes: max size of serialized message values in a batch
+            max_staleness: max number of seconds the first message of a batch waits for posting
+            min_idle_sleep: seconds to wait after the first cycle with no messages
+            max_idle_sleep: upper bound of wait between cycles with no messages
+            backoff_factor: idle sleep multiplier for every subsequent idle cycle
+            history_size: number of the latest flush decisions and cycles to keep
+            max_cycle: max seconds of a cycle. When it's over, the batch is flushed and the cycle ends
+                even if broker still has messages, so that work done between cycles isn't postponed
+                forever under continuous load
+
+        """
+        if max_records < 1:
+            raise ValueError(f'Batch shall allow at least 1 record, got: {max_records}')
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_staleness = max_staleness
+        self.min_idle_sleep = min_idle_sleep
+        self.max_idle_sleep = max_idle_sleep
+        self.backoff_factor = backoff_factor
+        self.max_cycle = max_cycle
+        self._idle_sleep = 0.0
+        self.flushes: Deque[FlushDecision] = deque(maxlen=history_size)
+        self.cycles: Deque[CycleSummary] = deque(maxlen=history_size)
+        self._cycle_flushes = list()
+
+    def update(self, **settings: float) -> None:
+        """Changes limits of the scheduler, e.g. when config is reloaded
+
+        Args:
+            **settings: new values of max_records, max_bytes, max_staleness,
+                min_idle_sleep, max_idle_sleep or max_cycle
+
+        Raises:
+            ValueError: if setting is unknown or max_records is not positive
+
+        """
+        unknown = set(settings) - set(self.SETTINGS)
+        if unknown:
+            raise ValueError(f'Unknown scheduler settings: {sorted(unknown)}, expected some of {self.SETTINGS}')
+        if settings.get('max_records', self.max_records) < 1:
+            raise ValueError(f'Batch shall allow at least 1 record, got: {settings["max_records"]}')
+        for name, value in settings.items():
+            setattr(self, name, value)
+
+    def flush_reason(self, records: int, size: int, age: float) -> Optional[str]:
+        """Returns reason to flush batch with given parameters or None if it may wait
+
+        Args:
+            records: number of messages in the batch
+            size: size of messages in the batch in bytes
+            age: seconds since the first message was added to the batch
+
+        """
+        if not records:
+            return None
+        if records >= self.max_records:
+            return 'records'
+        if size >= self.max_bytes:
+            return 'bytes'
+        if age >= self.max_staleness:
+            return 'staleness'
+        return None
+
+    def record_flush(self, reason: str, records: int, size: int, age: float) -> FlushDecision:
+        """Stores the decision to flush the batch for later analysis"""
+        decision = FlushDecision(time.time(), reason, records, size, age)
+        self.flushes.append(decision)
+        self._cycle_flushes.append(decision)
+        log.debug(f'Flushing batch of {records} messages, {size} bytes, {age:.3f}s old. Reason: {reason}')
+        return decision
+
+    def end_cycle(self, failed: bool = False) -> CycleSummary:
+        """Closes the cycle and decides how long to wait before the next one
+
+        Args:
+            failed: cycle didn't manage to store its batches, e.g. DB is unavailable.
+                Next cycle is delayed as if this one was idle
+
+        Returns:
+            summary of the cycle. Its sleep is the number of seconds to wait:
+            0 if cycle brought messages, otherwise growing with every idle or failed cycle
+
+        """
+        records = sum(flush.records for flush in self._cycle_flushes)
+        if records and not failed:
+            self._idle_sleep = 0.0
+        elif not self._idle_sleep:
+            self._idle_sleep = self.min_idle_sleep
+        else:
+            self._idle_sleep = min(self._idle_sleep * self.backoff_factor, self.max_idle_sleep)
+        summary = CycleSummary(
+            flushes=dict(Counter(flush.reason for flush in self._cycle_flushes)),
+            records=records,
+            bytes=sum(flush.bytes for flush in self._cycle_flushes),
+            sleep=self._idle_sleep,
+            failed=failed
+        )
+        self.cycles.append(summary)
+        self._cycle_flushes = list()
+        if failed:
+            log.warning(f'Cycle failed to post {summary.records} messages. Next cycle in {summary.sleep}s')
+            return summary
+        log.info(
+            f'Cycle posted {summary.records} messages, {summary.bytes} bytes. '
+            f'Flushes by reason: {summary.flushes}. Next cycle in {summary.sleep}s'
+        )
+        return summary
+
+    def stats(self) -> Dict[str, int]:
+        """Returns number of flushes by reason over the kept history"""
+        stats = {reason: 0 for reason in self.FLUSH_REASONS}
+        stats.update(Counter(flush.reason for flush in self.flushes))
+        return stats
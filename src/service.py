@@ -1,100 +1,289 @@
 import argparse
 import logging
 import os
+import signal
 import sys
+import threading
 import time
 
 
 from functools import partial
-from multiprocessing import Process
-from typing import Iterable, Optional
+from typing import Any, Callable, Dict, Iterable, Optional
 
 
 try:
-    from ..src.postgres_wrapper import WebMonitoringDBWrapper
-    from ..src.consumer import Consumer
-    from ..utils.env_config import config
+    from ..src.context import TOPIC, service_context
+    from ..src.metrics import MetricsServer, ServiceMetrics
+    from ..src.pipeline import Pipeline
+    from ..src.profiling import CycleProfiler
+    from ..src.reload import ConfigReloader
+    from ..src.scheduler import CycleSummary, FlushScheduler
+    from ..src.spool import DiskSpool, SpooledWriter
+    from ..src.supervisor import LagAutoscaler, WorkerCounters, WorkerSupervisor
 except ImportError:
-    from src.postgres_wrapper import WebMonitoringDBWrapper
-    from src.consumer import Consumer
-    from utils.env_config import config
+    from src.context import TOPIC, service_context
+    from src.metrics import MetricsServer, ServiceMetrics
+    from src.pipeline import Pipeline
+    from src.profiling import CycleProfiler
+    from src.reload import ConfigReloader
+    from src.scheduler import CycleSummary, FlushScheduler
+    from src.spool import DiskSpool, SpooledWriter
+    from src.supervisor import LagAutoscaler, WorkerCounters, WorkerSupervisor
+
+log = logging.getLogger(f'{__file__}:ConsumerAndPublishingService')
+log.addHandler(logging.NullHandler())
 
-TOPIC = 'website-metrics'
 DB = os.getenv('DB', default='website_metrics')
 SCHEMA = 'web_metrics'
 TABLE = 'metrics'
 
-_storage_provider = os.environ.get('STORAGE_SERVICE_PROVIDER')
-_storage_settings = config['Metrics storage endpoint'][_storage_provider]
-_db_settings = _storage_settings['db']
+# settings and clients of the service are built on first access, see src.context.ServiceContext
+_CONTEXT_ATTRIBUTES = {
+    'SLEEP_BETWEEN_REQUESTS': 'sleep_between_requests',
+    'SCHEDULER_SETTINGS': 'scheduler_settings',
+    'PIPELINE_DEPTH': 'pipeline_depth',
+    'SPOOL_FACTORY': 'spool_factory',
+    'SPOOL_SETTINGS': 'spool_settings',
+    'CONSUMER_FACTORY': 'consumer_factory',
+    'CONSUMER': 'consumer',
+    'LAG_PROBE_FACTORY': 'lag_probe_factory',
+    'ROLLUPS': 'rollups',
+    'METRICS_ENDPOINT': 'metrics_endpoint',
+    'AUTOSCALING_SETTINGS': 'autoscaling_settings',
+    'PROFILER_FACTORY': 'profiler_factory',
+    'PARTITION_MAINTENANCE_INTERVAL': 'partition_maintenance_interval',
+    'DATABASE': 'database'
+}
 
-_db_auth_basic = (os.environ.get('DB_LOGIN'), os.environ.get('DB_PASS'))
 
-_db_auth = {
-    'scram': _db_auth_basic,
-    'no_auth': ()
-}
+def __getattr__(name: str) -> Any:
+    try:
+        attribute = _CONTEXT_ATTRIBUTES[name]
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+    return getattr(service_context(), attribute)
 
-_db = {
-    'postgres': WebMonitoringDBWrapper
-}
 
-SLEEP_BETWEEN_REQUESTS = _storage_settings['upload every']
+class ConsumePublishService:
+    def __init__(
+            self,
+            consumer,
+            db_wrapper,
+            sleep_time: int,
+            cycles: Optional[int] = None,
+            db_schema: Optional[str] = None,
+            db_table: Optional[str] = None,
+            scheduler: Optional[FlushScheduler] = None,
+            counters: Optional[WorkerCounters] = None,
+            pipeline_depth: int = 0,
+            spool: Optional[DiskSpool] = None,
+            spool_settings: Optional[Dict[str, Any]] = None,
+            maintenance_interval: float = 3600.0,
+            aggregate: Optional[Callable[[Iterable[Any]], Any]] = None,
+            metrics: Optional[ServiceMetrics] = None,
+            profiler: Optional[CycleProfiler] = None,
+            reloader: Optional[ConfigReloader] = None,
+            stop: Optional[threading.Event] = None
+    ):
+        """Cycles and stages of consume_publish_run, see its arguments
 
-_collection_provider = os.environ['BROKER_SERVICE_PROVIDER']
-_broker_settings = config['Metrics collection endpoint'][_collection_provider]['broker']
-_broker_type = _broker_settings['type']
-_broker_url = _broker_settings['host']
-_broker_port = str(_broker_settings['port'])
-_broker_uri = ':'.join((_broker_url, _broker_port))
+        Table and rollup tables are expected to be created by caller.
 
-_broker_auth_sasl_plain = {
-    'security_protocol': 'SASL_PLAINTEXT',
-    'sasl_mechanism': 'PLAIN',
-    'sasl_plain_username': os.environ.get('BROKER_USERNAME'),
-    'sasl_plain_password': os.environ.get('BROKER_PASSWORD')
-}
+        Args:
+            aggregate: computes rollups of a batch, see src.rollups.aggregate. None - rollups are disabled
 
-_broker_auth_ssl = {
-    'security_protocol': 'SSL',
-    'ssl_cafile': os.environ.get('BROKER_CA_CERT'),
-    'ssl_certfile': os.environ.get('BROKER_SERVICE_CERT'),
-    'ssl_keyfile': os.environ.get('BROKER_SERVICE_KEY')
-}
+        """
+        self._consumer = consumer
+        self._db_wrapper = db_wrapper
+        self._sleep_time = sleep_time
+        self._cycles = cycles
+        self._db_schema = db_schema
+        self._db_table = db_table
+        self._scheduler = scheduler
+        self._counters = counters
+        self._pipeline_depth = pipeline_depth
+        self._maintenance_interval = maintenance_interval
+        self._aggregate = aggregate
+        self._metrics = metrics
+        self._profiler = profiler
+        self._reloader = reloader
+        self._stop = stop
+        self._insert = partial(db_wrapper.insert, schema=db_schema, table=db_table, raise_errors=True)
+        self._writer = SpooledWriter(self._insert, spool, **(spool_settings or {})) if spool is not None else None
+        self._partitioned = db_schema and db_table and getattr(db_wrapper, 'partitioning', None) is not None
+        self._next_maintenance = time.monotonic() + maintenance_interval
+        self._counter = 0
 
-_brokers = {
-    'kafka': Consumer
-}
+    def store(self, data, direct: Callable[[], Any]) -> bool:
+        """Writes data with direct or spools it, returns False if data is spooled"""
+        if self._writer is None:
+            direct()
+            return True
+        # positions are dropped, so that replay doesn't skip the batch if offsets
+        # of its partitions were moved forward meanwhile, e.g. by other worker
+        if self._writer.write(list(data), direct):
+            return True
+        if self._counters:
+            self._counters.add(spooled=len(data))
+        return False
 
-_broker_auth = {
-    'sasl_plain': _broker_auth_sasl_plain,
-    'ssl': _broker_auth_ssl,
-    'no_auth': {'security_protocol': 'PLAINTEXT'}
-}
+    # offsets are committed only after the batch is written or spooled, failed write
+    # raises and not committed messages are fetched again in the next cycle.
+    # Stages are the same as of the pipeline, so that rollups get the records the writer got
+    def publish(self, data) -> None:
+        written = self.write(self.prepare(data))
+        if written is not None and self._aggregate is not None:
+            self.rollup(written)
 
-CONSUMER = _brokers[_broker_settings['type']](
-    TOPIC,
-    bootstrap_servers=_broker_uri,
-    **_broker_auth[_broker_settings['auth']]
-)
-
-if isinstance(_db_auth[_db_settings['auth']], tuple):
-    DATABASE = partial(
-        _db[_db_settings['type']],
-        _db_settings['host'],
-        _db_settings['port'],
-        *_db_auth[_db_settings['auth']]
-    )
-elif isinstance(_db_auth[_db_settings['auth']], dict):
-    DATABASE = partial(
-        _db[_db_settings['type']],
-        _db_settings['host'],
-        _db_settings['port'],
-        **_db_auth[_db_settings['auth']]
-    )
-else:
-    msg = f'Database auth object have improper type. Got {type(_db_auth[_db_settings["auth"]])}'
-    raise ValueError(f'{msg}, expected: tuple or dict')
+    # rollups are merged after the batch is stored and are not retried: their failure
+    # shall not make the batch fetched and written again
+    def rollup(self, data) -> None:
+        try:
+            aggregates = self._aggregate(data)
+            if aggregates is not None:
+                self._db_wrapper.merge_rollup(aggregates, schema=self._db_schema, table=self._db_table)
+        except Exception as e:
+            log.error(f'Failed to merge rollups of batch of {len(data)} records: {e}')
+
+    def prepare(self, data):
+        return data, self._db_wrapper.prepare_insert(data, schema=self._db_schema, table=self._db_table)
+
+    def write(self, item):
+        data, prepared = item
+        written = list()
+        # prepared is None if batch is rejected because of its data, there's nothing to retry
+        if prepared is not None:
+            direct = partial(self._db_wrapper.write_prepared, prepared, raise_errors=True, written=written)
+            if not self.store(data, direct):
+                # spooled records are written on replay
+                written = prepared.data
+            if self._counters:
+                self._counters.add(messages=prepared.rows, batches=1)
+        # batches are marked in the order they were fetched
+        self._consumer.mark_processed(data)
+        # records stored in DB go to rollup stage, if any
+        return written or None
+
+    def tune(self, changes: Dict[str, Any]) -> None:
+        """Applies settings changed in config, see ConfigReloader.check"""
+        scheduler_changes = {name: changes[name] for name in FlushScheduler.SETTINGS if name in changes}
+        if 'sleep_time' in changes:
+            self._sleep_time = changes['sleep_time']
+            scheduler_changes['max_idle_sleep'] = self._sleep_time
+        if scheduler_changes and self._scheduler is not None:
+            self._scheduler.update(**scheduler_changes)
+        elif 'max_records' in scheduler_changes:
+            log.error('Batch limits are ignored, service was started without batches (batch max records: 0)')
+        self._pipeline_depth = changes.get('pipeline_depth', self._pipeline_depth)
+        if 'ingest_mode' in changes or 'page_size' in changes:
+            self._db_wrapper.tune(ingest_mode=changes.get('ingest_mode'), page_size=changes.get('page_size'))
+
+    def run(self) -> None:
+        """Runs cycles until stopped, interrupted by user or the number of cycles is reached"""
+        if self._writer is not None:
+            self._writer.start()
+        with self._consumer:
+            while True:
+                try:
+                    summary = self.run_cycle()
+                    if not self._proceed():
+                        break
+                    self._reload()
+                    if not self._pause(summary.sleep if summary else self._sleep_time):
+                        break
+                except KeyboardInterrupt:
+                    break
+        if self._writer is not None:
+            self._writer.stop()
+
+    def run_cycle(self) -> Optional[CycleSummary]:
+        """Fetches and stores messages once, returns summary of the cycle if it's scheduled"""
+        started = time.monotonic()
+        if self._profiler is not None:
+            self._profiler.start_cycle()
+        summary = None
+        failed = False
+        try:
+            fetched = self._consume()
+            self._consumer.commit_processed()
+        except Exception as e:
+            log.error(f'Failed to post messages to DB, they will be fetched again: {e}')
+            failed, fetched = True, 0
+            self._consumer.rewind()
+        if self._scheduler:
+            summary = self._scheduler.end_cycle(failed)
+            fetched = summary.records
+        self._maintain()
+        self._record_cycle(started, failed)
+        if not fetched:
+            log.warning('No data to push to DB. Is web metric service running?')
+        else:
+            log.info(f'Successfully fetched {fetched} pieces of data')
+        self._counter += 1
+        return summary
+
+    def _consume(self) -> int:
+        """Fetches and stores messages, returns number of them fetched without scheduler"""
+        if self._scheduler and self._pipeline_depth:
+            stages = (self.prepare, self.write, self.rollup) if self._aggregate is not None else (self.prepare, self.write)
+            Pipeline(
+                self._consumer.iter_batches(scheduler=self._scheduler, commit=False, stop=self._stop),
+                *stages,
+                queue_size=self._pipeline_depth,
+                name='ConsumePublishPipeline'
+            ).run()
+            return 0
+        if self._scheduler:
+            for data in self._consumer.iter_batches(scheduler=self._scheduler, commit=False, stop=self._stop):
+                self.publish(data)
+            return 0
+        data = self._consumer.fetch_latest(commit=False)
+        if data:
+            self.publish(data)
+        return len(data)
+
+    def _maintain(self) -> None:
+        if self._writer is not None and self._writer.spool.depth():
+            log.warning(f'Spooled batches waiting for DB: {self._writer.stats()}')
+        if self._partitioned and time.monotonic() >= self._next_maintenance:
+            self._db_wrapper.manage_partitions(self._db_schema, self._db_table)
+            self._next_maintenance = time.monotonic() + self._maintenance_interval
+
+    def _record_cycle(self, started: float, failed: bool) -> None:
+        if self._counters:
+            self._counters.add(cycles=1)
+        if self._metrics is not None:
+            self._metrics.cycles.inc()
+            self._metrics.cycle_duration.observe(time.monotonic() - started)
+            if failed:
+                self._metrics.errors.inc(label_value='cycle')
+        if self._profiler is not None:
+            self._profiler.end_cycle(self._counter)
+
+    def _proceed(self) -> bool:
+        if self._cycles and self._counter >= self._cycles:
+            log.info(f'Exiting service because it worked {self._counter} out of {self._cycles} cycles')
+            return False
+        if self._stop is not None and self._stop.is_set():
+            log.warning(f'Exiting service on request after {self._counter} cycles, processed offsets are committed')
+            return False
+        return True
+
+    def _reload(self) -> None:
+        if self._reloader is not None:
+            changes = self._reloader.check()
+            if changes:
+                self.tune(changes)
+
+    def _pause(self, seconds: float) -> bool:
+        """Sleeps between cycles, returns False if stop was requested meanwhile"""
+        if self._stop is None:
+            time.sleep(seconds)
+            return True
+        if self._stop.wait(seconds):
+            log.warning(f'Exiting service on request after {self._counter} cycles')
+            return False
+        return True
 
 
 def consume_publish_run(
@@ -104,50 +293,151 @@ def consume_publish_run(
         topics: Optional[Iterable[str]] = None,
         cycles: Optional[int] = None,
         db_schema: Optional[str] = None,
-        db_table: Optional[str] = None
+        db_table: Optional[str] = None,
+        scheduler: Optional[FlushScheduler] = None,
+        counters: Optional[WorkerCounters] = None,
+        pipeline_depth: int = 0,
+        spool: Optional[DiskSpool] = None,
+        spool_settings: Optional[Dict[str, Any]] = None,
+        maintenance_interval: float = 3600.0,
+        rollups: bool = False,
+        metrics: Optional[ServiceMetrics] = None,
+        profiler: Optional[CycleProfiler] = None,
+        reloader: Optional[ConfigReloader] = None,
+        stop: Optional[threading.Event] = None
 ):
     """Service runner for fetching data from Kafka broker and posting to DB
 
     Args:
         consumer: Kafka consumer
         db_wrapper: helper lib to work with DB
-        sleep_time: number of seconds to wait between metric collection
+        sleep_time: number of seconds to wait between metric collection. Not used with scheduler
         topics: to change to. When provided, previous topics are wiped out
         cycles: number of iterations to run the service. Runs infinitely if None
         db_schema: database schema (in postgres understanding) to store data
         db_table: database table to store data
+        scheduler: when provided, data is posted to DB in bounded batches as they arrive
+            instead of fetching all messages at once. Scheduler decides when batch is posted
+            and how long to wait when there are no messages instead of fixed sleep_time
+        counters: throughput counters to report to, e.g. when run by WorkerSupervisor
+        pipeline_depth: works only with scheduler. If positive, fetching batches from broker,
+            building queries and writing to DB run in parallel threads. Defines max number
+            of batches waiting for every stage. When 0, these steps run one after another
+        spool: when provided, batches which couldn't be written to DB are stored there
+            and written later by a background thread instead of fetching them again
+        spool_settings: keyword arguments of SpooledWriter, e.g. latency_budget
+        maintenance_interval: seconds between partition maintenance of partitioned table,
+            see WebMonitoringDBWrapper.manage_partitions
+        rollups: if True, aggregates of every written batch are merged into rollup tables,
+            see WebMonitoringDBWrapper.create_rollup_tables. Requires numpy
+        metrics: durations of cycles and failed ones are recorded there, consumer and
+            DB wrapper shall be created with the same metrics to record their stages
+        profiler: profiles cycles when requested, see CycleProfiler.request
+        reloader: reports changed config between cycles. Sleep time, batch limits, pipeline
+            depth, ingest mode and page size of DB wrapper are changed accordingly
+        stop: when set, e.g. by signal handler, broker is not polled anymore, batches already
+            fetched are stored, their offsets are committed and the service returns
 
     Returns:
-        None, runs until interrupted by user or iterated "iterations" times
+        None, runs until stopped, interrupted by user or iterated "iterations" times
 
     """
-
     if topics:
         consumer.change_topics(topics)
-    log = logging.getLogger(f'{__file__}:ConsumerAndPublishingService')
-    log.addHandler(logging.NullHandler())
-
-    with consumer:
-        counter = 0
-        def proceed(): return counter < cycles if cycles else True
-        while True:
-            try:
-                data = consumer.fetch_latest()
-                if not data:
-                    log.warning('No data to push to DB. Is web metric service running?')
-                else:
-                    log.info(f'Successfully fetched {len(data)} pieces of data')
-                    db_wrapper.insert(data, schema=db_schema, table=db_table)
-                counter += 1
-                if not proceed():
-                    log.info(f'Exiting service because it worked {counter} out of {cycles} cycles')
-                    break
-                time.sleep(sleep_time)
-            except KeyboardInterrupt:
-                break
 
+    aggregate = None
+    if rollups:
+        # numpy is imported only when rollups are enabled
+        try:
+            from ..src.rollups import aggregate, require_numpy
+        except ImportError:
+            from src.rollups import aggregate, require_numpy
+        require_numpy()
+    if db_schema and db_table:
+        # table is created once here, so that inserts don't need to send DDL
+        db_wrapper.create_table_if_not_exist(db_schema, db_table)
+        if rollups:
+            db_wrapper.create_rollup_tables(db_schema, db_table)
 
-if __name__ == '__main__':
+    ConsumePublishService(
+        consumer,
+        db_wrapper,
+        sleep_time,
+        cycles=cycles,
+        db_schema=db_schema,
+        db_table=db_table,
+        scheduler=scheduler,
+        counters=counters,
+        pipeline_depth=pipeline_depth,
+        spool=spool,
+        spool_settings=spool_settings,
+        maintenance_interval=maintenance_interval,
+        aggregate=aggregate,
+        metrics=metrics,
+        profiler=profiler,
+        reloader=reloader,
+        stop=stop
+    ).run()
+
+
+def total_lag(consumer, topics: Iterable[str]) -> int:
+    """Returns number of messages in topics not processed by the consumer group, see Consumer.lag"""
+    return sum(consumer.lag(topics).values())
+
+
+def run_worker(
+        consumer_factory: Callable,
+        db_factory: Callable,
+        spool_factory: Optional[Callable] = None,
+        metrics: Optional[ServiceMetrics] = None,
+        profiler_factory: Optional[Callable] = None,
+        reloader_factory: Optional[Callable] = None,
+        **kwargs
+):
+    """Entry point of worker process. Creates its own consumer, DB wrapper and spool.
+
+    SIGTERM and SIGINT make the worker finish batches already fetched, commit their offsets,
+    close connections, dead letters and spool and exit with code 0, so that restarted service
+    continues right after them.
+
+    Args:
+        consumer_factory: callable without args creating consumer
+        db_factory: callable without args creating DB wrapper
+        spool_factory: callable without args creating spool, e.g. DiskSpool.claim
+        metrics: shared by all workers, when given, passed as metrics keyword argument
+            to both factories and to consume_publish_run
+        profiler_factory: callable without args creating CycleProfiler. Profiling is
+            requested by SIGUSR1 sent to the worker
+        reloader_factory: callable without args creating ConfigReloader, None - config is not reloaded
+        **kwargs: keyword arguments of consume_publish_run
+
+    """
+    spool = spool_factory() if spool_factory else None
+    if metrics is not None:
+        consumer, db_wrapper = consumer_factory(metrics=metrics), db_factory(metrics=metrics)
+    else:
+        consumer, db_wrapper = consumer_factory(), db_factory()
+    profiler = profiler_factory() if profiler_factory else None
+    if profiler is not None and hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.request())
+    reloader = reloader_factory() if reloader_factory else None
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stop.set())
+    try:
+        consume_publish_run(
+            consumer, db_wrapper, spool=spool, metrics=metrics, profiler=profiler, reloader=reloader, stop=stop, **kwargs
+        )
+    finally:
+        db_wrapper.close()
+        # worker processes don't run atexit handlers, buffered dead letters would be lost
+        if db_wrapper.dead_letters is not None:
+            db_wrapper.dead_letters.close()
+        if spool is not None:
+            spool.close()
+
+
+def _argument_parser() -> argparse.ArgumentParser:
     cmd_args = argparse.ArgumentParser()
 
     cmd_args.add_argument(
@@ -190,52 +480,140 @@ if __name__ == '__main__':
         help='seconds to wait between broker polling, defaults to service.yaml settings',
         type=int
     )
-    args = cmd_args.parse_args()
-
-    logging.basicConfig(
-        format='%(asctime)s - %(levelname)s | %(name)s >>> %(message)s',
-        datefmt='%d-%b-%Y %H:%M:%S'
+    cmd_args.add_argument(
+        '--workers',
+        dest='workers',
+        help='number of consumer-publisher processes sharing topic partitions. Defaults to 1',
+        default=1,
+        type=int
     )
-
-    PROCESS_NAME = 'WebMetricsConsumerPublisher'
-    mp_args = (
-        CONSUMER,
-        DATABASE(args.db)
+    cmd_args.add_argument(
+        '--profile',
+        dest='profile',
+        help='profile the first cycles of every worker, see profiling in service.yaml. '
+             'Profiling could be started later by SIGUSR1 as well',
+        action='store_true'
     )
-    mp_kwargs = {
-        'sleep_time': args.sleep if args.sleep else SLEEP_BETWEEN_REQUESTS,
+    cmd_args.add_argument(
+        '--reload-config',
+        dest='reload_config',
+        help='apply changes of sleep time, batch limits, pipeline depth, ingest mode and page size '
+             'in service.yaml and service_local.yaml without restart',
+        action='store_true'
+    )
+    cmd_args.add_argument(
+        '--daemon',
+        dest='daemon',
+        help='run without interactive prompt until SIGTERM or SIGINT, or until all workers finish',
+        action='store_true'
+    )
+    return cmd_args
+
+
+PROCESS_NAME = 'WebMetricsConsumerPublisher'
+
+
+def _worker_kwargs(context, args: argparse.Namespace) -> Dict[str, Any]:
+    """Returns keyword arguments of run_worker for command line arguments"""
+    scheduler_settings = context.scheduler_settings
+    if args.sleep:
+        scheduler_settings['max_idle_sleep'] = args.sleep
+    return {
+        'consumer_factory': context.consumer_factory,
+        'db_factory': partial(context.database, args.db),
+        'sleep_time': args.sleep if args.sleep else context.sleep_between_requests,
         'topics': [args.topic] if args.topic else None,
         'cycles': args.cycles if args.cycles else None,
         'db_schema': args.schema if args.schema else None,
-        'db_table': args.table if args.table else None
+        'db_table': args.table if args.table else None,
+        'scheduler': FlushScheduler(**scheduler_settings) if scheduler_settings['max_records'] else None,
+        'pipeline_depth': context.pipeline_depth,
+        'spool_factory': context.spool_factory,
+        'spool_settings': context.spool_settings,
+        'maintenance_interval': context.partition_maintenance_interval,
+        'rollups': context.rollups,
+        'profiler_factory': partial(context.profiler_factory, requested=args.profile),
+        'reloader_factory': context.reloader_factory if args.reload_config else None
     }
-    consume_publish_process = Process(
-        target=consume_publish_run,
-        args=mp_args,
-        kwargs=mp_kwargs
+
+
+def _start_autoscaler(context, supervisor: WorkerSupervisor, topic: str, metrics: Optional[ServiceMetrics]):
+    """Starts scaling of workers by consumer lag, returns the autoscaler and its lag probe or Nones if disabled"""
+    if context.autoscaling_settings is None:
+        return None, None
+    lag_probe = context.lag_probe_factory()
+    lag_probe.__enter__()
+    autoscaler = LagAutoscaler(
+        supervisor,
+        partial(total_lag, lag_probe, [topic]),
+        metrics=metrics,
+        **context.autoscaling_settings
     )
+    autoscaler.start()
+    print(f'Workers are scaled between {autoscaler.min_workers} and {autoscaler.max_workers} by consumer lag')
+    return autoscaler, lag_probe
 
-    consume_publish_process.start()
-    if consume_publish_process.is_alive():
-        print(f'Process {PROCESS_NAME} is collecting web metrics...')
-    timeout = 5
-    while True:
-        try:
-            user_input = input('Type "quit" and press enter to exit... \n')
-        except KeyboardInterrupt:
-            user_input = 'quit'
-        if user_input == 'quit':
-            print('Stopping process execution...')
-            consume_publish_process.terminate()
-            time.sleep(timeout)
-        if consume_publish_process.is_alive():
-            print('Still alive after SIGTERM! Lets kill this thing!')
-            consume_publish_process.kill()
-            time.sleep(timeout)
-        if consume_publish_process.is_alive():
-            print("It's a zombie! You've made it, you deal with it! I'm out!")
-        if not consume_publish_process.is_alive():
-            msg = ' '.join((f'{PROCESS_NAME} stopped successfully.',
-                            f'Exit code: {consume_publish_process.exitcode}.'))
-            print(msg)
-        sys.exit(0)
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _wait_for_shutdown(supervisor: WorkerSupervisor, daemon: bool) -> None:
+    """Returns when user types quit, on SIGTERM or SIGINT, or in daemon mode when all workers finish"""
+    # SIGTERM, e.g. from process manager on deploy, stops the service the same way as Ctrl+C
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        if daemon:
+            while supervisor.is_running():
+                time.sleep(1)
+            return
+        while input('Type "quit" and press enter to exit... \n') != 'quit':
+            pass
+    except KeyboardInterrupt:
+        pass
+
+
+def main() -> None:
+    args = _argument_parser().parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s | %(name)s >>> %(message)s',
+        datefmt='%d-%b-%Y %H:%M:%S'
+    )
+
+    context = service_context()
+    mp_kwargs = _worker_kwargs(context, args)
+    metrics_server = None
+    metrics_endpoint = context.metrics_endpoint
+    if metrics_endpoint is not None:
+        # shared counters shall exist before workers are started
+        mp_kwargs['metrics'] = ServiceMetrics()
+        metrics_server = MetricsServer(mp_kwargs['metrics'], *metrics_endpoint)
+        metrics_server.start()
+        print(f'Metrics are served at http://{metrics_endpoint[0]}:{metrics_endpoint[1]}/metrics')
+    # all workers are in the same consumer group, so that Kafka spreads partitions across them
+    supervisor = WorkerSupervisor(run_worker, workers=args.workers, kwargs=mp_kwargs, name=PROCESS_NAME)
+    supervisor.start()
+    print(f'{args.workers} process(es) {PROCESS_NAME} are collecting web metrics...')
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: supervisor.send_signal(signum))
+        print(f'Send SIGUSR1 to pid {os.getpid()} to profile workers')
+    autoscaler, lag_probe = _start_autoscaler(context, supervisor, args.topic, mp_kwargs.get('metrics'))
+
+    _wait_for_shutdown(supervisor, args.daemon)
+    print(f'Stopping process execution, waiting up to {context.shutdown_timeout}s for workers to store their batches...')
+    if autoscaler is not None:
+        autoscaler.stop()
+        lag_probe.__exit__(None, None, None)
+    exit_code = supervisor.stop(context.shutdown_timeout)
+    if metrics_server is not None:
+        metrics_server.stop()
+    msg = ' '.join((f'{PROCESS_NAME} stopped. Exit code: {exit_code}.',
+                    f'Exit codes of workers: {supervisor.exit_codes()}.'))
+    print(msg)
+    print(f'Throughput: {supervisor.stats()}')
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+import fcntl
+import logging
+import os
+import pickle
+import threading
+import time
+
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class SpoolFull(Exception):
+    """Raised when batch doesn't fit into the spool size limit."""
+
+
+class DiskSpool:
+    SUFFIX = '.spool'
+
+    def __init__(self, directory: Union[str, Path], max_bytes: int = 104857600, sync: bool = True):
+        """Append-only queue of batches on local disk, survives service restarts.
+
+        Every batch is a segment file written once: to a temporary file which is then
+        renamed, so that a crash never leaves a partially written segment. Segments are
+        named by sequence number, i.e. replayed in the order they were appended.
+
+        Args:
+            directory: folder with segment files, created if missing. Shall be used by
+                a single process at a time, see claim
+            max_bytes: max total size of segments
+            sync: if True, segment is flushed to disk before append returns
+
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._sync = sync
+        self._lock = threading.Lock()
+        for leftover in self.directory.glob('*.tmp'):
+            leftover.unlink()
+        self._segments: List[Tuple[Path, int, int]] = sorted(
+            (path, self._records(path), path.stat().st_size) for path in self.directory.glob(f'*{self.SUFFIX}')
+        )
+        self._next_sequence = int(self._segments[-1][0].name.split('-')[0]) + 1 if self._segments else 0
+        # set by claim
+        self._lock_file = None
+        if self._segments:
+            log.warning(f'Found {len(self._segments)} spooled batches in {self.directory}')
+
+    @classmethod
+    def claim(cls, base: Union[str, Path], **kwargs) -> 'DiskSpool':
+        """Opens spool in the first subfolder of base not used by other process.
+
+        Worker processes of the same service get separate spools this way, and a restarted
+        worker picks up the spool left by the crashed one.
+        """
+        base = Path(base)
+        base.mkdir(parents=True, exist_ok=True)
+        index = 0
+        while True:
+            directory = base / str(index)
+            directory.mkdir(exist_ok=True)
+            lock_file = open(directory / '.lock', 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                index += 1
+                continue
+            spool = cls(directory, **kwargs)
+            # lock is held as long as the file is open
+            spool._lock_file = lock_file
+            return spool
+
+    def close(self) -> None:
+        """Releases spool claimed by claim, so that other process could use it. Spooled batches stay on disk"""
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def append(self, batch: Any) -> None:
+        """Stores batch at the end of the queue
+
+        Raises:
+            SpoolFull: if the batch exceeds max_bytes together with already spooled ones
+        """
+        data = pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._bytes() + len(data) > self.max_bytes:
+                raise SpoolFull(f'Spool {self.directory} is full: {self._bytes()} of {self.max_bytes} bytes used')
+            records = len(batch) if hasattr(batch, '__len__') else 1
+            path = self.directory / f'{self._next_sequence:012d}-{records}{self.SUFFIX}'
+            self._next_sequence += 1
+            tmp_path = path.with_suffix('.tmp')
+            with open(tmp_path, 'wb') as segment:
+                segment.write(data)
+                if self._sync:
+                    segment.flush()
+                    os.fsync(segment.fileno())
+            tmp_path.rename(path)
+            self._segments.append((path, records, len(data)))
+
+    def peek(self) -> Optional[Tuple[Path, Any]]:
+        """Returns the oldest segment and its batch or None if spool is empty"""
+        with self._lock:
+            if not self._segments:
+                return None
+            path = self._segments[0][0]
+        with open(path, 'rb') as segment:
+            return path, pickle.load(segment)
+
+    def remove(self, path: Path) -> None:
+        """Removes segment returned by peek, e.g. after the batch is replayed"""
+        with self._lock:
+            self._segments = [segment for segment in self._segments if segment[0] != path]
+            path.unlink()
+
+    def discard_oldest(self) -> None:
+        """Moves the oldest segment aside, e.g. when it can't be read"""
+        with self._lock:
+            if not self._segments:
+                return
+            path = self._segments.pop(0)[0]
+            path.rename(path.with_suffix('.bad'))
+
+    def depth(self) -> int:
+        """Number of spooled batches"""
+        with self._lock:
+            return len(self._segments)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'batches': len(self._segments),
+                'records': sum(segment[1] for segment in self._segments),
+                'bytes': self._bytes()
+            }
+
+    def _bytes(self) -> int:
+        return sum(segment[2] for segment in self._segments)
+
+    @classmethod
+    def _records(cls, path: Path) -> int:
+        try:
+            return int(path.name[:-len(cls.SUFFIX)].split('-')[1])
+        except (IndexError, ValueError):
+            return 0
+
+
+class SpooledWriter:
+    def __init__(
+            self,
+            write: Callable[[Any], Any],
+            spool: DiskSpool,
+            latency_budget: Optional[float] = None,
+            replay_rate: float = 0.0,
+            retry_interval: float = 1.0,
+            max_retry_interval: float = 60.0
+    ):
+        """Writes batches to DB, spools them to disk when DB fails or is slow
+
+        Once something is spooled, all subsequent batches go to spool too, so that
+        batches are stored in the order they came. A background thread replays spooled
+        batches, and direct writes resume when the spool is empty.
+
+        Args:
+            write: function storing batch, shall raise if batch isn't stored,
+                e.g. partial(db.insert, schema=..., table=..., raise_errors=True)
+            spool: where to keep batches which couldn't be written
+            latency_budget: seconds. If direct write took longer, subsequent batches go to
+                spool and are written by background thread at replay_rate until replay
+                of a batch fits into the budget
+            replay_rate: max number of records per second written by background thread, 0 - unlimited
+            retry_interval: seconds to wait after failed replay, doubled for every subsequent failure
+            max_retry_interval: upper bound of wait after failed replay
+
+        Usage:
+            writer = SpooledWriter(write, DiskSpool('spool'))
+            writer.start()
+            writer.write(batch)
+            ...
+            writer.stop()
+
+        """
+        self._write = write
+        self.spool = spool
+        self._latency_budget = latency_budget
+        self._replay_rate = replay_rate
+        self._retry_interval = retry_interval
+        self._max_retry_interval = max_retry_interval
+        # serializes direct writes and replays, so that batches are stored in order
+        self._write_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._wakeup = threading.Event()
+        self._drainer = None
+        # DB is over latency budget
+        self._slow = False
+        self.spooled = 0
+        self.replayed = 0
+
+    def start(self) -> None:
+        """Starts background thread replaying spooled batches"""
+        self._stopping.clear()
+        self._drainer = threading.Thread(target=self._drain, name='SpoolDrainer', daemon=True)
+        self._drainer.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stops background thread. Spooled batches stay on disk for the next start"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._drainer is not None:
+            self._drainer.join(timeout)
+
+    def write(self, batch: Any, direct: Optional[Callable[[], Any]] = None) -> bool:
+        """Stores batch in DB or in spool
+
+        Args:
+            batch: batch to store
+            direct: function making direct write of the batch, e.g. of the query already
+                built from it. Default is write function given to constructor
+
+        Returns:
+            True if batch is written to DB, False if it's spooled
+
+        Raises:
+            SpoolFull: if batch couldn't be written nor spooled. The error of the write
+                is logged in this case
+        """
+        with self._write_lock:
+            if not self._slow and not self.spool.depth():
+                started = time.monotonic()
+                try:
+                    if direct is not None:
+                        direct()
+                    else:
+                        self._write(batch)
+                    # written already, only subsequent batches go to spool
+                    self._slow = self._over_budget(time.monotonic() - started)
+                    return True
+                except Exception as e:
+                    log.error(f'Failed to write batch of {len(batch)} records, spooling it: {e}')
+            self.spool.append(batch)
+            self.spooled += len(batch)
+        self._wakeup.set()
+        return False
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.spool.stats(), spooled=self.spooled, replayed=self.replayed)
+
+    def _over_budget(self, elapsed: float) -> bool:
+        if self._latency_budget is None or elapsed <= self._latency_budget:
+            return False
+        log.warning(f'Write took {elapsed:.3f}s, over budget of {self._latency_budget}s. Spooling batches')
+        return True
+
+    def _drain(self) -> None:
+        retry_interval = self._retry_interval
+        while not self._stopping.is_set():
+            try:
+                entry = self.spool.peek()
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                log.error(f'Spooled batch is corrupted, skipping it: {e}')
+                self.spool.discard_oldest()
+                continue
+            if entry is None:
+                self._wakeup.wait(self._retry_interval)
+                self._wakeup.clear()
+                continue
+            path, batch = entry
+            started = time.monotonic()
+            try:
+                with self._write_lock:
+                    self._write(batch)
+                    self.spool.remove(path)
+                    self._slow = self._over_budget(time.monotonic() - started)
+            except Exception as e:
+                log.error(f'Failed to replay spooled batch, retrying in {retry_interval}s: {e}')
+                self._stopping.wait(retry_interval)
+                retry_interval = min(retry_interval * 2, self._max_retry_interval)
+                continue
+            retry_interval = self._retry_interval
+            self.replayed += len(batch)
+            log.info(f'Replayed spooled batch of {len(batch)} records, {self.spool.depth()} batches left')
+            if self._replay_rate:
+                # keeps average rate of replay
+                pause = len(batch) / self._replay_rate - (time.monotonic() - started)
+                if pause > 0:
+                    self._stopping.wait(pause)
@@ -0,0 +1,386 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    from ..src.metrics import ServiceMetrics
+except ImportError:
+    from src.metrics import ServiceMetrics
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class WorkerCounters:
+    FIELDS = ('messages', 'batches', 'cycles', 'spooled')
+
+    def __init__(self):
+        """Throughput counters shared between worker process and supervisor.
+
+        Shall be created before the worker process is started and passed to it.
+        """
+        self._values = {field: multiprocessing.Value('q', 0) for field in self.FIELDS}
+
+    def add(self, **increments: int) -> None:
+        """Increments counters, e.g. counters.add(messages=10, batches=1)"""
+        for field, increment in increments.items():
+            value = self._values[field]
+            with value.get_lock():
+                value.value += increment
+
+    def snapshot(self) -> Dict[str, int]:
+        return {field: value.value for field, value in self._values.items()}
+
+
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.counters = WorkerCounters()
+        self.process: Optional[multiprocessing.Process] = None
+        self.restarts = 0
+        self.finished = False
+
+
+class WorkerSupervisor:
+    def __init__(
+            self,
+            target: Callable[..., Any],
+            workers: int = 1,
+            kwargs: Optional[Dict[str, Any]] = None,
+            name: str = 'Worker',
+            max_restarts: int = 5,
+            restart_delay: float = 1.0,
+            check_interval: float = 1.0
+    ):
+        """Runs several worker processes, restarts crashed ones and combines their results
+
+        Args:
+            target: function run by every worker. Gets kwargs and 'counters' - WorkerCounters
+                to report throughput to. Worker exiting with code 0 is not restarted
+            workers: number of worker processes
+            kwargs: keyword arguments of target
+            name: prefix of worker process names
+            max_restarts: max number of restarts of every worker
+            restart_delay: seconds to wait before restarting crashed worker
+            check_interval: seconds between checks of workers state
+
+        Usage:
+            supervisor = WorkerSupervisor(run, workers=4, kwargs={...})
+            supervisor.start()
+            ...
+            supervisor.stop()
+
+        Note:
+            number of workers could be changed while running with scale_to, e.g. by LagAutoscaler
+
+        """
+        if workers < 1:
+            raise ValueError(f'Number of workers shall be positive, got: {workers}')
+        self._target = target
+        self._kwargs = kwargs or dict()
+        self._name = name
+        self._max_restarts = max_restarts
+        self._restart_delay = restart_delay
+        self._check_interval = check_interval
+        self._workers = [_Worker(i) for i in range(workers)]
+        # workers stopped by scale_to, kept for their counters
+        self._retired: List[_Worker] = []
+        self._next_index = workers
+        self._lock = threading.RLock()
+        self._stopping = threading.Event()
+        self._monitor = None
+
+    def start(self) -> None:
+        """Starts worker processes and a thread which watches them"""
+        with self._lock:
+            for worker in self._workers:
+                self._spawn(worker)
+        self._monitor = threading.Thread(target=self._watch, name=f'{self._name}Supervisor', daemon=True)
+        self._monitor.start()
+
+    def check(self) -> None:
+        """Restarts crashed workers. Called periodically by the supervisor thread"""
+        with self._lock:
+            for worker in self._workers:
+                if self._stopping.is_set():
+                    return
+                if worker.finished or worker.process is None or worker.process.is_alive():
+                    continue
+                exit_code = worker.process.exitcode
+                if exit_code == 0:
+                    log.info(f'{worker.process.name} finished its work')
+                    worker.finished = True
+                elif worker.restarts >= self._max_restarts:
+                    log.error(f'{worker.process.name} crashed with exit code {exit_code}, restart limit reached')
+                    worker.finished = True
+                else:
+                    log.warning(f'{worker.process.name} crashed with exit code {exit_code}, restarting...')
+                    worker.restarts += 1
+                    time.sleep(self._restart_delay)
+                    self._spawn(worker)
+
+    @property
+    def workers(self) -> int:
+        """Number of workers which are alive or are going to be restarted"""
+        with self._lock:
+            return sum(not worker.finished for worker in self._workers)
+
+    def scale_to(self, workers: int) -> int:
+        """Starts new workers or stops running ones, so that the given number of them is running
+
+        Workers are stopped with SIGTERM starting from the most recently started one, see stop.
+        Counters of stopped workers are kept in stats.
+
+        Args:
+            workers: required number of running workers
+
+        Returns:
+            number of running workers, unchanged if supervisor is stopping
+        """
+        if workers < 1:
+            raise ValueError(f'Number of workers shall be positive, got: {workers}')
+        with self._lock:
+            active = [worker for worker in self._workers if not worker.finished]
+            if self._stopping.is_set():
+                return len(active)
+            for _ in range(workers - len(active)):
+                worker = _Worker(self._next_index)
+                self._next_index += 1
+                self._workers.append(worker)
+                self._spawn(worker)
+            for worker in reversed(active[workers:]):
+                self._workers.remove(worker)
+                self._retired.append(worker)
+                worker.finished = True
+                if worker.process is not None and worker.process.is_alive():
+                    worker.process.terminate()
+                    log.info(f'Stopped {worker.process.name} to scale down')
+            log.info(f'Number of workers scaled from {len(active)} to {workers}')
+            return workers
+
+    def send_signal(self, signum: int) -> None:
+        """Sends signal to all running workers, e.g. SIGUSR1 to start profiling"""
+        with self._lock:
+            for worker in self._workers:
+                if worker.process is not None and worker.process.is_alive():
+                    os.kill(worker.process.pid, signum)
+
+    def is_running(self) -> bool:
+        """True if at least one worker is alive or is going to be restarted"""
+        with self._lock:
+            return any(not worker.finished for worker in self._workers)
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Waits until all workers are finished
+
+        Returns:
+            True if all workers are finished, False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.is_running():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(min(self._check_interval, 0.1))
+        return True
+
+    def stop(self, timeout: float = 5.0) -> int:
+        """Stops workers: first with SIGTERM, then with SIGKILL if still alive after timeout
+
+        Workers handling SIGTERM, e.g. service.run_worker, finish their current work and exit,
+        so timeout shall be long enough for that. Killed workers lose their current work
+
+        Returns:
+            combined exit code, see exit_code
+        """
+        self._stopping.set()
+        with self._lock:
+            processes = [
+                worker.process for worker in self._workers + self._retired if worker.process is not None
+            ]
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            self._wait(processes, timeout)
+            for process in processes:
+                if process.is_alive():
+                    log.warning(f'{process.name} still alive after SIGTERM! Killing it')
+                    process.kill()
+            self._wait(processes, timeout)
+            for worker in self._workers:
+                worker.finished = True
+        return self.exit_code()
+
+    def exit_code(self) -> Optional[int]:
+        """Returns 0 if all workers exited successfully, the first non-zero code otherwise.
+
+        None if some worker is still running
+        """
+        codes = self.exit_codes()
+        if any(code is None for code in codes):
+            return None
+        return next((code for code in codes if code != 0), 0)
+
+    def exit_codes(self) -> List[Optional[int]]:
+        with self._lock:
+            return [worker.process.exitcode if worker.process else None for worker in self._workers]
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns throughput counters of all workers, summed up and per worker"""
+        with self._lock:
+            workers = [
+                dict(worker.counters.snapshot(), restarts=worker.restarts) for worker in self._workers
+            ]
+            retired = [
+                dict(worker.counters.snapshot(), restarts=worker.restarts) for worker in self._retired
+            ]
+        total = {
+            field: sum(worker[field] for worker in workers + retired)
+            for field in WorkerCounters.FIELDS + ('restarts',)
+        }
+        total['workers'] = workers
+        return total
+
+    def _spawn(self, worker: _Worker) -> None:
+        worker.process = multiprocessing.Process(
+            target=self._target,
+            kwargs=dict(self._kwargs, counters=worker.counters),
+            name=f'{self._name}-{worker.index}'
+        )
+        worker.process.start()
+        log.info(f'Started {worker.process.name}, pid: {worker.process.pid}')
+
+    def _watch(self) -> None:
+        while not self._stopping.is_set() and self.is_running():
+            self.check()
+            self._stopping.wait(self._check_interval)
+
+    @staticmethod
+    def _wait(processes: List[multiprocessing.Process], timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+
+
+class LagAutoscaler:
+    def __init__(
+            self,
+            supervisor: WorkerSupervisor,
+            lag_probe: Callable[[], int],
+            min_workers: int = 1,
+            max_workers: int = 4,
+            scale_up_lag: int = 10000,
+            scale_down_lag: int = 1000,
+            sustain: float = 60.0,
+            cooldown: float = 120.0,
+            check_interval: float = 10.0,
+            metrics: Optional[ServiceMetrics] = None
+    ):
+        """Adds a worker when consumer lag stays high and removes one when it stays low
+
+        Number of workers changes by one at a time and only after lag stays beyond
+        the threshold for 'sustain' seconds, so that short spikes don't make workers
+        restart back and forth. Workers beyond the number of topic partitions stay idle,
+        so max_workers shall not exceed it.
+
+        Args:
+            supervisor: runs the workers
+            lag_probe: callable without args returning total lag of the consumer group
+                in messages, e.g. based on Consumer.lag
+            min_workers: workers are never scaled below this number
+            max_workers: workers are never scaled above this number
+            scale_up_lag: a worker is added when lag stays above this number of messages
+            scale_down_lag: a worker is removed when lag stays below this number of messages
+            sustain: seconds lag shall stay beyond a threshold before scaling
+            cooldown: min seconds between changes of the number of workers
+            check_interval: seconds between lag measurements
+            metrics: if given, lag and number of workers are recorded in it
+
+        Usage:
+            autoscaler = LagAutoscaler(supervisor, probe, min_workers=1, max_workers=8)
+            autoscaler.start()
+            ...
+            autoscaler.stop()
+
+        """
+        if not 1 <= min_workers <= max_workers:
+            raise ValueError(f'Expected 1 <= min workers <= max workers, got: {min_workers}, {max_workers}')
+        if scale_down_lag >= scale_up_lag:
+            raise ValueError(f'Scale down lag shall be below scale up lag, got: {scale_down_lag}, {scale_up_lag}')
+        self._supervisor = supervisor
+        self._lag_probe = lag_probe
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.scale_up_lag = scale_up_lag
+        self.scale_down_lag = scale_down_lag
+        self._sustain = sustain
+        self._cooldown = cooldown
+        self._check_interval = check_interval
+        self._metrics = metrics
+        self._above_since: Optional[float] = None
+        self._below_since: Optional[float] = None
+        self._last_scaled: Optional[float] = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def decide(self, lag: int, workers: int, now: Optional[float] = None) -> Optional[int]:
+        """Returns the number of workers to scale to, None if it shall stay unchanged
+
+        Args:
+            lag: measured lag in messages
+            workers: current number of workers
+            now: time.monotonic() moment of the measurement
+        """
+        now = time.monotonic() if now is None else now
+        if workers < self.min_workers or workers > self.max_workers:
+            return min(max(workers, self.min_workers), self.max_workers)
+        if lag > self.scale_up_lag:
+            self._below_since = None
+            self._above_since = now if self._above_since is None else self._above_since
+            sustained, target = now - self._above_since >= self._sustain, workers + 1
+        elif lag < self.scale_down_lag:
+            self._above_since = None
+            self._below_since = now if self._below_since is None else self._below_since
+            sustained, target = now - self._below_since >= self._sustain, workers - 1
+        else:
+            self._above_since = self._below_since = None
+            return
+        cooled_down = self._last_scaled is None or now - self._last_scaled >= self._cooldown
+        if sustained and cooled_down and self.min_workers <= target <= self.max_workers:
+            return target
+
+    def check(self) -> None:
+        """Measures lag and scales workers if needed. Called periodically by the autoscaler thread"""
+        try:
+            lag = self._lag_probe()
+        except Exception as e:
+            log.warning(f'Failed to measure consumer lag, workers are not scaled: {e}')
+            return
+        workers = self._supervisor.workers
+        target = self.decide(lag, workers)
+        if target is not None:
+            log.info(f'Consumer lag is {lag} messages, scaling workers from {workers} to {target}')
+            workers = self._supervisor.scale_to(target)
+            self._last_scaled = time.monotonic()
+            # the new number of workers shall prove itself during the whole sustain period
+            self._above_since = self._below_since = None
+        if self._metrics is not None:
+            self._metrics.consumer_lag.set(lag)
+            self._metrics.workers.set(workers)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._watch, name='LagAutoscaler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _watch(self) -> None:
+        while not self._stopping.is_set() and self._supervisor.is_running():
+            self.check()
+            self._stopping.wait(self._check_interval)
@@ -8,13 +8,25 @@ from tests.mocks.consumer import consumer
 @pytest.mark.integration
 def test_db_wrapper_integration(db_client):
     data = consumer.fetch_latest()
-    inserted_rows = db_client.insert(data, schema=SCHEMA, table=TABLE)
+    inserted_rows = list(db_client.insert(data, schema=SCHEMA, table=TABLE, returning='rows'))
     for row in inserted_rows:
         assert row in EXPECTED, f'Row from DB doesnt match with expected: {row}'
     for row in EXPECTED:
         assert row in inserted_rows, f'Expected row is missing in DB: {row}'
 
 
+@pytest.mark.integration
+def test_db_wrapper_query(db_client):
+    db_client.insert(consumer.fetch_latest(), schema=SCHEMA, table=TABLE)
+    rows = [
+        tuple(row) for row in db_client.query(
+            SCHEMA, TABLE, url='https://www.monedo.com/', since=datetime.datetime(2021, 1, 1), fetch_size=2
+        ) if row.comment == 'test'
+    ]
+    for row in EXPECTED:
+        assert row in rows, f'Expected row is missing in DB: {row}'
+
+
 EXPECTED = [
     (
         datetime.datetime(2021, 1, 1, 0, 0),
@@ -0,0 +1,20 @@
+import json
+
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+from kafka import TopicPartition
+
+
+def make_poll_result(values: List[Any], topic: str = 'website-metrics', partition: int = 0, offset: int = 0) -> Dict:
+    """Builds result of KafkaConsumer.poll with records of a single partition"""
+    records = [
+        SimpleNamespace(
+            topic=topic,
+            partition=partition,
+            offset=offset + i,
+            value=value,
+            serialized_value_size=len(json.dumps(value).encode('utf-8'))
+        ) for i, value in enumerate(values)
+    ]
+    return {TopicPartition(topic, partition): records} if records else {}
@@ -0,0 +1,10 @@
+import pytest
+
+from src import postgres_wrapper
+
+
+@pytest.fixture(autouse=True)
+def forget_provisioned_tables():
+    """Every test starts as a fresh process which hasn't created any table yet"""
+    postgres_wrapper._provisioned_tables.clear()
+    yield
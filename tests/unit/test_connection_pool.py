@@ -0,0 +1,85 @@
+import pytest
+
+from unittest.mock import MagicMock
+
+from src.connection_pool import ConnectionPool, PoolTimeoutError
+from src.postgres_wrapper import SQLDatabaseWrapper
+
+
+def _connection(**connection_params):
+    connection = MagicMock()
+    connection.closed = 0
+    return connection
+
+
+@pytest.mark.unit
+def test_connection_is_reused():
+    connect = MagicMock(side_effect=_connection)
+    pool = ConnectionPool(connect, max_size=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert first is second
+    assert connect.call_count == 1
+    assert pool.stats()['checkouts'] == 2
+
+
+@pytest.mark.unit
+def test_connection_recycled_after_lifetime():
+    connect = MagicMock(side_effect=_connection)
+    pool = ConnectionPool(connect, max_size=1, max_lifetime=0)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert first is not second
+    first.close.assert_called_once()
+    assert pool.stats()['recycled'] == 1
+
+
+@pytest.mark.unit
+def test_broken_connection_is_discarded():
+    pool = ConnectionPool(MagicMock(side_effect=_connection), max_size=1)
+    with pool.connection() as connection:
+        connection.closed = 2
+    with pytest.raises(RuntimeError):
+        with pool.connection() as connection:
+            connection.rollback.side_effect = RuntimeError('connection lost')
+            raise RuntimeError('connection lost')
+    stats = pool.stats()
+    assert stats['discarded'] == 2
+    assert stats['size'] == 0
+
+
+@pytest.mark.unit
+def test_connection_kept_after_query_error():
+    pool = ConnectionPool(MagicMock(side_effect=_connection), max_size=1)
+    with pytest.raises(RuntimeError):
+        with pool.connection() as connection:
+            raise RuntimeError('syntax error')
+    connection.rollback.assert_called_once()
+    assert pool.stats()['idle'] == 1
+
+
+@pytest.mark.unit
+def test_checkout_timeout_when_exhausted():
+    pool = ConnectionPool(MagicMock(side_effect=_connection), max_size=1, checkout_timeout=0.01)
+    with pool.connection():
+        with pytest.raises(PoolTimeoutError):
+            with pool.connection():
+                pass
+    assert pool.stats()['timeouts'] == 1
+
+
+@pytest.mark.unit
+def test_wrapper_keeps_connection_between_queries():
+    db_lib = MagicMock()
+    db_lib.connect.side_effect = _connection
+    db = SQLDatabaseWrapper('host', 'port', 'user', 'password', 'mock-db')
+    db.execute_sql('SELECT 1', db_lib=db_lib)
+    db.execute_sql('SELECT 2', db_lib=db_lib)
+    db_lib.connect.assert_called_once_with(**db._connection_params)
+    assert db.pool_stats()['idle'] == 1
+    db.close()
+    assert db.pool_stats() == {}
@@ -0,0 +1,147 @@
+import threading
+import time
+
+import pytest
+
+from unittest.mock import MagicMock
+
+from kafka import TopicPartition
+
+from src.consumer import Consumer
+from src.scheduler import FlushScheduler
+from tests.mocks.consumer import valid_data
+from tests.mocks.kafka_lib_mock import make_poll_result
+
+
+def _consumer(*poll_results):
+    consumer = Consumer('website-metrics', security_protocol='PLAINTEXT')
+    consumer._consumer = MagicMock()
+    consumer._consumer.poll.side_effect = list(poll_results) + [{}]
+    return consumer
+
+
+@pytest.mark.unit
+def test_iter_batches_limits_number_of_records():
+    consumer = _consumer(make_poll_result(valid_data[:2]), make_poll_result(valid_data[2:]))
+    batches = list(consumer.iter_batches(max_records=2, max_linger=60))
+    assert batches == [valid_data[:2], valid_data[2:]]
+    assert consumer._consumer.poll.call_args_list[0][1]['max_records'] == 2
+
+
+@pytest.mark.unit
+def test_iter_batches_limits_size_of_batch():
+    consumer = _consumer(*[make_poll_result([value]) for value in valid_data])
+    batches = list(consumer.iter_batches(max_records=100, max_bytes=1, max_linger=60))
+    assert batches == [[value] for value in valid_data]
+
+
+@pytest.mark.unit
+def test_iter_batches_commits_after_batch_is_processed():
+    consumer = _consumer(make_poll_result(valid_data[:1]), make_poll_result(valid_data[1:2]))
+    batches = consumer.iter_batches(max_records=1)
+    next(batches)
+    consumer._consumer.commit.assert_not_called()
+    next(batches)
+    assert consumer._consumer.commit.call_count == 1
+
+
+@pytest.mark.unit
+def test_iter_batches_stops_when_drained():
+    consumer = _consumer()
+    assert list(consumer.iter_batches()) == []
+    consumer._consumer.commit.assert_not_called()
+
+
+@pytest.mark.unit
+def test_iter_batches_commits_only_processed_batches():
+    consumer = _consumer(
+        make_poll_result(valid_data[:2], offset=10),
+        make_poll_result(valid_data[2:], offset=12),
+        make_poll_result(valid_data[:1], partition=1, offset=5)
+    )
+    batches = consumer.iter_batches(max_records=2, commit=False)
+    first = next(batches)
+    assert list(first.offsets) == [10, 11]
+    next(batches)
+    consumer._consumer.commit.assert_not_called()
+    consumer.mark_processed(first)
+    assert list(batches) == []
+    committed = consumer._consumer.commit.call_args[0][0]
+    assert {tp.partition: meta.offset for tp, meta in committed.items()} == {0: 12}
+
+
+@pytest.mark.unit
+def test_fetch_latest_returns_records_fetched_by_poll():
+    consumer = _consumer(make_poll_result(valid_data[:1]))
+    iterated = make_poll_result(valid_data[1:], offset=1)
+    consumer._consumer.__iter__.return_value = iter(next(iter(iterated.values())))
+    # offsets are committed only for records given to the caller
+    consumer._consumer.commit.side_effect = lambda: committed.extend(messages)
+    committed = list()
+    messages = consumer.fetch_latest()
+    assert messages == valid_data
+    assert committed == valid_data
+    assert messages.next_offsets() == {('website-metrics', 0): len(valid_data)}
+
+
+@pytest.mark.unit
+def test_rewind_returns_to_committed_offsets():
+    consumer = _consumer()
+    consumer._consumer.assignment.return_value = {TopicPartition('website-metrics', 0)}
+    consumer._consumer.committed.return_value = 7
+    consumer.rewind()
+    consumer._consumer.seek.assert_called_once_with(TopicPartition('website-metrics', 0), 7)
+
+
+@pytest.mark.unit
+def test_lag_of_all_partitions_of_topic():
+    consumer = _consumer()
+    consumer._consumer.partitions_for_topic.return_value = {0, 1}
+    first, second = TopicPartition('website-metrics', 0), TopicPartition('website-metrics', 1)
+    consumer._consumer.end_offsets.return_value = {first: 120, second: 30}
+    consumer._consumer.committed.side_effect = lambda partition: {first: 100, second: None}[partition]
+    consumer._consumer.beginning_offsets.return_value = {second: 10}
+    assert consumer.lag(['website-metrics']) == {('website-metrics', 0): 20, ('website-metrics', 1): 20}
+    consumer._consumer.beginning_offsets.assert_called_once_with([second])
+
+
+@pytest.mark.unit
+def test_lag_of_assigned_partitions():
+    consumer = _consumer()
+    partition = TopicPartition('website-metrics', 3)
+    consumer._consumer.assignment.return_value = {partition}
+    consumer._consumer.end_offsets.return_value = {partition: 5}
+    consumer._consumer.committed.return_value = 5
+    assert consumer.lag() == {('website-metrics', 3): 0}
+    consumer._consumer.assignment.return_value = set()
+    assert consumer.lag() == {}
+
+
+@pytest.mark.unit
+def test_iter_batches_gives_away_fetched_messages_when_stopped():
+    stop = threading.Event()
+    consumer = _consumer()
+
+    def poll(**kwargs):
+        stop.set()
+        return make_poll_result(valid_data[:1])
+
+    consumer._consumer.poll.side_effect = poll
+    batches = list(consumer.iter_batches(max_records=2, max_linger=60, stop=stop))
+    assert batches == [valid_data[:1]]
+    assert consumer._consumer.poll.call_count == 1
+
+
+@pytest.mark.unit
+def test_iter_batches_ends_cycle_under_continuous_load():
+    consumer = _consumer()
+
+    def poll(**kwargs):
+        time.sleep(0.01)
+        return make_poll_result(valid_data[:1])
+
+    consumer._consumer.poll.side_effect = poll
+    scheduler = FlushScheduler(max_records=1000, max_staleness=60, max_cycle=0.1)
+    batches = list(consumer.iter_batches(scheduler=scheduler))
+    assert len(batches) == 1 and batches[0]
+    assert [flush.reason for flush in scheduler.flushes] == ['cycle']
@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from pathlib import Path
+
+from src.context import ServiceContext
+from src.postgres_wrapper import WebMonitoringDBWrapper
+from utils.env_config import read_config
+
+
+# import of the service module shall not read config or load client libraries
+HEAVY_MODULES = ('yaml', 'kafka', 'psycopg2', 'numpy')
+
+_PROJECT_ROOT = Path(__file__).parent.parent.parent
+
+
+def _modules_loaded_by_service_import() -> str:
+    code = '; '.join((
+        'import sys',
+        'import src.service',
+        f'print(*(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+    ))
+    # without providers, reading config on import would fail
+    environ = {k: v for k, v in os.environ.items() if not k.endswith('SERVICE_PROVIDER')}
+    environ['PYTHONPATH'] = str(_PROJECT_ROOT)
+    result = subprocess.run(
+        [sys.executable, '-c', code], cwd=_PROJECT_ROOT, env=environ, capture_output=True, text=True, check=True
+    )
+    return result.stdout
+
+
+@pytest.mark.unit
+def test_service_import_has_no_side_effects():
+    assert _modules_loaded_by_service_import().split() == []
+
+
+@pytest.mark.unit
+def test_context_builds_clients_on_first_use():
+    context = ServiceContext(read_config(), storage_provider='docker', broker_provider='docker', environ={})
+    assert context.database is context.database
+    db = context.database('mock-db')
+    assert isinstance(db, WebMonitoringDBWrapper)
+    assert db._connection_params['host'] == 'localhost'
+    assert context.consumer_factory.keywords['bootstrap_servers'] == 'localhost:9092'
+    assert context.scheduler_settings['max_idle_sleep'] == context.sleep_between_requests
+
+
+@pytest.mark.unit
+def test_context_requires_known_provider():
+    context = ServiceContext({'Metrics storage endpoint': {'docker': {}}}, environ={})
+    with pytest.raises(ValueError, match='STORAGE_SERVICE_PROVIDER'):
+        context.storage_settings
@@ -0,0 +1,120 @@
+import json
+import multiprocessing
+
+import pytest
+
+from unittest.mock import MagicMock
+
+from src.dead_letter import DeadLetterSink, JsonlDeadLetterSink
+from src.postgres_wrapper import WebMonitoringDBWrapper
+from src.service import SCHEMA, TABLE
+from tests.mocks.consumer import valid_data
+
+
+class _InvalidDatetime(Exception):
+    pgcode = '22007'
+
+
+def _db_lib_rejecting(marker):
+    def execute(sql, args=None):
+        if marker in sql:
+            raise _InvalidDatetime(f'invalid input syntax for type timestamp: "{marker}"')
+
+    cursor = MagicMock()
+    cursor.execute.side_effect = execute
+    cursor.fetchall.return_value = []
+    db_lib = MagicMock()
+    db_lib.connect.return_value.closed = 0
+    db_lib.connect.return_value.cursor.return_value.__enter__.return_value = cursor
+    return db_lib, cursor
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('record', [
+    'not a dict',
+    dict(valid_data[0], unknown='key'),
+    dict(valid_data[0], url=None),
+    dict(valid_data[0], request_timestamp='yesterday'),
+    dict(valid_data[0], resp_status_code='OK'),
+    dict(valid_data[0], pattern_found='maybe'),
+])
+def test_invalid_records_are_detected(record):
+    assert WebMonitoringDBWrapper.validate_record(record) is not None
+
+
+@pytest.mark.unit
+def test_valid_records_pass_validation():
+    assert all(WebMonitoringDBWrapper.validate_record(record) is None for record in valid_data)
+
+
+@pytest.mark.unit
+def test_invalid_record_does_not_reject_batch():
+    db_lib, cursor = _db_lib_rejecting('never')
+    dead_letters = DeadLetterSink()
+    db = WebMonitoringDBWrapper(
+        'host', 'port', 'user', 'password', 'mock-db', provisioning='startup', dead_letters=dead_letters
+    )
+    db.insert(valid_data + [dict(valid_data[0], unknown='key')], schema=SCHEMA, table=TABLE, db_lib=db_lib)
+    cursor.execute.assert_called_once()
+    assert dead_letters.count == 1
+
+
+@pytest.mark.unit
+def test_batch_rejected_by_db_is_bisected():
+    db_lib, cursor = _db_lib_rejecting('2021-13-01')
+    dead_letters = DeadLetterSink()
+    db = WebMonitoringDBWrapper(
+        'host', 'port', 'user', 'password', 'mock-db', provisioning='startup', dead_letters=dead_letters
+    )
+    bad = dict(valid_data[0], request_timestamp='2021-13-01 00:00:00')
+    data = [valid_data[0]] * 6 + [bad] + [valid_data[1]]
+    # let the bad record reach DB
+    db.validate_record = lambda record: None
+    db.insert(data, schema=SCHEMA, table=TABLE, db_lib=db_lib)
+    assert dead_letters.count == 1
+    inserted = [call[0][0].count('), (') + 1 for call in cursor.execute.call_args_list if '2021-13-01' not in call[0][0]]
+    assert sum(inserted) == 7
+    assert cursor.execute.call_count <= 2 * 3 + 1
+
+
+@pytest.mark.unit
+def test_records_rejected_by_db_are_not_reported_written():
+    db_lib, cursor = _db_lib_rejecting('2021-13-01')
+    db = WebMonitoringDBWrapper(
+        'host', 'port', 'user', 'password', 'mock-db', provisioning='startup', dead_letters=DeadLetterSink()
+    )
+    bad = dict(valid_data[0], request_timestamp='2021-13-01 00:00:00')
+    db.validate_record = lambda record: None
+    written = list()
+    db.write_prepared(db.prepare_insert(valid_data + [bad], SCHEMA, TABLE), db_lib=db_lib, written=written)
+    assert sorted(map(repr, written)) == sorted(map(repr, valid_data))
+
+
+@pytest.mark.unit
+def test_jsonl_sink_appends_records_with_reason(tmp_path):
+    path = tmp_path / 'dead' / 'letters.jsonl'
+    sink = JsonlDeadLetterSink(path)
+    sink.send(valid_data[0], 'reason 1')
+    sink.send('garbage', 'reason 2')
+    sink.close()
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(line['record'], line['reason']) for line in lines] == [(valid_data[0], 'reason 1'), ('garbage', 'reason 2')]
+
+
+def _append_dead_letters(path, count):
+    sink = JsonlDeadLetterSink(path)
+    for i in range(count):
+        sink.send({'payload': 'x' * 10000, 'i': i}, 'reason')
+    sink.close()
+
+
+@pytest.mark.unit
+def test_jsonl_sink_shared_by_processes_keeps_lines_whole(tmp_path):
+    path = tmp_path / 'letters.jsonl'
+    processes = [multiprocessing.Process(target=_append_dead_letters, args=(path, 50)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(lines) == 200
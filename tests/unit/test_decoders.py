@@ -0,0 +1,80 @@
+import json
+import pickle
+
+import pytest
+
+from unittest.mock import MagicMock
+
+from src.decoders import DictDecoder, InvalidMessage, RowDecoder, json_loads
+from src.postgres_wrapper import WebMonitoringDBWrapper
+from src.service import SCHEMA, TABLE
+from tests.mocks.consumer import valid_data
+
+
+KEYS = tuple(WebMonitoringDBWrapper.DATA_TO_DB)
+
+
+def _encode(value) -> bytes:
+    return json.dumps(value).encode('utf-8')
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('library', ['auto', 'json'])
+def test_dict_decoder_decodes_json(library):
+    decoder = DictDecoder(library)
+    assert [decoder(_encode(record)) for record in valid_data] == valid_data
+
+
+@pytest.mark.unit
+def test_row_decoder_follows_column_order():
+    decoder = RowDecoder(KEYS)
+    record = dict(valid_data[2])
+    del record['comment']
+    row = decoder(_encode(record))
+    assert row == tuple(record.get(key) for key in KEYS)
+    assert row[KEYS.index('comment')] is None
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('value', [b'{"url": ', b'[1, 2]', _encode(dict(valid_data[0], unknown='key'))])
+def test_row_decoder_returns_invalid_message(value):
+    result = RowDecoder(KEYS)(value)
+    assert isinstance(result, InvalidMessage)
+    assert result.raw == value.decode('utf-8')
+
+
+@pytest.mark.unit
+def test_unknown_json_library_is_rejected():
+    with pytest.raises(ValueError):
+        json_loads('yaml')
+
+
+@pytest.mark.unit
+def test_decoder_survives_pickling():
+    decoder = pickle.loads(pickle.dumps(RowDecoder(KEYS, library='json')))
+    assert decoder(_encode(valid_data[0])) == tuple(valid_data[0][key] for key in KEYS)
+
+
+@pytest.mark.unit
+def test_rows_are_inserted_like_dicts():
+    rows = [tuple(record.get(key) for key in KEYS) for record in valid_data]
+    assert WebMonitoringDBWrapper.to_copy_buffer(rows).read() == WebMonitoringDBWrapper.to_copy_buffer(
+        valid_data).read()
+    cursor = MagicMock()
+    db_lib = MagicMock()
+    db_lib.connect.return_value.closed = 0
+    db_lib.connect.return_value.cursor.return_value.__enter__.return_value = cursor
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', provisioning='startup')
+    db.insert(rows, schema=SCHEMA, table=TABLE, db_lib=db_lib)
+    query = cursor.execute.call_args[0][0]
+    assert f'INSERT INTO {SCHEMA}.{TABLE}({", ".join(WebMonitoringDBWrapper.DATA_TO_DB.values())})' in query
+    assert "('2021-01-01 00:00:00', 'https://www.monedo.com/', 'Web metric collection service', NULL," in query
+
+
+@pytest.mark.unit
+def test_invalid_message_is_validated():
+    invalid = InvalidMessage('{"url": ', 'Not a valid JSON')
+    row = tuple(valid_data[0].get(key) for key in KEYS)
+    assert WebMonitoringDBWrapper.validate_record(invalid) == 'Not a valid JSON'
+    assert WebMonitoringDBWrapper.validate_record(row) is None
+    assert WebMonitoringDBWrapper.validate_record(row[:-1]) is not None
@@ -0,0 +1,103 @@
+import pytest
+import urllib.error
+import urllib.request
+
+from unittest.mock import MagicMock
+
+from src.consumer import Consumer
+from src.metrics import Counter, Histogram, MetricsServer, ServiceMetrics, parse_exposition
+from src.postgres_wrapper import WebMonitoringDBWrapper
+from src.service import SCHEMA, TABLE
+from tests.mocks.consumer import valid_data
+from utils.db_lib_mock import mock_db_lib, mock_db_active_cursor
+from tests.mocks.kafka_lib_mock import make_poll_result
+
+
+@pytest.mark.unit
+def test_counter_exposition_per_label():
+    counter = Counter('requests_total', 'Requests', 'stage', ('fetch', 'insert'))
+    counter.inc(label_value='insert')
+    counter.inc(2, label_value='insert')
+    assert counter.exposition() == [
+        '# HELP requests_total Requests',
+        '# TYPE requests_total counter',
+        'requests_total{stage="fetch"} 0',
+        'requests_total{stage="insert"} 3'
+    ]
+
+
+@pytest.mark.unit
+def test_histogram_exposition_is_cumulative():
+    histogram = Histogram('duration_seconds', 'Duration', (0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value)
+    samples = parse_exposition(histogram.exposition())
+    assert samples == {
+        'duration_seconds_bucket{le="0.1"}': 1,
+        'duration_seconds_bucket{le="1"}': 3,
+        'duration_seconds_bucket{le="+Inf"}': 4,
+        'duration_seconds_sum': 6.05,
+        'duration_seconds_count': 4
+    }
+
+
+@pytest.mark.unit
+def test_server_exposes_metrics():
+    metrics = ServiceMetrics()
+    metrics.messages.inc(5)
+    server = MetricsServer(metrics, port=0)
+    server.start()
+    try:
+        url = 'http://{}:{}'.format(*server.address)
+        with urllib.request.urlopen(f'{url}/metrics') as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            samples = parse_exposition(response.read().decode('utf-8').splitlines())
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f'{url}/other')
+    finally:
+        server.stop()
+    assert samples['web_metrics_messages_total'] == 5
+    assert samples['web_metrics_errors_total{stage="insert"}'] == 0
+
+
+@pytest.mark.unit
+def test_consumer_records_fetched_batches():
+    metrics = ServiceMetrics()
+    consumer = Consumer('website-metrics', metrics=metrics, security_protocol='PLAINTEXT')
+    consumer._consumer = MagicMock()
+    consumer._consumer.poll.side_effect = [make_poll_result(valid_data[:2]), make_poll_result(valid_data[2:]), {}]
+    batches = list(consumer.iter_batches(max_records=2, max_linger=60))
+    assert metrics.messages.value() == len(valid_data)
+    assert metrics.batches.value() == len(batches)
+    assert metrics.batch_size.count() == len(batches)
+    assert metrics.fetch_duration.count() == len(batches)
+    assert metrics.message_bytes.value() > 0
+
+
+@pytest.mark.unit
+def test_db_wrapper_records_insert_stages():
+    metrics = ServiceMetrics()
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', provisioning='startup', metrics=metrics)
+    db.insert(valid_data, schema=SCHEMA, table=TABLE, db_lib=mock_db_lib)
+    assert metrics.inserted_rows.value() == len(valid_data)
+    assert metrics.transform_duration.count() == 1
+    assert metrics.insert_duration.count() == 1
+    assert metrics.sql_duration.count() == 1
+    assert metrics.errors.value('insert') == 0
+
+
+@pytest.mark.unit
+def test_db_wrapper_records_failures():
+    metrics = ServiceMetrics()
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', provisioning='startup', metrics=metrics)
+    mock_db_active_cursor.execute.side_effect = RuntimeError('connection lost')
+    try:
+        with pytest.raises(RuntimeError):
+            db.insert(valid_data, schema=SCHEMA, table=TABLE, db_lib=mock_db_lib, raise_errors=True)
+    finally:
+        mock_db_active_cursor.execute.side_effect = None
+    assert db.insert([{'unknown': 1}], schema=SCHEMA, table=TABLE, db_lib=mock_db_lib) is None
+    assert metrics.errors.value('sql') == 1
+    assert metrics.errors.value('insert') == 1
+    assert metrics.errors.value('transform') == 1
+    assert metrics.inserted_rows.value() == 0
@@ -0,0 +1,92 @@
+import datetime
+
+import pytest
+
+from unittest.mock import MagicMock
+
+from src.partitions import PartitioningPolicy, expired_starts, partition_start, planned_ranges
+from src.postgres_wrapper import WebMonitoringDBWrapper
+from src.service import SCHEMA, TABLE
+
+
+NOW = datetime.datetime(2021, 12, 30, 13, 45)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('interval, expected', [
+    ('day', [(datetime.datetime(2021, 12, 30), datetime.datetime(2021, 12, 31)),
+             (datetime.datetime(2021, 12, 31), datetime.datetime(2022, 1, 1))]),
+    ('week', [(datetime.datetime(2021, 12, 27), datetime.datetime(2022, 1, 3)),
+              (datetime.datetime(2022, 1, 3), datetime.datetime(2022, 1, 10))]),
+    ('month', [(datetime.datetime(2021, 12, 1), datetime.datetime(2022, 1, 1)),
+               (datetime.datetime(2022, 1, 1), datetime.datetime(2022, 2, 1))]),
+])
+def test_planned_ranges(interval, expected):
+    assert planned_ranges(PartitioningPolicy(interval, ahead=1), NOW) == expected
+
+
+@pytest.mark.unit
+def test_only_partitions_ended_before_retention_are_expired():
+    policy = PartitioningPolicy('day', retention_days=2)
+    starts = [datetime.datetime(2021, 12, day) for day in (26, 27, 28, 29)]
+    assert expired_starts(policy, starts, NOW) == starts[:2]
+    assert expired_starts(PartitioningPolicy('day'), starts, NOW) == []
+
+
+@pytest.mark.unit
+def test_unknown_interval_is_rejected():
+    with pytest.raises(ValueError):
+        WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', partitioning=PartitioningPolicy('year'))
+
+
+def _db_lib_with_cursor(cursor):
+    db_lib = MagicMock()
+    db_lib.connect.return_value.closed = 0
+    db_lib.connect.return_value.cursor.return_value.__enter__.return_value = cursor
+    return db_lib
+
+
+PARTITIONS = [
+    ('p', f'{TABLE}_default'),
+    ('p', f'{TABLE}_p20211201'),
+    ('p', f'{TABLE}_p20211230'),
+]
+
+
+@pytest.mark.unit
+def test_partitions_are_created_ahead_and_expired():
+    cursor = MagicMock()
+    # partitions, then rows of created ranges in default partition
+    cursor.fetchall.side_effect = [PARTITIONS, [(False,)], [(False,)]]
+    policy = PartitioningPolicy('day', ahead=2, retention_days=7)
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', partitioning=policy)
+    result = db.manage_partitions(SCHEMA, TABLE, db_lib=_db_lib_with_cursor(cursor), now=NOW)
+    assert result == {'created': [f'{TABLE}_p20211231', f'{TABLE}_p20220101'], 'expired': [f'{TABLE}_p20211201']}
+    queries = [call[0][0] for call in cursor.execute.call_args_list]
+    assert 'PARTITION OF web_metrics.metrics FOR VALUES FROM' in queries[2]
+    assert 'DETACH' not in queries[2]
+    assert cursor.execute.call_args_list[2][0][1] == {
+        'start': datetime.datetime(2021, 12, 31), 'end': datetime.datetime(2022, 1, 1)
+    }
+    assert f'DROP TABLE IF EXISTS {SCHEMA}.{TABLE}_p20211201' in queries
+    # expired rows of default partition are deleted too
+    assert queries[-1] == f'DELETE FROM {SCHEMA}.{TABLE}_default WHERE time_stamp < %s'
+    assert cursor.execute.call_args_list[-1][0][1] == (datetime.datetime(2021, 12, 23),)
+    assert partition_start(TABLE, f'{TABLE}_default') is None
+
+
+@pytest.mark.unit
+def test_rows_in_default_partition_are_moved_to_created_one():
+    cursor = MagicMock()
+    # maintenance lapsed and rows of 2021-12-31 landed in default partition
+    cursor.fetchall.side_effect = [PARTITIONS, [(True,)]]
+    policy = PartitioningPolicy('day', ahead=1)
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', partitioning=policy)
+    result = db.manage_partitions(SCHEMA, TABLE, db_lib=_db_lib_with_cursor(cursor), now=NOW)
+    assert result == {'created': [f'{TABLE}_p20211231'], 'expired': []}
+    query = cursor.execute.call_args_list[-1][0][0]
+    steps = ['DETACH PARTITION', 'PARTITION OF', f'DELETE FROM {SCHEMA}.{TABLE}_default', 'INSERT INTO', 'ATTACH PARTITION']
+    positions = [query.index(step) for step in steps]
+    assert positions == sorted(positions)
+    # moved in one transaction
+    assert cursor.execute.call_count == 3
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+from functools import partial
+
+from src.pipeline import Pipeline
+from src.postgres_wrapper import WebMonitoringDBWrapper
+from src.service import SCHEMA, TABLE
+from tests.mocks.consumer import consumer, valid_data
+from utils.db_lib_mock import mock_db_lib, mock_db_active_cursor
+
+
+DELAY = 0.1
+BATCHES = 5
+
+
+def _slow_fetches(intervals):
+    for _ in range(BATCHES):
+        start = time.perf_counter()
+        time.sleep(DELAY)
+        data = consumer.fetch_latest()
+        intervals.append((start, time.perf_counter()))
+        yield data
+
+
+@pytest.mark.unit
+def test_fetch_overlaps_db_write():
+    fetches, writes = list(), list()
+
+    def slow_execute(sql, args=None):
+        start = time.perf_counter()
+        time.sleep(DELAY)
+        writes.append((start, time.perf_counter()))
+
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', provisioning='startup')
+    mock_db_active_cursor.execute.side_effect = slow_execute
+    try:
+        stats = Pipeline(
+            _slow_fetches(fetches),
+            partial(db.prepare_insert, schema=SCHEMA, table=TABLE),
+            partial(db.write_prepared, db_lib=mock_db_lib)
+        ).run()
+    finally:
+        mock_db_active_cursor.execute.side_effect = None
+        mock_db_active_cursor.execute.reset_mock()
+    assert stats['items'] == [BATCHES, BATCHES, BATCHES]
+    # next batch is fetched while the previous one is written
+    assert any(fetch[0] < write[1] and write[0] < fetch[1] for fetch in fetches for write in writes)
+    assert stats['wall'] < 0.8 * 2 * DELAY * BATCHES
+
+
+@pytest.mark.unit
+def test_backpressure_limits_items_in_flight():
+    fetched = list()
+    release = threading.Event()
+
+    def source():
+        for i in range(10):
+            fetched.append(i)
+            yield valid_data
+
+    def blocked_write(data):
+        release.wait(5)
+
+    pipeline = Pipeline(source(), blocked_write, queue_size=1)
+    thread = threading.Thread(target=pipeline.run)
+    thread.start()
+    time.sleep(DELAY)
+    # one item is being written, one waits in the queue and one waits for free place
+    assert len(fetched) == 3
+    release.set()
+    thread.join(5)
+    assert len(fetched) == 10
+
+
+@pytest.mark.unit
+def test_stage_error_stops_pipeline():
+    def failing_write(data):
+        raise RuntimeError('DB is gone')
+
+    with pytest.raises(RuntimeError):
+        Pipeline(iter([valid_data] * 10), failing_write, queue_size=1).run()
@@ -1,8 +1,13 @@
+import datetime
 import pytest
 
+from functools import partial
+from unittest.mock import MagicMock
+
 from src.service import SCHEMA, TABLE
 from src.postgres_wrapper import WebMonitoringDBWrapper
-from tests.mocks.db_lib_mock import mock_db_lib, mock_db_active_cursor
+from src.records import Batch, MetricRow
+from utils.db_lib_mock import mock_db_lib, mock_db_active_cursor
 from tests.mocks.consumer import consumer
 
 
@@ -13,6 +18,8 @@ def test_insert_query_creation():
     mock_db_lib.connect.assert_called_with(**db._connection_params)
     for part in EXPECTED_ARGS_INSERT:
         assert part in mock_db_active_cursor.execute.call_args_list[1][0][0]
+    # inserted rows are not sent back by default
+    assert 'RETURNING' not in mock_db_active_cursor.execute.call_args_list[1][0][0]
 
 
 @pytest.mark.unit
@@ -30,6 +37,226 @@ def test_delete_query_creation():
     db.delete_data(schema=SCHEMA, table=TABLE, db_lib=mock_db_lib, comment='test')
     for part in EXPECTED_ARGS_DELETE:
         assert part in mock_db_active_cursor.execute.call_args_list[0][0][0]
+    assert 'RETURNING' not in mock_db_active_cursor.execute.call_args_list[0][0][0]
+
+
+@pytest.mark.unit
+def test_copy_insert_query_creation():
+    mock_db_active_cursor.copy_expert.reset_mock()
+    mock_db_active_cursor.rowcount = 3
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', ingest_mode='copy')
+    result = db.insert(consumer.fetch_latest(), schema=SCHEMA, table=TABLE, db_lib=mock_db_lib)
+    assert result == 3
+    sql, buffer = mock_db_active_cursor.copy_expert.call_args[0]
+    assert sql == EXPECTED_COPY_QUERY
+    assert buffer.read() == EXPECTED_COPY_BUFFER
+
+
+@pytest.mark.unit
+def test_insert_returns_count_by_default():
+    cursor = MagicMock()
+    cursor.rowcount = 3
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', provisioning='startup')
+    assert db.insert(consumer.fetch_latest(), SCHEMA, TABLE, _db_lib_with_cursor(cursor)) == 3
+    cursor.fetchall.assert_not_called()
+
+
+@pytest.mark.unit
+def test_insert_returns_given_columns():
+    cursor = MagicMock()
+    cursor.fetchall.return_value = [('https://www.monedo.com/', 200)] * 3
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', provisioning='startup')
+    result = db.insert(
+        consumer.fetch_latest(), SCHEMA, TABLE, _db_lib_with_cursor(cursor), returning=('url', 'status_code')
+    )
+    assert result == cursor.fetchall.return_value
+    assert 'RETURNING url, status_code;' in cursor.execute.call_args[0][0]
+
+
+@pytest.mark.unit
+def test_insert_streams_returned_rows():
+    cursor = MagicMock()
+    cursor.fetchmany.side_effect = [[(1,), (2,)], [(3,)], []]
+    db_lib = _db_lib_with_cursor(cursor)
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', provisioning='startup')
+    rows = db.insert(consumer.fetch_latest(), SCHEMA, TABLE, db_lib, returning='rows')
+    # the query is sent before rows are read, the transaction is committed after that
+    assert 'RETURNING *;' in cursor.execute.call_args[0][0]
+    db_lib.connect.return_value.__exit__.assert_not_called()
+    assert list(rows) == [(1,), (2,), (3,)]
+    db_lib.connect.return_value.__exit__.assert_called_once_with(None, None, None)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('returning', ['rows', ('url',)])
+def test_copy_insert_rejects_returned_rows(returning):
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', ingest_mode='copy')
+    with pytest.raises(ValueError):
+        db.insert(consumer.fetch_latest(), SCHEMA, TABLE, mock_db_lib, returning=returning)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('returning', ['all', ('url', 'password'), ()])
+def test_unknown_returning_rejected(returning):
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db')
+    with pytest.raises(ValueError):
+        db.delete_data(SCHEMA, TABLE, mock_db_lib, returning=returning, comment='test')
+
+
+ROW = (
+    datetime.datetime(2021, 1, 1), 'https://www.monedo.com/', 'Web metric collection service',
+    datetime.timedelta(microseconds=123000), 200, '104.18.91.87', True, 'test'
+)
+
+
+@pytest.mark.unit
+def test_query_streams_rows_through_named_cursor():
+    cursor = MagicMock()
+    cursor.fetchmany.side_effect = [[ROW, ROW], [ROW], []]
+    db_lib = _db_lib_with_cursor(cursor)
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db')
+    since = datetime.datetime(2021, 1, 1)
+    rows = db.query(SCHEMA, TABLE, url='https://www.monedo.com/', status_code=(500, 503), since=since,
+                    fetch_size=2, db_lib=db_lib)
+    assert list(rows) == [MetricRow(*ROW)] * 3
+    assert db_lib.connect.return_value.cursor.call_args[0][0].startswith(f'{TABLE}_query_')
+    query, args = cursor.execute.call_args[0]
+    assert query == (
+        f'SELECT {", ".join(MetricRow._fields)} FROM {SCHEMA}.{TABLE} '
+        'WHERE url = %(url)s AND status_code = ANY(%(status_code)s) AND time_stamp >= %(since)s '
+        'ORDER BY time_stamp'
+    )
+    assert args == {'url': 'https://www.monedo.com/', 'status_code': [500, 503], 'since': since}
+    assert all(call[0] == (2,) for call in cursor.fetchmany.call_args_list)
+
+
+@pytest.mark.unit
+def test_query_yields_columnar_chunks():
+    cursor = MagicMock()
+    cursor.fetchmany.side_effect = [[ROW[:2], ROW[:2]], [ROW[:2]], []]
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db')
+    chunks = db.query(SCHEMA, TABLE, columns=('time_stamp', 'url'), columnar=True, db_lib=_db_lib_with_cursor(cursor))
+    assert list(chunks) == [
+        {'time_stamp': [ROW[0]] * 2, 'url': [ROW[1]] * 2},
+        {'time_stamp': [ROW[0]], 'url': [ROW[1]]}
+    ]
+    assert 'WHERE' not in cursor.execute.call_args[0][0]
+
+
+@pytest.mark.unit
+def test_query_rejects_unknown_columns():
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db')
+    with pytest.raises(ValueError):
+        db.query(SCHEMA, TABLE, columns=('url', 'password'), db_lib=mock_db_lib)
+
+
+@pytest.mark.unit
+def test_prepared_insert_sends_pages_of_parameters():
+    cursor = MagicMock()
+    cursor.rowcount = 2
+    db_lib = _db_lib_with_cursor(cursor)
+    db = WebMonitoringDBWrapper(
+        'host', 'port', 'user', 'password', 'mock-db', ingest_mode='prepared', provisioning='startup', page_size=2
+    )
+    assert db.insert(consumer.fetch_latest(), SCHEMA, TABLE, db_lib) == 4
+    assert db.insert(consumer.fetch_latest(), SCHEMA, TABLE, db_lib) == 4
+    queries = [call[0][0] for call in cursor.execute.call_args_list]
+    # statement is prepared only once per connection
+    assert queries[0].startswith(f'PREPARE insert_{SCHEMA}_{TABLE}(timestamp[], varchar[], varchar[], interval[]')
+    assert f'INSERT INTO {SCHEMA}.{TABLE}' in queries[0] and 'unnest($1, $2, $3, $4, $5, $6, $7, $8)' in queries[0]
+    assert queries[1:] == [f'EXECUTE insert_{SCHEMA}_{TABLE}(%s::timestamp[], %s::varchar[], %s::varchar[], '
+                           '%s::interval[], %s::int[], %s::varchar[], %s::boolean[], %s::varchar[])'] * 4
+    first_page, second_page = [call[0][1] for call in cursor.execute.call_args_list[1:3]]
+    assert first_page[1] == ['https://www.monedo.com/'] * 2
+    assert second_page[3] == [None]
+    assert db_lib.connect.call_count == 1
+
+
+@pytest.mark.unit
+def test_prepared_insert_rejects_returned_rows_and_bad_page_size():
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', ingest_mode='prepared')
+    with pytest.raises(ValueError):
+        db.insert(consumer.fetch_latest(), SCHEMA, TABLE, mock_db_lib, returning='rows')
+    with pytest.raises(ValueError):
+        WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', ingest_mode='prepared', page_size=0)
+
+
+@pytest.mark.unit
+def test_copy_buffer_escaping():
+    entry = {'url': 'https://a\tb/\n', 'comment': 'back\\slash', 'ip_address': None}
+    buffer = WebMonitoringDBWrapper.to_copy_buffer([entry])
+    assert buffer.read() == '\\N\thttps://a\\tb/\\n\t\\N\t\\N\t\\N\t\\N\t\\N\tback\\\\slash\n'
+
+
+@pytest.mark.unit
+def test_copy_buffer_rejects_unknown_keys():
+    with pytest.raises(KeyError):
+        WebMonitoringDBWrapper.to_copy_buffer([{'url': 'https://www.monedo.com/', 'unknown': 1}])
+
+
+def _db_lib_with_cursor(cursor):
+    db_lib = MagicMock()
+    db_lib.connect.return_value.closed = 0
+    db_lib.connect.return_value.cursor.return_value.__enter__.return_value = cursor
+    return db_lib
+
+
+class _UndefinedTable(Exception):
+    pgcode = '42P01'
+
+
+@pytest.mark.unit
+def test_table_provisioned_once_per_process():
+    cursor = MagicMock()
+    db_lib = _db_lib_with_cursor(cursor)
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db')
+    db.insert(consumer.fetch_latest(), schema=SCHEMA, table=TABLE, db_lib=db_lib)
+    db.insert(consumer.fetch_latest(), schema=SCHEMA, table=TABLE, db_lib=db_lib)
+    queries = [call[0][0] for call in cursor.execute.call_args_list]
+    assert len(queries) == 3
+    assert 'CREATE TABLE' in queries[0]
+    assert all('INSERT INTO' in query for query in queries[1:])
+
+
+@pytest.mark.unit
+def test_index_profile_creates_own_indexes_and_drops_others():
+    cursor = MagicMock()
+    db_lib = _db_lib_with_cursor(cursor)
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', index_profile='write-optimized')
+    db.create_table_if_not_exist('bench_schema', 'index_profile', db_lib)
+    query = cursor.execute.call_args[0][0]
+    assert 'CREATE INDEX IF NOT EXISTS index_profile_time_stamp_brin ON bench_schema.index_profile USING brin' in query
+    assert query.count('CREATE INDEX') == 1
+    assert 'DROP INDEX IF EXISTS bench_schema.index_profile_url;' in query
+    assert 'DROP INDEX IF EXISTS bench_schema.index_profile_url_time_stamp;' in query
+    assert 'index_profile_time_stamp_brin;' not in query
+
+
+@pytest.mark.unit
+def test_unknown_index_profile_rejected():
+    with pytest.raises(ValueError):
+        WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', index_profile='all')
+
+
+@pytest.mark.unit
+def test_startup_provisioning_sends_no_ddl_on_insert():
+    cursor = MagicMock()
+    db_lib = _db_lib_with_cursor(cursor)
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', provisioning='startup')
+    db.insert(consumer.fetch_latest(), schema=SCHEMA, table=TABLE, db_lib=db_lib)
+    cursor.execute.assert_called_once()
+    assert 'INSERT INTO' in cursor.execute.call_args[0][0]
+
+
+@pytest.mark.unit
+def test_missing_table_provisioned_again():
+    cursor = MagicMock()
+    cursor.execute.side_effect = [None, _UndefinedTable('relation does not exist'), None, None]
+    db_lib = _db_lib_with_cursor(cursor)
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db')
+    db.insert(consumer.fetch_latest(), schema=SCHEMA, table=TABLE, db_lib=db_lib)
+    queries = [call[0][0] for call in cursor.execute.call_args_list]
+    assert ['CREATE TABLE' in query for query in queries] == [True, False, True, False]
 
 
 EXPECTED_ARGS_INSERT = [
@@ -41,13 +268,97 @@ EXPECTED_ARGS_INSERT = [
     "('2021-01-01 00:00:00', 'https://www.monedo.com/', '104.18.91.87', '0:00:00.123456',"
     " '200', 'True', 'Web metric collection service', 'test'), ",
     "('2021-01-01 00:00:00', 'https://www.monedo.com/', NULL, NULL, '200', NULL,"
-    " 'Web metric collection service', 'test')",
-    "RETURNING *;"
+    " 'Web metric collection service', 'test')"
 ]
 
+EXPECTED_COPY_QUERY = (
+    "COPY web_metrics.metrics(time_stamp, url, agent, response_time, status_code, ip,"
+    " content_validation, comment) FROM STDIN"
+)
+
+EXPECTED_COPY_BUFFER = (
+    "2021-01-01 00:00:00\thttps://www.monedo.com/\tWeb metric collection service\t0:00:00.123456"
+    "\t200\t104.18.91.87\tTrue\ttest\n"
+    "2021-01-01 00:00:00\thttps://www.monedo.com/\tWeb metric collection service\t0:00:00.123456"
+    "\t200\t104.18.91.87\tTrue\ttest\n"
+    "2021-01-01 00:00:00\thttps://www.monedo.com/\tWeb metric collection service\t\\N"
+    "\t200\t\\N\t\\N\ttest\n"
+)
+
 EXPECTED_ARGS_DELETE = [
     "DELETE",
     "FROM web_metrics.metrics",
-    "WHERE comment='test'",
-    "RETURNING *;"
+    "WHERE comment='test'"
 ]
+
+
+@pytest.mark.unit
+def test_idempotent_insert_skips_stored_records():
+    partition = ('website-metrics', 0)
+    cursor = MagicMock()
+    cursor.fetchall.side_effect = [[('website-metrics', 0, 11)], []]
+    db_lib = _db_lib_with_cursor(cursor)
+    db = WebMonitoringDBWrapper(
+        'host', 'port', 'user', 'password', 'mock-db', provisioning='startup', idempotent=True
+    )
+    batch = Batch(consumer.fetch_latest(), [partition] * 3, [10, 11, 12])
+    db.insert(batch, schema=SCHEMA, table=TABLE, db_lib=db_lib)
+    # the whole write is a single transaction, committed on exit
+    db_lib.connect.return_value.__exit__.assert_called_once_with(None, None, None)
+    assert f'FROM {SCHEMA}.{TABLE}_offsets' in cursor.execute.call_args_list[0][0][0]
+    insert_query = cursor.execute.call_args_list[1][0][0]
+    assert insert_query.count("('2021-01-01 00:00:00'") == 2
+    update_query, update_args = cursor.executemany.call_args[0]
+    assert 'GREATEST' in update_query and update_args == [(13, 'website-metrics', 0)]
+
+
+@pytest.mark.unit
+def test_idempotent_insert_keeps_positions_of_valid_records():
+    partition = ('website-metrics', 0)
+    cursor = MagicMock()
+    cursor.fetchall.side_effect = [[], []]
+    dead_letters = MagicMock()
+    db = WebMonitoringDBWrapper(
+        'host', 'port', 'user', 'password', 'mock-db', provisioning='startup', idempotent=True, dead_letters=dead_letters
+    )
+    records = consumer.fetch_latest()
+    batch = Batch([records[0], {'unknown': 1}, records[2]], [partition] * 3, [10, 11, 12])
+    prepared = db.prepare_insert(batch, SCHEMA, TABLE)
+    assert isinstance(prepared.data, Batch) and list(prepared.data.offsets) == [10, 12]
+    db.write_prepared(prepared, db_lib=_db_lib_with_cursor(cursor))
+    dead_letters.send.assert_called_once()
+    assert f'FROM {SCHEMA}.{TABLE}_offsets' in cursor.execute.call_args_list[0][0][0]
+    update_query, update_args = cursor.executemany.call_args[0]
+    assert update_args == [(13, 'website-metrics', 0)]
+
+
+class _ConnectionLost(Exception):
+    pgcode = '08006'
+
+
+class _InvalidDatetime(Exception):
+    pgcode = '22007'
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('error, raised', [(_ConnectionLost, True), (_InvalidDatetime, False)])
+def test_only_errors_not_caused_by_data_are_raised(error, raised):
+    cursor = MagicMock()
+    cursor.execute.side_effect = error('failure')
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db', provisioning='startup')
+    insert = partial(db.insert, consumer.fetch_latest(), SCHEMA, TABLE, _db_lib_with_cursor(cursor), raise_errors=True)
+    if raised:
+        with pytest.raises(error):
+            insert()
+    else:
+        assert insert() is None
+
+
+@pytest.mark.unit
+def test_tune_validates_all_settings_before_change():
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db')
+    with pytest.raises(ValueError):
+        db.tune(ingest_mode='copy', page_size=0)
+    assert db._ingest_mode == 'values'
+    db.tune(ingest_mode='prepared', page_size=10)
+    assert (db._ingest_mode, db._page_size) == ('prepared', 10)
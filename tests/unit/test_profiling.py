@@ -0,0 +1,62 @@
+import pstats
+import time
+import tracemalloc
+
+import pytest
+
+from src.profiling import CycleProfiler
+
+
+def _busy_cycle():
+    data = [str(i) * 10 for i in range(20000)]
+    deadline = time.monotonic() + 0.05
+    while time.monotonic() < deadline:
+        sum(len(item) for item in data[:1000])
+    return data
+
+
+@pytest.mark.unit
+def test_nothing_is_profiled_until_requested(tmp_path):
+    profiler = CycleProfiler(str(tmp_path / 'profiles'))
+    profiler.start_cycle()
+    assert profiler.end_cycle(0) is None
+    assert not profiler.active
+    assert not (tmp_path / 'profiles').exists()
+
+
+@pytest.mark.unit
+def test_requested_cycles_are_profiled(tmp_path):
+    profiler = CycleProfiler(str(tmp_path), cycles=3, cpu='cprofile', memory=True, top=5)
+    profiler.request(cycles=2)
+    reports = []
+    for cycle in range(3):
+        profiler.start_cycle()
+        kept = _busy_cycle()
+        reports.append(profiler.end_cycle(cycle))
+    assert reports[2] is None
+    assert not tracemalloc.is_tracing()
+    first = reports[0]
+    assert len(first.hot_functions) == 5
+    assert any('_busy_cycle' in line or 'test_profiling' in line for line, _ in first.top_allocators)
+    assert sorted(path.suffix for path in tmp_path.iterdir()) == ['.prof', '.prof', '.tracemalloc', '.tracemalloc']
+    assert pstats.Stats(first.dumps[0]).total_calls > 0
+    assert len(kept) == 20000
+
+
+@pytest.mark.unit
+def test_sampling_profiler_writes_collapsed_stacks(tmp_path):
+    profiler = CycleProfiler(str(tmp_path), cycles=1, cpu='sampling', memory=False, sample_interval=0.001, requested=True)
+    profiler.start_cycle()
+    _busy_cycle()
+    report = profiler.end_cycle(7)
+    assert report.dumps == [str(next(tmp_path.iterdir()))]
+    assert report.dumps[0].endswith('-000007.stacks')
+    with open(report.dumps[0]) as dump:
+        assert any('_busy_cycle' in line for line in dump)
+    assert report.hot_functions
+
+
+@pytest.mark.unit
+def test_unknown_cpu_profiler():
+    with pytest.raises(ValueError):
+        CycleProfiler(cpu='perf')
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from src.decoders import InvalidMessage, RecordDecoder
+from src.postgres_wrapper import WebMonitoringDBWrapper
+from src.records import Batch, MetricRecord, records_from_dicts
+from tests.mocks.consumer import valid_data
+
+
+@pytest.mark.unit
+def test_record_fields_follow_table_columns():
+    assert MetricRecord._fields == tuple(WebMonitoringDBWrapper.DATA_TO_DB)
+
+
+@pytest.mark.unit
+def test_record_dict_adapter():
+    records = records_from_dicts(valid_data)
+    assert [record.to_dict() for record in records] == [dict(MetricRecord._field_defaults, **d) for d in valid_data]
+    with pytest.raises(TypeError):
+        MetricRecord.from_dict(dict(valid_data[0], unknown='key'))
+
+
+@pytest.mark.unit
+def test_record_decoder_shares_repeated_values():
+    decoder = RecordDecoder()
+    first, second = [decoder(json.dumps(record).encode('utf-8')) for record in valid_data[:2]]
+    assert isinstance(first, MetricRecord)
+    assert first == MetricRecord.from_dict(valid_data[0])
+    assert first.url is second.url
+    assert isinstance(decoder(b'{"url": 1, "unknown": 2}'), InvalidMessage)
+
+
+@pytest.mark.unit
+def test_records_are_copied_like_dicts():
+    buffer = WebMonitoringDBWrapper.to_copy_buffer(records_from_dicts(valid_data))
+    assert buffer.read() == WebMonitoringDBWrapper.to_copy_buffer(valid_data).read()
+    assert WebMonitoringDBWrapper.validate_record(MetricRecord.from_dict(valid_data[0])) is None
+
+
+@pytest.mark.unit
+def test_batch_keeps_positions_of_records():
+    partition = ('website-metrics', 0)
+    batch = Batch(valid_data, [partition] * 3, [10, 11, 12])
+    assert batch == valid_data
+    half = batch[1:]
+    assert isinstance(half, Batch) and list(half.offsets) == [11, 12]
+    assert batch.next_offsets() == {partition: 13}
+    fresh = batch.after({partition: 12})
+    assert fresh == valid_data[2:] and list(fresh.offsets) == [12]
+    assert batch.after({('website-metrics', 1): 100}) is batch
@@ -0,0 +1,101 @@
+import copy
+import os
+
+import pytest
+
+from unittest.mock import MagicMock
+
+from src.reload import ConfigReloader
+from src.scheduler import FlushScheduler
+from src.service import consume_publish_run
+from tests.mocks.consumer import valid_data
+
+
+CONFIG = {
+    'Metrics storage endpoint': {
+        'docker': {
+            'upload every': 60,
+            'batch max records': 1000,
+            'pool size': 4,
+            'db': {'type': 'postgres', 'ingest mode': 'values', 'page size': 1000}
+        }
+    },
+    'Metrics collection endpoint': {
+        'docker': {'broker': {'type': 'kafka', 'decoder': 'record'}}
+    }
+}
+
+
+class _Files:
+    """Config held in memory, 'saving' it changes modification time of the watched file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.config = copy.deepcopy(CONFIG)
+        self.save()
+
+    def save(self):
+        self.path.write_text(str(self.config))
+        stamp = os.stat(self.path).st_mtime_ns + 1000000000
+        os.utime(self.path, ns=(stamp, stamp))
+
+    def read(self):
+        return copy.deepcopy(self.config)
+
+
+def _reloader(tmp_path):
+    files = _Files(tmp_path / 'service.yaml')
+    reloader = ConfigReloader('docker', 'docker', check_interval=0, reader=files.read, paths=[files.path])
+    return files, reloader
+
+
+@pytest.mark.unit
+def test_changed_tunables_are_reported_once(tmp_path):
+    files, reloader = _reloader(tmp_path)
+    assert reloader.check() == {}
+    storage = files.config['Metrics storage endpoint']['docker']
+    storage['batch max records'] = 500
+    storage['db']['ingest mode'] = 'copy'
+    files.save()
+    assert reloader.check() == {'max_records': 500, 'ingest_mode': 'copy'}
+    assert reloader.check() == {}
+
+
+@pytest.mark.unit
+def test_not_reloadable_and_invalid_changes_are_rejected(tmp_path, caplog):
+    files, reloader = _reloader(tmp_path)
+    storage = files.config['Metrics storage endpoint']['docker']
+    storage['pool size'] = 8
+    storage['db']['page size'] = 0
+    storage['upload every'] = 30
+    files.config['Metrics collection endpoint']['docker']['broker']['decoder'] = 'dict'
+    files.save()
+    assert reloader.check() == {'sleep_time': 30}
+    assert 'pool size" requires restart' in caplog.text
+    assert 'broker / decoder" requires restart' in caplog.text
+    assert 'Invalid value of "Metrics storage endpoint / db / page size": 0' in caplog.text
+
+
+@pytest.mark.unit
+def test_files_are_not_read_until_changed(tmp_path):
+    files, reloader = _reloader(tmp_path)
+    reloader._reader = MagicMock(side_effect=AssertionError('config shall not be read'))
+    assert reloader.check() == {}
+
+
+@pytest.mark.unit
+def test_tunables_are_applied_between_cycles():
+    consumer = MagicMock()
+    consumer.iter_batches.return_value = iter([valid_data])
+    db_wrapper = MagicMock()
+    scheduler = FlushScheduler(max_records=10, max_idle_sleep=0)
+    reloader = MagicMock()
+    reloader.check.side_effect = [{'max_records': 2, 'sleep_time': 0, 'page_size': 10}, {}]
+    consume_publish_run(consumer, db_wrapper, sleep_time=0, cycles=3, scheduler=scheduler, reloader=reloader)
+    assert scheduler.max_records == 2
+    assert scheduler.max_idle_sleep == 0
+    db_wrapper.tune.assert_called_once_with(ingest_mode=None, page_size=10)
+    with pytest.raises(ValueError):
+        scheduler.update(max_records=0)
+    with pytest.raises(ValueError):
+        scheduler.update(backoff_factor=3)
@@ -0,0 +1,101 @@
+import datetime
+import pytest
+
+from unittest.mock import MagicMock
+
+from src.decoders import InvalidMessage
+from src.postgres_wrapper import WebMonitoringDBWrapper
+from src.records import MetricRecord
+from src.rollups import RESPONSE_TIME_BOUNDS, Rollup, aggregate, response_seconds
+
+
+np = pytest.importorskip('numpy')
+
+MINUTE = datetime.datetime(2021, 1, 1, 0, 0)
+
+
+def _record(url='https://www.monedo.com/', timestamp='2021-01-01 00:00:00', **kwargs):
+    return dict(
+        {
+            'request_timestamp': timestamp,
+            'url': url,
+            'service_name': 'Web metric collection service',
+            'resp_time': '0:00:00.123456',
+            'resp_status_code': 200,
+            'pattern_found': True
+        },
+        **kwargs
+    )
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('value, seconds', [
+    ('0:00:00.123456', 0.123456),
+    ('1:01:01', 3661),
+    (datetime.timedelta(milliseconds=250), 0.25),
+    (0.5, 0.5)
+])
+def test_response_seconds(value, seconds):
+    assert response_seconds(value) == pytest.approx(seconds)
+
+
+@pytest.mark.unit
+def test_records_aggregated_per_url_and_minute():
+    rollup = aggregate([
+        _record(),
+        _record(timestamp='2021-01-01 00:00:59', resp_time='0:00:02', resp_status_code=503, pattern_found=False),
+        _record(timestamp='2021-01-01 00:01:00', resp_time=None, pattern_found=None),
+        _record(url='https://www.example.com/')
+    ])
+    assert [row[:2] for row in rollup.minutes] == [
+        ('https://www.example.com/', MINUTE),
+        ('https://www.monedo.com/', MINUTE),
+        ('https://www.monedo.com/', MINUTE + datetime.timedelta(minutes=1))
+    ]
+    url, minute, requests, timed, total, histogram, validations, failures = rollup.minutes[1]
+    assert (requests, timed, validations, failures) == (2, 2, 2, 1)
+    assert total == pytest.approx(2.123456)
+    assert len(histogram) == len(RESPONSE_TIME_BOUNDS) + 1
+    assert histogram[RESPONSE_TIME_BOUNDS.index(0.15)] == 1 and histogram[RESPONSE_TIME_BOUNDS.index(2.0)] == 1
+    assert rollup.minutes[2][2:5] == (1, 0, 0.0)
+    assert rollup.statuses == [
+        ('https://www.example.com/', MINUTE, 200, 1),
+        ('https://www.monedo.com/', MINUTE, 200, 1),
+        ('https://www.monedo.com/', MINUTE, 503, 1),
+        ('https://www.monedo.com/', MINUTE + datetime.timedelta(minutes=1), 200, 1)
+    ]
+
+
+@pytest.mark.unit
+def test_invalid_records_not_aggregated():
+    rollup = aggregate([
+        InvalidMessage('{', 'Not a valid JSON'),
+        MetricRecord(**_record()),
+        _record(timestamp='yesterday'),
+        _record(url=None)
+    ])
+    assert [row[2] for row in rollup.minutes] == [1]
+    assert aggregate([InvalidMessage('{', 'Not a valid JSON')]) is None
+
+
+@pytest.mark.unit
+def test_unknown_status_code_not_counted_per_status():
+    rollup = aggregate([_record(resp_status_code='abc'), _record(resp_status_code='200')])
+    assert [row[2] for row in rollup.minutes] == [2]
+    assert rollup.statuses == [('https://www.monedo.com/', MINUTE, 200, 1)]
+
+
+@pytest.mark.unit
+def test_rollup_merged_in_one_transaction():
+    cursor = MagicMock()
+    db_lib = MagicMock()
+    db_lib.connect.return_value.closed = 0
+    db_lib.connect.return_value.cursor.return_value.__enter__.return_value = cursor
+    db = WebMonitoringDBWrapper('host', 'port', 'user', 'password', 'mock-db')
+    rollup = Rollup([('https://www.monedo.com/', MINUTE, 1, 1, 0.1, [0, 1], 1, 0)], [])
+    assert db.merge_rollup(rollup, 'web_metrics', 'metrics', db_lib)
+    minutes_query, minutes_rows = cursor.executemany.call_args_list[0][0]
+    assert 'INSERT INTO web_metrics.metrics_rollup_minute' in minutes_query
+    assert 'ON CONFLICT (url, time_stamp) DO UPDATE' in minutes_query
+    assert minutes_rows == rollup.minutes
+    db_lib.connect.return_value.__exit__.assert_called_once_with(None, None, None)
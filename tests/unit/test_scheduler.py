@@ -0,0 +1,38 @@
+import pytest
+
+from src.consumer import Consumer
+from src.scheduler import FlushScheduler
+from tests.mocks.consumer import valid_data
+from tests.mocks.kafka_lib_mock import make_poll_result
+from unittest.mock import MagicMock
+
+
+@pytest.mark.unit
+def test_flush_on_first_reached_threshold():
+    scheduler = FlushScheduler(max_records=10, max_bytes=100, max_staleness=1)
+    assert scheduler.flush_reason(0, 0, 5) is None
+    assert scheduler.flush_reason(1, 10, 0.5) is None
+    assert scheduler.flush_reason(10, 1000, 5) == 'records'
+    assert scheduler.flush_reason(5, 100, 5) == 'bytes'
+    assert scheduler.flush_reason(5, 10, 1) == 'staleness'
+
+
+@pytest.mark.unit
+def test_idle_backoff_grows_and_resets():
+    scheduler = FlushScheduler(min_idle_sleep=1, max_idle_sleep=5, backoff_factor=2)
+    assert [scheduler.end_cycle().sleep for _ in range(4)] == [1, 2, 4, 5]
+    scheduler.record_flush('drained', 3, 300, 0.1)
+    summary = scheduler.end_cycle()
+    assert summary.sleep == 0
+    assert summary.flushes == {'drained': 1}
+    assert scheduler.end_cycle().sleep == 1
+
+
+@pytest.mark.unit
+def test_consumer_records_flush_decisions():
+    consumer = Consumer('website-metrics', security_protocol='PLAINTEXT')
+    consumer._consumer = MagicMock()
+    consumer._consumer.poll.side_effect = [make_poll_result(valid_data[:2]), make_poll_result(valid_data[2:]), {}]
+    scheduler = FlushScheduler(max_records=2, max_staleness=60)
+    list(consumer.iter_batches(scheduler=scheduler))
+    assert [(flush.reason, flush.records) for flush in scheduler.flushes] == [('records', 2), ('drained', 1)]
@@ -0,0 +1,190 @@
+import signal
+import threading
+import time
+
+import pytest
+
+from unittest.mock import MagicMock
+
+from src.scheduler import FlushScheduler
+from src.service import SCHEMA, TABLE, ConsumePublishService, consume_publish_run, run_worker
+from src.supervisor import WorkerSupervisor
+from src.spool import DiskSpool
+from tests.mocks.consumer import valid_data
+
+
+def _write_prepared(prepared, written=None, **kwargs):
+    written.extend(prepared.data)
+    return prepared.rows
+
+
+@pytest.mark.unit
+def test_batches_are_posted_as_they_arrive():
+    consumer = MagicMock()
+    consumer.iter_batches.return_value = iter([valid_data[:2], valid_data[2:]])
+    db_wrapper = MagicMock()
+    consume_publish_run(
+        consumer,
+        db_wrapper,
+        sleep_time=0,
+        cycles=1,
+        db_schema=SCHEMA,
+        db_table=TABLE,
+        scheduler=FlushScheduler(max_records=2)
+    )
+    consumer.iter_batches.assert_called_once()
+    consumer.fetch_latest.assert_not_called()
+    assert [call[0][0] for call in db_wrapper.prepare_insert.call_args_list] == [valid_data[:2], valid_data[2:]]
+    assert db_wrapper.write_prepared.call_count == 2
+
+
+@pytest.mark.unit
+def test_failed_write_is_not_committed():
+    consumer = MagicMock()
+    consumer.iter_batches.return_value = iter([valid_data])
+    db_wrapper = MagicMock()
+    db_wrapper.write_prepared.side_effect = ConnectionError('DB is gone')
+    scheduler = FlushScheduler(max_records=3, min_idle_sleep=0)
+    consume_publish_run(
+        consumer, db_wrapper, sleep_time=0, cycles=1, db_schema=SCHEMA, db_table=TABLE, scheduler=scheduler
+    )
+    consumer.mark_processed.assert_not_called()
+    consumer.rewind.assert_called_once()
+    assert scheduler.cycles[-1].failed
+
+
+@pytest.mark.unit
+def test_failed_write_is_spooled(tmp_path):
+    consumer = MagicMock()
+    consumer.iter_batches.return_value = iter([valid_data])
+    db_wrapper = MagicMock()
+    db_wrapper.write_prepared.side_effect = ConnectionError('DB is gone')
+    # spooled batches are replayed with insert
+    db_wrapper.insert.side_effect = ConnectionError('DB is gone')
+    spool = DiskSpool(tmp_path)
+    consume_publish_run(
+        consumer, db_wrapper, sleep_time=0, cycles=1, db_schema=SCHEMA, db_table=TABLE,
+        scheduler=FlushScheduler(max_records=3), spool=spool, spool_settings={'retry_interval': 60}
+    )
+    consumer.mark_processed.assert_called_once_with(valid_data)
+    consumer.rewind.assert_not_called()
+    assert spool.peek()[1] == valid_data
+
+
+@pytest.mark.unit
+def test_rollups_merged_after_write():
+    pytest.importorskip('numpy')
+    consumer = MagicMock()
+    consumer.iter_batches.return_value = iter([valid_data])
+    db_wrapper = MagicMock()
+    db_wrapper.prepare_insert.side_effect = lambda data, **kwargs: MagicMock(rows=len(data), data=data)
+    db_wrapper.write_prepared.side_effect = _write_prepared
+    consume_publish_run(
+        consumer, db_wrapper, sleep_time=0, cycles=1, db_schema=SCHEMA, db_table=TABLE,
+        scheduler=FlushScheduler(max_records=3), pipeline_depth=1, rollups=True
+    )
+    db_wrapper.create_rollup_tables.assert_called_once_with(SCHEMA, TABLE)
+    rollup = db_wrapper.merge_rollup.call_args[0][0]
+    assert sum(row[2] for row in rollup.minutes) == len(valid_data)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('pipeline_depth, max_records', [(0, 0), (0, 4), (1, 4)])
+def test_rollups_aggregate_records_given_to_writer(pipeline_depth, max_records):
+    pytest.importorskip('numpy')
+    consumer = MagicMock()
+    invalid = dict(valid_data[0], resp_status_code='abc')
+    consumer.fetch_latest.return_value = valid_data + [invalid]
+    consumer.iter_batches.return_value = iter([valid_data + [invalid]])
+    db_wrapper = MagicMock()
+    # as if invalid record is sent to dead letters
+    db_wrapper.prepare_insert.side_effect = lambda data, **kwargs: MagicMock(rows=len(data) - 1, data=data[:-1])
+    db_wrapper.write_prepared.side_effect = _write_prepared
+    consume_publish_run(
+        consumer, db_wrapper, sleep_time=0, cycles=1, db_schema=SCHEMA, db_table=TABLE,
+        scheduler=FlushScheduler(max_records=max_records) if max_records else None,
+        pipeline_depth=pipeline_depth,
+        rollups=True
+    )
+    rollup = db_wrapper.merge_rollup.call_args[0][0]
+    assert sum(row[2] for row in rollup.minutes) == len(valid_data)
+
+
+@pytest.mark.unit
+def test_rollups_skip_records_rejected_by_db():
+    consumer = MagicMock()
+    consumer.iter_batches.return_value = iter([valid_data])
+    db_wrapper = MagicMock()
+    db_wrapper.prepare_insert.side_effect = lambda data, **kwargs: MagicMock(rows=len(data), data=data)
+    # DB rejected the data, nothing is written
+    db_wrapper.write_prepared.return_value = None
+    aggregate = MagicMock()
+    service = ConsumePublishService(
+        consumer, db_wrapper, sleep_time=0, cycles=1, db_schema=SCHEMA, db_table=TABLE,
+        scheduler=FlushScheduler(max_records=3), aggregate=aggregate
+    )
+    service.run()
+    consumer.mark_processed.assert_called_once_with(valid_data)
+    aggregate.assert_not_called()
+    db_wrapper.merge_rollup.assert_not_called()
+
+
+@pytest.mark.unit
+def test_profiler_wraps_every_cycle():
+    consumer = MagicMock()
+    consumer.fetch_latest.return_value = valid_data
+    profiler = MagicMock()
+    consume_publish_run(consumer, MagicMock(), sleep_time=0, cycles=2, profiler=profiler)
+    assert profiler.start_cycle.call_count == 2
+    assert [call[0][0] for call in profiler.end_cycle.call_args_list] == [0, 1]
+
+
+def _idle_consumer():
+    consumer = MagicMock()
+    consumer.fetch_latest.return_value = []
+    return consumer
+
+
+@pytest.mark.unit
+def test_stop_request_finishes_current_batch_and_commits():
+    stop = threading.Event()
+    consumer = MagicMock()
+    consumer.fetch_latest.return_value = valid_data
+    db_wrapper = MagicMock()
+    db_wrapper.write_prepared.side_effect = lambda *args, **kwargs: stop.set()
+    # infinite service with long sleep returns right after the batch
+    consume_publish_run(consumer, db_wrapper, sleep_time=60, stop=stop)
+    db_wrapper.write_prepared.assert_called_once()
+    consumer.mark_processed.assert_called_once_with(valid_data)
+    consumer.commit_processed.assert_called_once()
+
+
+@pytest.mark.unit
+def test_worker_closes_dead_letters_and_spool(tmp_path):
+    db_wrapper = MagicMock()
+    spool = DiskSpool.claim(tmp_path)
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        run_worker(_idle_consumer, lambda: db_wrapper, spool_factory=lambda: spool, sleep_time=0, cycles=1)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+    db_wrapper.close.assert_called_once()
+    db_wrapper.dead_letters.close.assert_called_once()
+    # spool is released for the next worker
+    assert DiskSpool.claim(tmp_path).directory == spool.directory
+
+
+@pytest.mark.unit
+def test_worker_exits_cleanly_on_sigterm():
+    supervisor = WorkerSupervisor(
+        run_worker,
+        kwargs={'consumer_factory': _idle_consumer, 'db_factory': MagicMock, 'sleep_time': 60},
+        check_interval=0.01
+    )
+    supervisor.start()
+    # let the worker install its signal handlers
+    time.sleep(0.5)
+    started = time.monotonic()
+    assert supervisor.stop(timeout=10) == 0
+    assert time.monotonic() - started < 5
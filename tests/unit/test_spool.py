@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+from src.spool import DiskSpool, SpooledWriter, SpoolFull
+from tests.mocks.consumer import valid_data
+
+
+class _FlakyDB:
+    def __init__(self, failures: int = 0, delay: float = 0.0):
+        self.failures = failures
+        self.delay = delay
+        self.stored = list()
+
+    def write(self, batch):
+        time.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('DB is unavailable')
+        self.stored.append(batch)
+
+
+def _wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+@pytest.mark.unit
+def test_spool_keeps_order_across_restarts(tmp_path):
+    spool = DiskSpool(tmp_path)
+    spool.append(valid_data[:1])
+    spool.append(valid_data[1:])
+    reopened = DiskSpool(tmp_path)
+    assert reopened.stats() == {'batches': 2, 'records': 3, 'bytes': spool.stats()['bytes']}
+    path, batch = reopened.peek()
+    assert batch == valid_data[:1]
+    reopened.remove(path)
+    assert reopened.peek()[1] == valid_data[1:]
+
+
+@pytest.mark.unit
+def test_spool_size_is_limited(tmp_path):
+    spool = DiskSpool(tmp_path, max_bytes=100)
+    with pytest.raises(SpoolFull):
+        spool.append(valid_data)
+    assert spool.depth() == 0
+
+
+@pytest.mark.unit
+def test_claimed_spools_are_not_shared(tmp_path):
+    first = DiskSpool.claim(tmp_path)
+    second = DiskSpool.claim(tmp_path)
+    assert first.directory != second.directory
+
+
+@pytest.mark.unit
+def test_closed_spool_could_be_claimed_again(tmp_path):
+    first = DiskSpool.claim(tmp_path)
+    first.close()
+    assert DiskSpool.claim(tmp_path).directory == first.directory
+
+
+@pytest.mark.unit
+def test_failed_batches_are_replayed_in_order(tmp_path):
+    db = _FlakyDB(failures=2)
+    writer = SpooledWriter(db.write, DiskSpool(tmp_path), retry_interval=0.01)
+    assert not writer.write(valid_data[:1])
+    # the spool isn't empty, so the next batch waits behind the failed one
+    assert not writer.write(valid_data[1:])
+    writer.start()
+    try:
+        _wait_for(lambda: writer.spool.depth() == 0)
+    finally:
+        writer.stop(1)
+    assert db.stored == [valid_data[:1], valid_data[1:]]
+    assert writer.write(valid_data)
+
+
+@pytest.mark.unit
+def test_batches_are_spooled_when_db_is_slow(tmp_path):
+    db = _FlakyDB(delay=0.05)
+    writer = SpooledWriter(db.write, DiskSpool(tmp_path), latency_budget=0.01)
+    assert writer.write(valid_data)
+    assert not writer.write(valid_data)
+    assert writer.stats()['spooled'] == len(valid_data)
@@ -0,0 +1,97 @@
+import sys
+import time
+
+import pytest
+
+from src.supervisor import LagAutoscaler, WorkerSupervisor
+
+
+def _crash_once(counters):
+    # first run of every worker crashes, restarted one finishes successfully
+    if not counters.snapshot()['cycles']:
+        counters.add(cycles=1)
+        sys.exit(3)
+    counters.add(messages=10, batches=1)
+
+
+def _always_crash(counters):
+    sys.exit(5)
+
+
+def _run_forever(counters):
+    counters.add(cycles=1)
+    while True:
+        time.sleep(0.01)
+
+
+@pytest.mark.unit
+def test_crashed_workers_are_restarted():
+    supervisor = WorkerSupervisor(_crash_once, workers=2, restart_delay=0, check_interval=0.01)
+    supervisor.start()
+    assert supervisor.join(timeout=10)
+    assert supervisor.exit_code() == 0
+    stats = supervisor.stats()
+    assert stats['messages'] == 20
+    assert stats['restarts'] == 2
+    assert [worker['batches'] for worker in stats['workers']] == [1, 1]
+
+
+@pytest.mark.unit
+def test_restart_limit_and_combined_exit_code():
+    supervisor = WorkerSupervisor(_always_crash, workers=1, max_restarts=1, restart_delay=0, check_interval=0.01)
+    supervisor.start()
+    assert supervisor.join(timeout=10)
+    assert supervisor.exit_code() == 5
+    assert supervisor.stats()['restarts'] == 1
+
+
+@pytest.mark.unit
+def test_scale_to_starts_and_stops_workers():
+    supervisor = WorkerSupervisor(_run_forever, workers=1, check_interval=0.01)
+    supervisor.start()
+    try:
+        assert supervisor.scale_to(3) == 3
+        assert supervisor.workers == 3
+        assert supervisor.scale_to(1) == 1
+        assert supervisor.workers == 1
+        assert len(supervisor.exit_codes()) == 1
+        assert supervisor.is_running()
+    finally:
+        supervisor.stop(timeout=5)
+    # counters of stopped workers are kept
+    assert supervisor.stats()['cycles'] <= 3
+    assert len(supervisor.stats()['workers']) == 1
+    with pytest.raises(ValueError):
+        supervisor.scale_to(0)
+
+
+@pytest.mark.unit
+def test_autoscaler_scales_on_sustained_lag():
+    autoscaler = LagAutoscaler(
+        None, lambda: 0, min_workers=1, max_workers=3, scale_up_lag=100, scale_down_lag=10, sustain=5, cooldown=20
+    )
+    # spike shorter than sustain period is ignored
+    assert autoscaler.decide(500, workers=1, now=0) is None
+    assert autoscaler.decide(50, workers=1, now=3) is None
+    assert autoscaler.decide(500, workers=1, now=4) is None
+    assert autoscaler.decide(500, workers=1, now=9) == 2
+    autoscaler._last_scaled = 9
+    # cooldown
+    assert autoscaler.decide(500, workers=2, now=20) is None
+    assert autoscaler.decide(500, workers=2, now=29) == 3
+    # upper bound
+    assert autoscaler.decide(500, workers=3, now=100) is None
+    assert autoscaler.decide(0, workers=3, now=101) is None
+    assert autoscaler.decide(0, workers=3, now=106) == 2
+    # lower bound
+    assert autoscaler.decide(0, workers=1, now=200) is None
+    # out of bounds number of workers is corrected right away
+    assert autoscaler.decide(50, workers=5, now=201) == 3
+
+
+@pytest.mark.unit
+def test_autoscaler_rejects_inconsistent_settings():
+    with pytest.raises(ValueError):
+        LagAutoscaler(None, lambda: 0, min_workers=3, max_workers=2)
+    with pytest.raises(ValueError):
+        LagAutoscaler(None, lambda: 0, scale_up_lag=10, scale_down_lag=10)
@@ -1,3 +1,5 @@
+# Stand-in for psycopg2 which accepts any query, used by unit tests and by benchmarks
+# measuring client side cost of DB writes
 from unittest.mock import MagicMock
 
 
@@ -7,6 +9,8 @@ mock_db_cursor = MagicMock()
 mock_db_active_cursor = MagicMock()
 
 mock_db_lib.connect.return_value = mock_db_connection
+# psycopg2 connection reports 0 while it's open
+mock_db_connection.closed = 0
 mock_db_connection.cursor.return_value = mock_db_cursor
 mock_db_cursor.__enter__.return_value = mock_db_active_cursor
 mock_db_active_cursor.execute.return_value = None
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
-import yaml
+import threading
 
 from pathlib import Path
 
@@ -12,6 +12,8 @@ class ConfigParser:
     def __new__(cls, path):
         if not Path.exists(path):
             return None
+        # yaml is imported only when config is actually read
+        import yaml
         with open(path, 'r') as f:
             contents = f.read()
             return yaml.safe_load(contents)
@@ -31,6 +33,32 @@ _path_to_local_config = Path(
         _path_to_config_folder.joinpath('service_local.yaml')
     )
 )
-config = ConfigParser(_path_to_config)
-_config_local = ConfigParser(_path_to_local_config)
-config = merge_dicts(config, _config_local)
+
+_config = None
+_config_lock = threading.Lock()
+
+
+def config_paths() -> tuple:
+    """Returns paths of service.yaml and service_local.yaml, the latter may not exist"""
+    return _path_to_config, _path_to_local_config
+
+
+def read_config() -> dict:
+    """Reads service.yaml merged with service_local.yaml, every call reads the files again"""
+    return merge_dicts(ConfigParser(_path_to_config), ConfigParser(_path_to_local_config))
+
+
+def load_config() -> dict:
+    """Returns config read on the first call, see read_config"""
+    global _config
+    with _config_lock:
+        if _config is None:
+            _config = read_config()
+        return _config
+
+
+def __getattr__(name):
+    # config used to be read on import, it's kept as attribute read on first access
+    if name == 'config':
+        return load_config()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')